@@ -1,5 +1,7 @@
 from django.conf import settings
+from django.http import JsonResponse
 from helper.exceptions import SmoothException
+import hmac
 import ipaddress
 
 class InternalAPIMiddleware:
@@ -13,23 +15,30 @@ class InternalAPIMiddleware:
         INTERNAL_API_PREFIX = "/api/internal/"
 
         if request.path.startswith(INTERNAL_API_PREFIX):
-            # Check Auth Header
-            auth_header = request.headers.get("X-Service-Auth")
-            if auth_header != self.internal_secret_key:
-                raise SmoothException("Invalid service authentication token.", status_code=401)
-
-            # Check Internal IP
-            client_ip = request.META.get("REMOTE_ADDR", "")
             try:
-                ip_addr = ipaddress.ip_address(client_ip)
-                if ip_addr not in self.internal_network:
-                    raise SmoothException("Forbidden: Invalid Internal IP", status_code=403)
-            except ValueError:
-                raise SmoothException("Invalid IP Address", status_code=400)
-
-            # Check Hostname
-            request_host = request.get_host().split(":")[0]
-            if request_host not in self.allowed_hosts:
-                raise SmoothException("Forbidden: Invalid Hostname", status_code=403)
+                self.check(request)
+            except SmoothException as e:
+                # Raised outside a DRF view, so DRF's exception handler never sees it
+                return JsonResponse({"detail": e.message, "redirect_url": e.redirect_url}, status=e.status_code)
 
         return self.get_response(request)
+
+    def check(self, request):
+        # Check Auth Header; without a configured secret every request is refused
+        auth_header = request.headers.get("X-Service-Auth") or ""
+        if not self.internal_secret_key or not hmac.compare_digest(auth_header, self.internal_secret_key):
+            raise SmoothException("Invalid service authentication token.", status_code=401)
+
+        # Check Internal IP
+        client_ip = request.META.get("REMOTE_ADDR", "")
+        try:
+            ip_addr = ipaddress.ip_address(client_ip)
+            if ip_addr not in self.internal_network:
+                raise SmoothException("Forbidden: Invalid Internal IP", status_code=403)
+        except ValueError:
+            raise SmoothException("Invalid IP Address", status_code=400)
+
+        # Check Hostname
+        request_host = request.get_host().split(":")[0]
+        if request_host not in self.allowed_hosts:
+            raise SmoothException("Forbidden: Invalid Hostname", status_code=403)
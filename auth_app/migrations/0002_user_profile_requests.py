@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-19 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='profile_requests',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -28,6 +28,7 @@ class User(AbstractBaseUser, UUIDPrimaryKey, TimeLine, IsActiveModel):
     )
     
     last_login = models.DateTimeField(null=True, blank=True)
+    profile_requests = models.BooleanField(default=False) # profile this user's chat and upload requests, see helper/profiling.py
 
     objects: UserManager = UserManager()
 
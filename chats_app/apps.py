@@ -1,6 +1,15 @@
+import os
 from django.apps import AppConfig
 
 
 class ChatsAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chats_app'
+
+    def ready(self):
+        # Comma separated model names to build and bind at startup, e.g. WARM_MODELS=gemma2-9b-it
+        warm_models = [name.strip() for name in os.getenv('WARM_MODELS', '').split(',') if name.strip()]
+        if warm_models:
+            from workflow_graphs.bujji.registry import model_registry
+            from workflow_graphs.bujji.tools import ALL_TOOLS
+            model_registry.warm(warm_models, ALL_TOOLS)
@@ -0,0 +1,102 @@
+import time
+import contextvars
+from collections import Counter
+from django.db import connections
+from django.db.backends.signals import connection_created
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from workflow_graphs.bujji.metrics import metrics
+
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+# Statements run on behalf of the current request, by database. Threads the request starts need a copy of the context.
+_request_queries : contextvars.ContextVar[Counter | None] = contextvars.ContextVar('request_queries', default=None)
+
+
+def _count_django_query(execute, sql, params, many, context):
+    queries = _request_queries.get()
+    if queries is not None:
+        queries['django'] += 1
+    return execute(sql, params, many, context)
+
+
+def _count_memory_query(connection, cursor, statement, parameters, context, executemany):
+    queries = _request_queries.get()
+    if queries is not None:
+        queries['memory'] += 1
+
+
+def _add_query_counter(connection, **kwargs):
+    if _count_django_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_django_query)
+
+
+class MeasuredStream:
+    """Streamed body that counts the request's queries while it is being produced and reports once it is done or closed."""
+    def __init__(self, streaming_content, queries: Counter, on_close):
+        self._iterator = iter(streaming_content)
+        self.queries = queries
+        self.on_close = on_close
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        token = _request_queries.set(self.queries)
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            self.close()
+            raise
+        finally:
+            _request_queries.reset(token)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.on_close()
+
+
+class RequestMetricsMiddleware:
+    """
+    Request duration and DB queries per request by view and database, plus the number of open SSE streams and
+    their duration. Streamed responses are measured until the last event is sent.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+        connection_created.connect(_add_query_counter, dispatch_uid='request-metrics')
+        for connection in connections.all(initialized_only=True):
+            _add_query_counter(connection)
+        if not event.contains(Engine, 'before_cursor_execute', _count_memory_query):
+            event.listen(Engine, 'before_cursor_execute', _count_memory_query)
+
+    def __call__(self, request):
+        queries = Counter()
+        started = time.perf_counter()
+        token = _request_queries.set(queries)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+
+        view = request.resolver_match.url_name if request.resolver_match is not None else 'unmatched'
+        if not response.streaming:
+            self.observe(view, response.status_code, started, queries)
+            return response
+
+        metrics.add_gauge('sse_active_streams', 1, view=view)
+
+        def on_close():
+            metrics.add_gauge('sse_active_streams', -1, view=view)
+            metrics.observe('sse_stream_duration_seconds', time.perf_counter() - started, view=view)
+            self.observe(view, response.status_code, started, queries)
+
+        response.streaming_content = MeasuredStream(response.streaming_content, queries, on_close)
+        return response
+
+    @staticmethod
+    def observe(view: str, status: int, started: float, queries: Counter):
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - started, view=view, status=status)
+        for database in ('django', 'memory'):
+            metrics.observe('db_queries_per_request', queries[database], buckets=QUERY_BUCKETS, view=view, database=database)
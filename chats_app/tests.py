@@ -1,3 +1,996 @@
-from django.test import TestCase
+import os
+import bz2
+import json
+import time
+import tempfile
+import threading
+import multiprocessing
+from types import SimpleNamespace
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+from django.http import StreamingHttpResponse
+from django.test import Client, SimpleTestCase, override_settings
+from rest_framework.views import APIView
+from rest_framework.test import APIRequestFactory, force_authenticate
+from langchain_core.documents import Document
+from langchain_core.tools import tool
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGenerationChunk
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from workflow_graphs.bujji.fetchers import HTMLFetcher, extract_sections, budget_sections
+from workflow_graphs.bujji.wiki_index import WikipediaIndex, extract_lead, iter_pages
+from workflow_graphs.bujji.speculation import RetrievalPrefetch
+from workflow_graphs.bujji.fakes import ScriptedChatModel, HashingEmbeddings
+from workflow_graphs.bujji.vector_dbs import InMemoryVectorDB, FAISSVectorDB
+from workflow_graphs.bujji.tool_executor import ToolExecutor, TOOL_CALL_ERROR_TEMPLATE, answered_calls
+from workflow_graphs.bujji.guardrails import TOOL_MAX_ITERATIONS, TURN_MAX_INPUT_TOKENS
+from workflow_graphs.bujji.nodes import route_model_output, call_model
+from workflow_graphs.bujji.calculator import CalculatorError, calculator
+from workflow_graphs.bujji.tools import ALL_TOOLS, calculator_tool
+from workflow_graphs.bujji import tools as tools_module
+from workflow_graphs.bujji.rate_limit import TokenBucket, CircuitBreaker, SingleFlight
+from duckduckgo_search.exceptions import RatelimitException
+from workflow_graphs.bujji.tool_selection import select_tools
+from workflow_graphs.bujji.self_discussion import decide
+from workflow_graphs.bujji.router import ModelRouter, ModelProfile
+from workflow_graphs.bujji.hedging import HedgedChatModel
+from workflow_graphs.bujji.scheduler import LLMScheduler, BaseTokenBudget, LocalTokenBudget, DatabaseTokenBudget, SchedulerTimeout, BACKGROUND
+from workflow_graphs.bujji.cassettes import CassetteRecorder, CassettePlayer, CassetteMiss
+from helper.profiling import RequestProfiler, RequestProfilingMixin
+from chats_app.views import LLMResponseSSEView
+from workflow_graphs.bujji.tracing import Trace, SpanExporter, OTLPSpanExporter, span, traced, instrument_model
+from workflow_graphs.bujji.metrics import MetricsRegistry, MultiProcessCollector, metrics, render
+from workflow_graphs.bujji import memory as memory_module
+from workflow_graphs.bujji.memory import Memory
 
-# Create your tests here.
+ARTICLE_HTML = """
+<html>
+  <head><title>Black Holes</title><script>var tracking = "should not appear";</script><style>p { color: red; }</style></head>
+  <body>
+    <header><a href="/">Home</a> <a href="/news">News</a></header>
+    <nav><ul><li><a href="/a">Menu A</a></li><li><a href="/b">Menu B</a></li></ul></nav>
+    <main>
+      <h1>Black Holes</h1>
+      <p>A black hole is a region of spacetime where gravity is so strong that nothing can escape.</p>
+      <h2>Event horizon</h2>
+      <p>The boundary of no escape is called the event horizon.</p>
+      <h2>Hawking radiation</h2>
+      <p>Black holes emit Hawking radiation because of quantum effects near the event horizon.</p>
+      <p><a href="/x">Related</a> <a href="/y">Links</a> <a href="/z">Everywhere</a></p>
+    </main>
+    <footer>Copyright footer text</footer>
+  </body>
+</html>
+"""
+
+LARGE_HTML = "<html><head><title>Large</title></head><body>" + "".join(
+    f"<h2>Section {i}</h2><p>{'Galaxies contain stars, gas and dark matter. ' * 20}</p>" for i in range(400)
+) + "</body></html>"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body: bytes, content_type: str = 'text/html; charset=utf-8'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/article':
+            self._send(ARTICLE_HTML.encode())
+        elif self.path == '/large':
+            self._send(LARGE_HTML.encode())
+        elif self.path == '/binary':
+            self._send(b'%PDF-1.4', content_type='application/pdf')
+        elif self.path == '/slow':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.end_headers()
+            self.wfile.write(b'<html><body><p>start</p>')
+            self.wfile.flush()
+            time.sleep(2)
+            self.wfile.write(b'<p>end</p></body></html>')
+        else:
+            self.send_error(404)
+
+
+class HTMLFetcherTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.fetcher = HTMLFetcher(max_bytes=200_000, timeout=1.0, connect_timeout=1.0)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.fetcher.client.close()
+        super().tearDownClass()
+
+    def test_extract_strips_boilerplate(self):
+        title, sections = extract_sections(ARTICLE_HTML)
+        text = '\n'.join(f"{section.heading}\n{section.text}" for section in sections)
+        self.assertEqual(title, "Black Holes")
+        self.assertIn("event horizon", text)
+        for boilerplate in ("tracking", "color: red", "Menu A", "Copyright", "Everywhere"):
+            self.assertNotIn(boilerplate, text)
+
+    def test_budget_prefers_query_relevant_sections(self):
+        _, sections = extract_sections(ARTICLE_HTML)
+        kept = budget_sections(sections, max_tokens=30, query="hawking radiation")
+        self.assertEqual([section.heading for section in kept], ["Hawking radiation"])
+
+    def test_fetch_text_is_token_budgeted(self):
+        text = self.fetcher.fetch_text(f"{self.base_url}/article", max_tokens=1000)
+        self.assertTrue(text.startswith("Title: Black Holes"))
+        self.assertIn("## Event horizon", text)
+
+        text = self.fetcher.fetch_text(f"{self.base_url}/large", max_tokens=500)
+        self.assertLessEqual(len(text), 500 * 4 + 200)
+
+    def test_download_is_capped(self):
+        result = self.fetcher.fetch(f"{self.base_url}/large")
+        self.assertTrue(result.truncated)
+        self.assertLessEqual(len(result.text.encode()), 200_000)
+
+    def test_non_html_is_not_downloaded(self):
+        text = self.fetcher.fetch_text(f"{self.base_url}/binary", max_tokens=500)
+        self.assertIn("Unsupported content type 'application/pdf'", text)
+
+    def test_slow_server_times_out(self):
+        started = time.perf_counter()
+        with self.assertRaises(Exception):
+            self.fetcher.fetch(f"{self.base_url}/slow")
+        self.assertLess(time.perf_counter() - started, 1.9)
+
+
+WIKI_DUMP_XML = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.11/">
+  <page>
+    <title>Black hole</title><ns>0</ns><id>1</id>
+    <revision><text>{{Short description|Region of spacetime}}
+A '''black hole''' is a region of [[spacetime]] where [[gravity|gravitation]] is so strong that nothing can escape.<ref>Wald 1984</ref>
+[[File:Black hole.jpg|thumb|An image of [[M87]]]]
+
+== History ==
+John Michell proposed dark stars in 1783.</text></revision>
+  </page>
+  <page>
+    <title>Hawking radiation</title><ns>0</ns><id>2</id>
+    <revision><text>'''Hawking radiation''' is thermal radiation emitted by black holes due to quantum effects near the event horizon.</text></revision>
+  </page>
+  <page>
+    <title>Blackhole</title><ns>0</ns><id>3</id><redirect title="Black hole" />
+    <revision><text>#REDIRECT [[Black hole]]</text></revision>
+  </page>
+  <page>
+    <title>Talk:Black hole</title><ns>1</ns><id>4</id>
+    <revision><text>Discussion about the article.</text></revision>
+  </page>
+</mediawiki>
+"""
+
+
+class WikipediaIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.dump_path = os.path.join(self.directory.name, 'pages-articles.xml.bz2')
+        with bz2.open(self.dump_path, 'wt', encoding='utf-8') as dump:
+            dump.write(WIKI_DUMP_XML)
+        self.index = WikipediaIndex(os.path.join(self.directory.name, 'wikipedia.sqlite3'))
+        self.imported = self.index.import_dump(self.dump_path)
+
+    def tearDown(self):
+        self.index.connection.close()
+        self.directory.cleanup()
+
+    def test_dump_skips_redirects_and_other_namespaces(self):
+        self.assertEqual(self.imported, 2)
+        self.assertEqual([title for title, _ in iter_pages(self.dump_path)], ['Black hole', 'Hawking radiation'])
+
+    def test_lead_is_plain_text(self):
+        lead = extract_lead(dict(iter_pages(self.dump_path))['Black hole'])
+        self.assertEqual(lead, "A black hole is a region of spacetime where gravitation is so strong that nothing can escape.")
+
+    def test_exact_title_lookup(self):
+        result = self.index.query("black hole")
+        self.assertTrue(result.startswith("Page: Black hole\nSummary: A black hole"))
+
+    def add_filler_articles(self, count: int = 10):
+        """Unrelated articles, so bm25 document frequencies look like a real corpus rather than two pages."""
+        connection = self.index.connection
+        connection.executemany("INSERT INTO articles (title, lead) VALUES (?, ?)", [(f"Region {number}", f"Region {number} is an administrative region of a country.") for number in range(count)])
+        connection.execute("INSERT INTO articles_fts (articles_fts) VALUES ('rebuild')")
+        connection.commit()
+
+    def test_full_text_lookup(self):
+        self.add_filler_articles()
+        self.assertIn("Page: Hawking radiation", self.index.query("thermal radiation from black holes"))
+
+    def test_partial_and_weak_matches_are_misses(self):
+        self.add_filler_articles()
+        # Only some of the terms match: the live API answers instead of an unrelated article.
+        self.assertEqual(self.index.query("dark matter radiation"), "")
+        # Every article mentions "region", so the best match is below the score threshold.
+        self.assertEqual(self.index.query("administrative region"), "")
+        self.assertEqual(WikipediaIndex(self.index.path, min_score=0).query("administrative region")[:12], "Page: Region")
+
+    def test_miss_returns_empty_string(self):
+        self.assertEqual(self.index.query("photosynthesis"), "")
+
+    def test_reimport_replaces_articles(self):
+        self.assertEqual(self.index.import_dump(self.dump_path), 2)
+        self.assertEqual(self.index.connection.execute("SELECT COUNT(*) FROM articles").fetchone()[0], 2)
+
+
+class SlowVectorDB:
+    """Stand-in for a vector store whose query embedding and search take `latency` seconds."""
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+
+    def query(self, query: str, k: int = 5) -> str:
+        self.calls += 1
+        time.sleep(self.latency)
+        return "\n\n".join(f"Chunk {i + 1}\nRevenue in quarter {i + 1} was {10 * (i + 1)} million." for i in range(k))
+
+
+class RetrievalPrefetchTests(SimpleTestCase):
+    def test_similar_query_is_served_from_prefetch(self):
+        vector_db = SlowVectorDB(latency=0.3)
+        prefetch = RetrievalPrefetch(vector_db, "what was the revenue in the uploaded report", k=5)
+        time.sleep(0.4)  # the first model call
+        started = time.perf_counter()
+        result = prefetch.serve("quarterly revenue report", 3)
+        self.assertLess(time.perf_counter() - started, 0.05)
+        self.assertEqual(result.count("Chunk "), 3)
+        self.assertEqual(vector_db.calls, 1)
+
+    def test_different_query_or_larger_k_is_not_served(self):
+        prefetch = RetrievalPrefetch(SlowVectorDB(latency=0), "what was the revenue", k=5)
+        self.assertIsNone(prefetch.serve("employee headcount by region", 5))
+        self.assertIsNone(prefetch.serve("revenue", 10))
+
+    def test_slow_prefetch_falls_through_to_the_live_query(self):
+        prefetch = RetrievalPrefetch(SlowVectorDB(latency=1.0), "what was the revenue", k=5)
+        started = time.perf_counter()
+        self.assertIsNone(prefetch.serve("revenue", 3, timeout=0.05))
+        self.assertLess(time.perf_counter() - started, 0.5)
+
+    def test_inject_only_for_questions_about_files(self):
+        self.assertIsNone(RetrievalPrefetch(SlowVectorDB(latency=0), "what was the revenue").inject())
+        self.assertIn("Chunk 1", RetrievalPrefetch(SlowVectorDB(latency=0), "what does the uploaded pdf say about revenue").inject())
+
+
+class SchedulerTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 0.0
+        # 100 tokens per 60 second window, and the window only turns over when the test moves the clock.
+        self.scheduler = LLMScheduler(LocalTokenBudget(window=60, clock=lambda: self.now), limits={}, tokens_per_minute=100, requests_per_minute=100, poll_interval=0.01)
+        self.served = []
+        self.events = {}
+
+    def queue(self, name: str, user_id: str, priority: int = 0) -> threading.Thread:
+        def run():
+            self.scheduler.acquire('model', user_id, 100, priority=priority, on_wait=self.events.setdefault(name, []).append)
+            self.served.append(name)
+        waiting = len(self.scheduler._queues['model'].waiting)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        while len(self.scheduler._queues['model'].waiting) == waiting:
+            time.sleep(0.001)
+        return thread
+
+    def drain(self, threads: list[threading.Thread]):
+        for _ in threads:
+            served = len(self.served)
+            self.now += 60
+            while len(self.served) == served:
+                time.sleep(0.001)
+        for thread in threads:
+            thread.join()
+
+    def test_users_take_turns_and_background_waits_for_interactive(self):
+        self.scheduler.acquire('model', 'someone', 100)
+        threads = [
+            self.queue('job', 'batch', priority=BACKGROUND),
+            self.queue('a1', 'alice'),
+            self.queue('a2', 'alice'),
+            self.queue('a3', 'alice'),
+            self.queue('b1', 'bob'),
+        ]
+        self.drain(threads)
+        self.assertEqual(self.served, ['a1', 'b1', 'a2', 'a3', 'job'])
+
+    def test_queue_position_and_expected_wait_are_reported(self):
+        self.scheduler.acquire('model', 'someone', 100)
+        self.now = 30
+        threads = [self.queue('a1', 'alice'), self.queue('b1', 'bob')]
+        self.assertEqual(self.events['a1'][-1], {'model' : 'model', 'position' : 1, 'expected_wait' : 30.0})
+        self.assertEqual(self.events['b1'][-1], {'model' : 'model', 'position' : 2, 'expected_wait' : 90.0})
+        self.drain(threads)
+        self.assertEqual(self.events['b1'][-1]['position'], 0)
+
+    def test_timeout_leaves_the_queue(self):
+        self.scheduler.acquire('model', 'someone', 100)
+        with self.assertRaises(SchedulerTimeout):
+            self.scheduler.acquire('model', 'alice', 100, timeout=0.05)
+        self.assertEqual(self.scheduler._queues['model'].waiting, [])
+
+    def lock_is_free(self) -> bool:
+        """Whether another thread can take the scheduler's lock right now."""
+        result = []
+        def take():
+            result.append(self.scheduler._condition.acquire(timeout=1))
+            if result[0]:
+                self.scheduler._condition.release()
+        thread = threading.Thread(target=take)
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def test_budget_and_callbacks_run_without_the_lock(self):
+        checking, answer = threading.Event(), threading.Event()
+        try_acquire = self.scheduler.budget.try_acquire
+        def slow_try_acquire(*args):
+            checking.set()
+            answer.wait(5)
+            return try_acquire(*args)
+
+        with mock.patch.object(self.scheduler.budget, 'try_acquire', side_effect=slow_try_acquire):
+            thread = threading.Thread(target=self.scheduler.acquire, args=('model', 'someone', 100), daemon=True)
+            thread.start()
+            self.assertTrue(checking.wait(5))
+            self.assertTrue(self.lock_is_free())
+            answer.set()
+            thread.join()
+
+        free = []
+        with self.assertRaises(SchedulerTimeout):
+            self.scheduler.acquire('model', 'alice', 100, on_wait=lambda event: free.append(self.lock_is_free()), timeout=0.05)
+        self.assertEqual(free, [True])
+
+    def test_database_budget_is_shared_between_workers(self):
+        from sqlalchemy import create_engine
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine(f"sqlite:///{directory}/budget.db")
+            workers = [DatabaseTokenBudget(lambda: engine, window=60, clock=lambda: self.now) for _ in range(2)]
+            self.assertEqual(workers[0].try_acquire('model', 80, 100, 10), (0.0, 0))
+            self.assertEqual(workers[1].try_acquire('model', 30, 100, 10), (60.0, 0))
+            # The first call used fewer tokens than estimated.
+            workers[0].settle('model', 0, -50)
+            self.assertEqual(workers[1].try_acquire('model', 30, 100, 10), (0.0, 0))
+            self.now = 61
+            self.assertEqual(workers[1].try_acquire('model', 100, 100, 10), (0.0, 1))
+            engine.dispose()
+
+
+class OfflineFakesTests(SimpleTestCase):
+    def test_scripted_model_streams_words_then_usage(self):
+        from langchain_core.messages import HumanMessage
+        model = ScriptedChatModel(responses=["one two three"], token_latency=0.01)
+        chunks = list(model.stream([HumanMessage(content="count to three")]))
+        self.assertEqual([chunk.content for chunk in chunks], ["one ", "two ", "three", ""])
+        self.assertEqual(chunks[-1].usage_metadata['output_tokens'], 3)
+        self.assertEqual(model.invoke("again").content, "one two three")
+        self.assertEqual(model.calls, 2)
+
+    def test_scripted_model_returns_tool_calls(self):
+        from langchain_core.messages import AIMessage
+        tool_call = {'name' : 'Calculator', 'args' : {'expression' : '1 + 1'}, 'id' : 'call_1'}
+        model = ScriptedChatModel(respond=lambda messages: AIMessage(content='', tool_calls=[tool_call])).bind_tools([])
+        self.assertEqual(model.invoke("add").tool_calls[0]['args'], {'expression' : '1 + 1'})
+
+    def test_in_memory_vector_db_ranks_by_shared_words(self):
+        vector_db = InMemoryVectorDB("offline-fakes-test", embeddings=HashingEmbeddings())
+        self.addCleanup(vector_db.delete_index)
+        vector_db.add_documents([("a", Document(page_content="Revenue grew to 12 million this quarter")), ("b", Document(page_content="The team hired three engineers"))])
+        self.assertTrue(vector_db.query("quarter revenue", k=1).startswith("Chunk 1\nRevenue grew"))
+        self.assertIs(InMemoryVectorDB("offline-fakes-test").store, vector_db.store)
+
+
+class CassetteTests(SimpleTestCase):
+    def record(self, path: str):
+        from langchain_core.messages import HumanMessage, ToolMessage
+        recorder = CassetteRecorder(path, {'user_query' : "count to three"})
+        model = recorder.wrap_model(ScriptedChatModel(responses=["one two three"], first_token_latency=0.05), 'scripted')
+        self.assertEqual(model.invoke([HumanMessage(content="count to three")]).content, "one two three")
+        tool_call = {'name' : 'Calculator', 'args' : {'expression' : '1 + 2'}, 'id' : 'call_1'}
+        recorder.record_tool(tool_call, ToolMessage("3", name='Calculator', tool_call_id='call_1'), 0.05)
+        recorder.close({})
+
+    def test_replay_serves_recorded_stream_and_tool_results(self):
+        from langchain_core.messages import HumanMessage
+        path = os.path.join(tempfile.mkdtemp(), 'turn.jsonl')
+        self.record(path)
+
+        player = CassettePlayer(path, timing='none')
+        self.assertEqual(player.header['user_query'], "count to three")
+        model = player.wrap_model(None, 'scripted')
+        chunks = list(model.stream([HumanMessage(content="count to three")]))
+        self.assertEqual([chunk.content for chunk in chunks], ["one ", "two ", "three", ""])
+        self.assertEqual(chunks[-1].usage_metadata['output_tokens'], 3)
+        self.assertEqual(player.drift, 0)
+        # A call whose arguments changed gets the next unused result recorded for the same tool.
+        replayed = player.tool_result({'name' : 'Calculator', 'args' : {'expression' : '1+2'}, 'id' : 'call_9'})
+        self.assertEqual((replayed.content, replayed.tool_call_id), ("3", 'call_9'))
+        self.assertEqual(player.tool_result({'name' : 'Calculator', 'args' : {'expression' : '1 + 2'}, 'id' : 'call_10'}).status, 'error')
+        with self.assertRaises(CassetteMiss):
+            model.invoke([HumanMessage(content="count to four")])
+        self.assertEqual(player.misses, 2)
+
+    def test_replay_timing(self):
+        from langchain_core.messages import HumanMessage
+        path = os.path.join(tempfile.mkdtemp(), 'turn.jsonl')
+        self.record(path)
+        for timing, low, high in [('original', 0.05, 1.0), ('compressed', 0.0, 0.03)]:
+            model = CassettePlayer(path, timing=timing, speedup=10).wrap_model(None, 'scripted')
+            started = time.perf_counter()
+            model.invoke([HumanMessage(content="count to three")])
+            self.assertTrue(low <= time.perf_counter() - started < high, timing)
+
+
+class ListSpanExporter(SpanExporter):
+    def __init__(self):
+        self.exported = threading.Event()
+        self.spans = []
+
+    def export(self, spans: list[dict]) -> None:
+        self.spans = spans
+        self.exported.set()
+
+
+class TracingTests(SimpleTestCase):
+    def test_spans_nest_under_nodes_and_are_summarised(self):
+        from langchain_core.messages import HumanMessage
+        exporter = ListSpanExporter()
+        trace = Trace('conversation-1', 'user-1', sampled=True, exporter=exporter)
+
+        @traced('call_model')
+        def node(state):
+            with span('model', model='scripted'):
+                instrument_model(ScriptedChatModel(responses=["one two three"], first_token_latency=0.02)).invoke([HumanMessage(content="count")])
+            with span('tool', tool='Calculator'):
+                with span('db', system='django'):
+                    pass
+            return {}
+
+        node({'_trace' : trace})
+        summary = trace.finish()
+        self.assertTrue(exporter.exported.wait(5))
+        self.assertEqual(list(summary['nodes']), ['call_model'])
+        self.assertEqual(summary['model_calls'][0]['output_tokens'], 3)
+        self.assertGreaterEqual(summary['model_calls'][0]['ttft'], 0.02)
+        self.assertEqual((summary['tools'], summary['db']['count']), ({'Calculator' : summary['tools']['Calculator']}, 1))
+
+        spans = {item['name'] : item for item in exporter.spans}
+        self.assertEqual(spans['db']['parent_id'], spans['tool']['span_id'])
+        self.assertEqual(spans['node']['parent_id'], spans['turn']['span_id'])
+        self.assertEqual(spans['db']['attributes']['conversation_id'], 'conversation-1')
+
+    def test_untraced_turn_records_nothing(self):
+        model = ScriptedChatModel(responses=["hi"])
+        with span('tool', tool='Calculator') as tool_span:
+            self.assertIsNone(tool_span)
+        self.assertIs(instrument_model(model), model)
+        self.assertEqual(traced('init')(lambda state: {'ok' : True})({}), {'ok' : True})
+
+    def test_otlp_request_shape(self):
+        trace = Trace('conversation-1', 'user-1', sampled=True, exporter=ListSpanExporter())
+        with trace.span('node', node='init'):
+            with span('db', system='memory'):
+                pass
+        trace.finish()
+        request = OTLPSpanExporter(endpoint=None).request([trace.root.to_dict(), *(item.to_dict() for item in trace.spans)])
+        spans = request['resourceSpans'][0]['scopeSpans'][0]['spans']
+        self.assertEqual([item['name'] for item in spans], ['turn', 'db', 'node init'])
+        self.assertNotIn('parentSpanId', spans[0])
+        self.assertEqual(spans[1]['parentSpanId'], spans[2]['spanId'])
+        self.assertIn({'key' : 'user_id', 'value' : {'stringValue' : 'user-1'}}, spans[1]['attributes'])
+
+
+def busy_wait(seconds: float):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        sum(range(1000))
+
+
+class ProfiledStreamView(RequestProfilingMixin, APIView):
+    authentication_classes = []
+    permission_classes = []
+    throttle_classes = []
+
+    def get(self, request):
+        def stream():
+            busy_wait(0.1)
+            yield "event: done\ndata: [DONE]\n\n"
+        return StreamingHttpResponse(stream(), content_type='text/event-stream')
+
+
+class RequestProfilingTests(SimpleTestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        settings = override_settings(MEDIA_ROOT=self.media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def read(self, request_id: str, name: str) -> str:
+        with open(os.path.join(self.media_root, 'profiles', request_id, name), encoding='utf-8') as file:
+            return file.read()
+
+    def test_streamed_response_is_profiled_until_fully_sent(self):
+        with mock.patch('helper.profiling.PROFILING_SECRET', 'secret'):
+            response = ProfiledStreamView.as_view()(APIRequestFactory().get('/stream/', HTTP_X_PROFILE='secret', HTTP_X_REQUEST_ID='turn-1'))
+        self.assertEqual(response['X-Profile-Id'], 'turn-1')
+        b''.join(response.streaming_content)
+        response.close()
+
+        self.assertIn('busy_wait (tests.py:', self.read('turn-1', 'wall.folded'))
+        self.assertIn('busy_wait (tests.py:', self.read('turn-1', 'cpu.folded'))
+        self.assertGreaterEqual(json.loads(self.read('turn-1', 'summary.json'))['seconds'], 0.1)
+
+    def test_unprofiled_without_the_secret(self):
+        with mock.patch('helper.profiling.PROFILING_SECRET', 'secret'):
+            response = ProfiledStreamView.as_view()(APIRequestFactory().get('/stream/', HTTP_X_PROFILE='guess'))
+        b''.join(response.streaming_content)
+        self.assertFalse(response.has_header('X-Profile-Id'))
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'profiles')))
+
+    def test_memory_profile_and_closed_unsent_stream(self):
+        profiler = RequestProfiler('upload-1', '/upload/', 'user-1', memory=True)
+        profiler.start()
+        retained = [bytearray(200_000) for _ in range(5)]
+        # The client went away before the body was read: closing the response still writes the profile.
+        profiler.wrap(iter(["unsent"])).close()
+        self.assertGreaterEqual(json.loads(self.read('upload-1', 'summary.json'))['memory_peak_bytes'], 1_000_000)
+        self.assertIn('tests.py:', self.read('upload-1', 'memory.folded'))
+        self.assertEqual(len(retained), 5)
+
+
+class MetricsTests(SimpleTestCase):
+    def test_render_prometheus_text(self):
+        registry = MetricsRegistry()
+        registry.inc('llm_tokens_total', 12, model='gpt-4o', direction='output')
+        registry.add_gauge('sse_active_streams', 1, view='llm_response')
+        registry.observe('sse_ttft_seconds', 0.3, buckets=(0.1, 0.5), model='say "hi"\n')
+        text = render(registry.snapshot())
+
+        self.assertIn('# TYPE llm_tokens_total counter\nllm_tokens_total{direction="output",model="gpt-4o"} 12.0\n', text)
+        self.assertIn('sse_active_streams{view="llm_response"} 1.0\n', text)
+        self.assertIn('sse_ttft_seconds_bucket{model="say \\"hi\\"\\n",le="0.1"} 0\n', text)
+        self.assertIn('sse_ttft_seconds_bucket{model="say \\"hi\\"\\n",le="0.5"} 1\n', text)
+        self.assertIn('sse_ttft_seconds_bucket{model="say \\"hi\\"\\n",le="+Inf"} 1\n', text)
+        self.assertIn('sse_ttft_seconds_count{model="say \\"hi\\"\\n"} 1\n', text)
+
+    def test_collector_sums_processes_and_drops_gauges_of_exited_ones(self):
+        directory = tempfile.mkdtemp()
+        worker, exited, this = MetricsRegistry(), MetricsRegistry(), MetricsRegistry()
+        for registry in (worker, exited, this):
+            registry.inc('tool_calls_total', 2)
+            registry.add_gauge('sse_active_streams', 1)
+            registry.observe('vector_query_seconds', 0.02, backend='memory')
+        for pid, registry in ((os.getppid(), worker), (2 ** 22 + 1, exited)):
+            with mock.patch('os.getpid', return_value=pid):
+                MultiProcessCollector(registry, directory).flush()
+
+        snapshot = MultiProcessCollector(this, directory).collect()
+        self.assertEqual(snapshot['counters'][('tool_calls_total', ())], 6)
+        self.assertEqual(snapshot['gauges'][('sse_active_streams', ())], 2)
+        self.assertEqual(snapshot['histograms'][('vector_query_seconds', (('backend', 'memory'),))]['count'], 3)
+
+    def test_collector_archives_exited_workers_once(self):
+        directory = tempfile.mkdtemp()
+        for pid in (2 ** 22 + 1, 2 ** 22 + 2):
+            exited = MetricsRegistry()
+            exited.inc('tool_calls_total', 2)
+            exited.add_gauge('sse_active_streams', 1)
+            with mock.patch('os.getpid', return_value=pid):
+                MultiProcessCollector(exited, directory).flush()
+        with open(os.path.join(directory, 'notes.json'), 'w') as file:
+            file.write('{}')
+
+        collector = MultiProcessCollector(MetricsRegistry(), directory)
+        for _ in range(2):
+            snapshot = collector.collect()
+            self.assertEqual(snapshot['counters'][('tool_calls_total', ())], 4)
+            self.assertNotIn(('sse_active_streams', ()), snapshot['gauges'])
+        self.assertEqual(sorted(name for name in os.listdir(directory) if name.endswith('.json')), ['archive.json', 'notes.json'])
+
+    def test_endpoint_is_internal_only(self):
+        internal = {'REMOTE_ADDR' : '172.18.0.5', 'HTTP_HOST' : 'gateway-service'}
+        metrics.inc('llm_tokens_total', 1, model='scripted', direction='input')
+        with override_settings(INTERNAL_SECRET_KEY_KEY='service-secret'):
+            response = Client().get('/api/internal/metrics', HTTP_X_SERVICE_AUTH='service-secret', **internal)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('llm_tokens_total{direction="input",model="scripted"}', response.content.decode())
+
+            self.assertEqual(Client().get('/api/internal/metrics', HTTP_X_SERVICE_AUTH='guess', **internal).status_code, 401)
+            self.assertEqual(Client().get('/api/internal/metrics', HTTP_X_SERVICE_AUTH='service-secret', REMOTE_ADDR='203.0.113.9', HTTP_HOST='gateway-service').status_code, 403)
+        with override_settings(INTERNAL_SECRET_KEY_KEY=None):
+            self.assertEqual(Client().get('/api/internal/metrics', **internal).status_code, 401)
+
+
+class ChatStreamTests(SimpleTestCase):
+    def stream(self, fake_stream):
+        """Posts a turn with the DB and the graph patched out; the patches last until the test ends, since the body runs lazily."""
+        for patcher in (
+            mock.patch('chats_app.views.models.Conversation.objects.get_or_create', return_value=(SimpleNamespace(id='c-1'), False)),
+            mock.patch('chats_app.views.get_vector_db'),
+            mock.patch('chats_app.views.start_trace', return_value=None),
+            mock.patch.object(LLMResponseSSEView, 'create_human_message'),
+            mock.patch.object(LLMResponseSSEView, 'create_assistant_message'),
+            mock.patch('chats_app.views.graph.stream', side_effect=fake_stream),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        request = APIRequestFactory().post('/api/chat/llm-response/', {'query' : 'hi', 'conversation_id' : 'c-1'}, format='json')
+        force_authenticate(request, user=SimpleNamespace(id=1, is_authenticated=True, profile_requests=False))
+        return LLMResponseSSEView.as_view(throttle_classes=[])(request)
+
+    def test_post_stream_tasks_run_when_closed_after_done(self):
+        written = []
+
+        def fake_stream(state, stream_mode):
+            state['_post_stream_tasks'].append(lambda: written.append(state['user_query']))
+            yield AIMessageChunk(content='Hello'), {'langgraph_node' : 'call_model'}
+
+        response = self.stream(fake_stream)
+        for event in response.streaming_content:
+            if event.startswith(b'event: done'):
+                break
+        response.close()
+        self.assertEqual(written, ['hi'])
+
+
+    def test_graph_stops_when_the_client_disconnects(self):
+        closed = threading.Event()
+
+        def fake_stream(state, stream_mode):
+            try:
+                while True:
+                    yield AIMessageChunk(content='Hello'), {'langgraph_node' : 'call_model'}
+                    time.sleep(0.01)
+            finally:
+                closed.set()
+
+        response = self.stream(fake_stream)
+        for event in response.streaming_content:
+            if event.startswith(b'event: final_response'):
+                break
+        response.close()
+        self.assertTrue(closed.wait(2))
+
+class MemoryCacheTests(SimpleTestCase):
+    def setUp(self):
+        engine = create_engine(f"sqlite:///{tempfile.mkdtemp()}/memory.db")
+        memory_module._metadata.create_all(engine)
+        for patcher in (mock.patch.object(memory_module, '_engine', engine), mock.patch.dict(os.environ, {'LONG_TERM_MEMORY' : 'false'})):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        memory_module.history_cache.clear()
+
+    def test_windows_are_cached_per_limit_and_token_counter(self):
+        def count_messages(messages):
+            return len(messages)
+
+        def count_characters(messages):
+            return sum(len(message.content) for message in messages)
+
+        writer = Memory.get_memory('session-1', 'user_1', 20, count_messages, True, False, 'human')
+        writer.add_messages([HumanMessage(content=f"question {turn}") if turn % 2 == 0 else AIMessage(content=f"answer {turn}") for turn in range(6)])
+
+        self.assertEqual(len(Memory.get_memory('session-1', 'user_1', 20, count_messages, True, False, 'human').messages), 6)
+        self.assertEqual(len(Memory.get_memory('session-1', 'user_1', 2, count_messages, True, False, 'human').messages), 2)
+        self.assertEqual([message.content for message in Memory.get_memory('session-1', 'user_1', 20, count_characters, True, False, 'human').messages], ['question 4', 'answer 5'])
+        self.assertEqual(len(Memory.get_memory('session-1', 'user_1', 20, count_messages, True, False, 'human').messages), 6)
+
+    def test_version_upsert(self):
+        with memory_module._engine.connect() as connection, Session(connection) as session:
+            self.assertEqual([Memory.bump_version(session, 'user_1', 'session-2') for _ in range(3)], [1, 2, 3])
+
+
+def add_faiss_documents(index_name: str, prefix: str, count: int):
+    vector_db = FAISSVectorDB(index_name, embeddings=HashingEmbeddings())
+    for number in range(count):
+        vector_db.add_documents([(f"{prefix}-{number}", Document(page_content=f"{prefix} note {number}"))])
+
+
+class FAISSVectorDBTests(SimpleTestCase):
+    def test_writers_in_other_processes_keep_each_others_entries(self):
+        with mock.patch.dict(os.environ, {'LOCAL_VECTOR_DB_DIR' : tempfile.mkdtemp()}):
+            context = multiprocessing.get_context('fork')
+            workers = [context.Process(target=add_faiss_documents, args=('shared', prefix, 10)) for prefix in ('left', 'right')]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            store = FAISSVectorDB('shared', embeddings=HashingEmbeddings()).store
+        self.assertEqual([worker.exitcode for worker in workers], [0, 0])
+        self.assertEqual(len(store.index_to_docstore_id), 20)
+
+
+class ToolExecutorTests(SimpleTestCase):
+    def test_hung_calls_time_out_once_and_do_not_hold_workers(self):
+        released = threading.Event()
+        self.addCleanup(released.set)
+
+        @tool("Hang")
+        def hang_tool(query: str) -> str:
+            """Blocks until the test ends."""
+            released.wait(10)
+            return "late"
+
+        @tool("Echo")
+        def echo_tool(query: str) -> str:
+            """Returns the query."""
+            return query
+
+        executor = ToolExecutor([hang_tool, echo_tool], timeouts={'Hang' : 0.05, 'Echo' : 1})
+        hung = AIMessage(content='', tool_calls=[{'name' : 'Hang', 'args' : {'query' : str(number)}, 'id' : f"hang-{number}"} for number in range(16)])
+        with mock.patch('workflow_graphs.bujji.tool_executor.metrics') as recorded:
+            self.assertTrue(all('timed out' in message.content for message in executor.run(hung, {})))
+            started = time.perf_counter()
+            echoed = executor.run(AIMessage(content='', tool_calls=[{'name' : 'Echo', 'args' : {'query' : 'hi'}, 'id' : 'echo-1'}]), {})
+            self.assertLess(time.perf_counter() - started, 0.5)
+            self.assertEqual(echoed[0].content, 'hi')
+
+            released.set()
+            time.sleep(0.1)
+        latencies = [call.kwargs['status'] for call in recorded.observe.call_args_list if call.args[0] == 'tool_latency_seconds']
+        self.assertEqual(sorted(latencies), ['ok'] + ['timeout'] * 16)
+        abandoned = sum(call.args[1] for call in recorded.add_gauge.call_args_list if call.args[0] == 'tool_calls_abandoned')
+        self.assertEqual(abandoned, 0)
+
+
+class ToolLoopTests(SimpleTestCase):
+    def setUp(self):
+        self.runs = []
+
+        @tool("Calculator")
+        def calculator_tool(expression: str) -> str:
+            """Records the expression."""
+            self.runs.append(expression)
+            return expression
+
+        self.executor = ToolExecutor([calculator_tool])
+
+    def call(self, expression: str, call_id: str) -> AIMessage:
+        return AIMessage(content='', tool_calls=[{'name' : 'Calculator', 'args' : {'expression' : expression}, 'id' : call_id}])
+
+    def test_only_the_same_call_with_a_result_is_a_repeat(self):
+        history = [
+            self.call("10 / 2", 'call-1'),
+            ToolMessage("5", name='Calculator', tool_call_id='call-1'),
+            self.call("3 - 1", 'call-2'),
+            ToolMessage(TOOL_CALL_ERROR_TEMPLATE.format(error="ConnectionError()"), name='Calculator', tool_call_id='call-2', status='error'),
+        ]
+        previous_calls = answered_calls(history)
+        repeat = self.executor.run(self.call("  10 /  2 ", 'call-3'), {}, previous_calls=previous_calls)
+        self.assertIn("already called", repeat[0].content)
+        self.assertEqual(self.runs, [])
+
+        for number, expression in enumerate(["2 / 10", "10 / 2 / 2", "3 - 1"]):
+            self.assertEqual(self.executor.run(self.call(expression, f"call-{4 + number}"), {}, previous_calls=previous_calls)[0].content, expression)
+        self.assertEqual(self.runs, ["2 / 10", "10 / 2 / 2", "3 - 1"])
+
+    def test_caps_stop_the_tool_loop(self):
+        state = {'messages' : [HumanMessage(content="hi"), self.call("1 + 1", 'call-1')], '_tool_iterations' : 0, '_input_tokens' : 0}
+        self.assertEqual(route_model_output(state), 'tools')
+        self.assertEqual(route_model_output({**state, '_tool_iterations' : TOOL_MAX_ITERATIONS}), 'budget_exhausted')
+        self.assertEqual(route_model_output({**state, '_input_tokens' : TURN_MAX_INPUT_TOKENS}), 'budget_exhausted')
+        self.assertEqual(route_model_output({**state, '_tool_iterations' : TOOL_MAX_ITERATIONS, '_force_final_answer' : True}), '__end__')
+
+class RateLimitTests(SimpleTestCase):
+    def test_token_bucket_bursts_then_waits_for_refill(self):
+        bucket = TokenBucket(rate=20, capacity=2)
+        self.assertTrue(bucket.acquire())
+        self.assertTrue(bucket.acquire())
+        self.assertFalse(bucket.acquire())
+        self.assertTrue(bucket.acquire(timeout=1))
+        with self.assertRaises(ValueError):
+            TokenBucket(rate=0, capacity=1)
+
+    def test_open_breaker_lets_one_probe_through(self):
+        breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0.05)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.release()
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertTrue(breaker.allow() and breaker.allow())
+
+    def test_single_flight_shares_one_call(self):
+        flight, released, calls = SingleFlight(), threading.Event(), []
+        def work():
+            calls.append(1)
+            released.wait(5)
+            return "result"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do('key', work))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        while not calls:
+            time.sleep(0.001)
+        time.sleep(0.05)
+        released.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((len(calls), results), (1, ["result"] * 4))
+
+        with self.assertRaises(KeyError):
+            flight.do('key', lambda: {}['missing'])
+
+    def search_with(self, run, breaker: CircuitBreaker) -> mock.MagicMock:
+        search = mock.MagicMock()
+        search.run.side_effect = run
+        for patcher in (
+            mock.patch.object(tools_module, 'search', search),
+            mock.patch.object(tools_module, 'search_breaker', breaker),
+            mock.patch.object(tools_module, 'search_bucket', TokenBucket(rate=100, capacity=10)),
+            mock.patch.object(tools_module, 'backoff_delay', return_value=0),
+            mock.patch.object(tools_module, '_wikipedia_search', return_value="wiki text"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return search
+
+    def test_rate_limited_search_falls_back_to_wikipedia(self):
+        search = self.search_with(RatelimitException("202 Ratelimit"), CircuitBreaker('test', failure_threshold=5))
+        self.assertEqual(tools_module._duckduckgo_search("mornings"), f"{tools_module.SEARCH_FALLBACK_PREFIX}\n\nwiki text")
+        self.assertEqual(search.run.call_count, tools_module.SEARCH_RETRIES + 1)
+
+    def test_failed_probe_does_not_keep_the_breaker_shut(self):
+        breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        self.search_with([TimeoutError("read timed out"), "search results"], breaker)
+        with self.assertRaises(TimeoutError):
+            tools_module._duckduckgo_search("mornings")
+        self.assertEqual(tools_module._duckduckgo_search("mornings"), "search results")
+
+class CalculatorTests(SimpleTestCase):
+    def test_sequence_arithmetic_is_rejected(self):
+        for expression in ('[1] * 10 ** 9', '10 ** 9 * [1]', '[1] + [2]', '-[1]'):
+            with self.assertRaises(CalculatorError):
+                calculator.evaluate(expression)
+        self.assertEqual(calculator_tool.invoke({'expression' : 'values * 10 ** 9', 'values' : [1.0, 2.0]})[:6], 'Error:')
+        self.assertEqual(calculator.evaluate('max([1, 2 * 3])'), 6)
+
+    def test_complex_results_are_rejected(self):
+        with self.assertRaises(CalculatorError):
+            calculator.evaluate('(-8) ** 0.5')
+        self.assertEqual(calculator_tool.invoke({'expression' : 'x ** 0.5', 'values' : [4.0, -8.0]}), "Error: Result is not a real number.")
+        self.assertEqual(calculator_tool.invoke({'expression' : 'x ** 0.5', 'values' : [4.0, 9.0]}), '[2.0, 3.0]')
+
+
+class SelfDiscussionTests(SimpleTestCase):
+    def decide(self, query: str, has_files: bool) -> dict:
+        return decide('auto', query, has_files, select_tools(ALL_TOOLS, query, [], has_files), [])
+
+    def test_attachment_alone_does_not_plan(self):
+        decision = self.decide("What is the title of this file?", has_files=True)
+        self.assertFalse(decision['plan'])
+        self.assertEqual(decision['reasons'], ['attachments'])
+
+    def test_complex_question_about_a_file_plans(self):
+        self.assertTrue(self.decide("Compare the two proposals in the uploaded document", has_files=True)['plan'])
+
+
+class ModelRouterTests(SimpleTestCase):
+    def test_names_outside_the_pool_are_not_tracked(self):
+        router = ModelRouter([ModelProfile('small', quality=1, context_window=8_000, cost=0.1)])
+        with mock.patch('workflow_graphs.bujji.router.metrics') as recorded:
+            for number in range(3):
+                router.record(f"client-supplied-{number}", 0.5, ok=True)
+            router.record('small', 0.5, ok=True)
+        self.assertEqual(list(router.health), ['small'])
+        self.assertEqual([call.kwargs['model'] for call in recorded.observe.call_args_list], ['other'] * 3 + ['small'])
+
+
+def failing(messages):
+    raise RuntimeError("provider unavailable")
+
+
+class HedgedChatModelTests(SimpleTestCase):
+    def hedged(self, primary: ScriptedChatModel, backup: ScriptedChatModel, delay: float) -> HedgedChatModel:
+        return HedgedChatModel(primary=primary, backup=backup, primary_name='primary-model', backup_name='backup-model', delay=delay)
+
+    def timed_invoke(self, model: HedgedChatModel) -> tuple[str, float]:
+        started = time.perf_counter()
+        reply = model.invoke("hi")
+        return reply.content, time.perf_counter() - started
+
+    def test_fast_primary_wins_without_a_hedge(self):
+        primary = ScriptedChatModel(responses=["from primary"])
+        backup = ScriptedChatModel(responses=["from backup"])
+        with mock.patch('workflow_graphs.bujji.hedging.metrics') as recorded:
+            content, _ = self.timed_invoke(self.hedged(primary, backup, delay=1.0))
+        self.assertEqual(content, "from primary")
+        self.assertEqual(backup.calls, 0)
+        recorded.inc.assert_not_called()
+
+    def test_backup_wins_when_the_primary_stalls(self):
+        primary = ScriptedChatModel(responses=["from primary"], first_token_latency=1.0)
+        backup = ScriptedChatModel(responses=["from backup"])
+        with mock.patch('workflow_graphs.bujji.hedging.metrics') as recorded:
+            content, seconds = self.timed_invoke(self.hedged(primary, backup, delay=0.1))
+        self.assertEqual(content, "from backup")
+        self.assertLess(seconds, 0.8)
+        recorded.inc.assert_any_call('llm_hedges_total', model='primary-model', target='backup-model')
+        recorded.inc.assert_any_call('llm_hedge_wins_total', model='backup-model', role='backup')
+
+    def test_primary_failure_starts_the_backup_before_the_deadline(self):
+        primary = ScriptedChatModel(respond=failing)
+        backup = ScriptedChatModel(responses=["from backup"])
+        content, seconds = self.timed_invoke(self.hedged(primary, backup, delay=5.0))
+        self.assertEqual(content, "from backup")
+        self.assertLess(seconds, 1.0)
+
+    def test_error_is_raised_when_both_fail(self):
+        primary = ScriptedChatModel(respond=failing)
+        backup = ScriptedChatModel(respond=failing)
+        started = time.perf_counter()
+        with self.assertRaisesMessage(RuntimeError, "provider unavailable"):
+            self.hedged(primary, backup, delay=5.0).invoke("hi")
+        self.assertLess(time.perf_counter() - started, 1.0)
+        self.assertEqual((primary.calls, backup.calls), (1, 1))
+
+
+class BrokenStreamModel(ScriptedChatModel):
+    """Streams one word and then loses the connection."""
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        yield ChatGenerationChunk(message=AIMessageChunk(content="Partial"))
+        raise ConnectionError("stream reset")
+
+
+class CallModelFallbackTests(SimpleTestCase):
+    def call(self, model, fallback: ScriptedChatModel) -> dict:
+        state = {
+            'model' : model,
+            'model_name' : 'first',
+            'user_id' : 'user-1',
+            '_model_candidates' : ['first', 'second'],
+            'messages' : [HumanMessage(content="hi")],
+            'memory_messages' : [],
+            'tools' : [],
+            '_conversation_metadata' : {},
+            '_verbose' : False,
+        }
+        with mock.patch('workflow_graphs.bujji.nodes.model_registry.get_model', return_value=fallback):
+            return call_model(state)
+
+    def test_failure_before_the_first_chunk_falls_back(self):
+        fallback = ScriptedChatModel(responses=["from fallback"])
+        result = self.call(ScriptedChatModel(respond=failing), fallback)
+        self.assertEqual(result['messages'][0].content, "from fallback")
+        self.assertIsInstance(result['messages'][0], AIMessage)
+
+    def test_failure_after_a_chunk_is_raised(self):
+        fallback = ScriptedChatModel(responses=["from fallback"])
+        with self.assertRaises(ConnectionError):
+            self.call(BrokenStreamModel(), fallback)
+        self.assertEqual(fallback.calls, 0)
+
+    def test_failed_call_refunds_its_budget(self):
+        budget = LocalTokenBudget(window=60, clock=lambda: 0.0)
+        scheduler = LLMScheduler(budget, limits={}, tokens_per_minute=100_000, requests_per_minute=100)
+        with mock.patch('workflow_graphs.bujji.nodes.LLM_SCHEDULER', True), mock.patch('workflow_graphs.bujji.nodes.llm_scheduler', scheduler):
+            self.call(ScriptedChatModel(respond=failing), ScriptedChatModel(responses=["from fallback"]))
+        self.assertEqual(budget._windows[('first', 0)][0], 0)
+        self.assertGreater(budget._windows[('second', 0)][0], 0)
+
+    def test_token_budgets_must_implement_the_interface(self):
+        with self.assertRaises(TypeError):
+            BaseTokenBudget()
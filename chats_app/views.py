@@ -1,7 +1,13 @@
 import os
 import json
+import time
+import logging
+import queue
 import tempfile
-from django.http import StreamingHttpResponse
+import threading
+import contextvars
+from django.db import connection
+from django.http import StreamingHttpResponse, HttpResponse
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from .serializers import ConversationSerializer, MessageSerializer, FileSerializer
@@ -12,9 +18,15 @@ from . import models
 from langchain_core.messages import BaseMessage, AIMessage
 from langchain_core.documents import Document
 from workflow_graphs.bujji.loaders import DynamicLoader
-from workflow_graphs.bujji.vector_dbs import PineconeVectorDB
+from workflow_graphs.bujji.vector_dbs import get_vector_db
+from workflow_graphs.bujji.tracing import start_trace
+from workflow_graphs.bujji.metrics import metrics, metrics_text
+from helper.profiling import RequestProfilingMixin
+
+class FileUploadAndProcessView(RequestProfilingMixin, APIView):
+    # Ingestion is where uploads' memory goes, so its profiles include tracemalloc allocations.
+    profile_memory = True
 
-class FileUploadAndProcessView(APIView):    
     def post(self, request, *args, **kwargs):
         uploaded_file = request.FILES.get('file')
         
@@ -27,14 +39,15 @@ class FileUploadAndProcessView(APIView):
 
             # Step 1: File Upload
             try:
-                file_instance = models.File.objects.create(
-                    file=uploaded_file,
-                    name=uploaded_file.name,
-                    metadata={
-                        'content_type': uploaded_file.content_type,
-                        'size': uploaded_file.size
-                    }
-                )
+                with metrics.timer('ingestion_stage_seconds', stage='upload'):
+                    file_instance = models.File.objects.create(
+                        file=uploaded_file,
+                        name=uploaded_file.name,
+                        metadata={
+                            'content_type': uploaded_file.content_type,
+                            'size': uploaded_file.size
+                        }
+                    )
                 yield f"event: file_progress\ndata: {json.dumps({'step': 1, 'total': total_steps, 'status': 'File uploaded'})}\n\n"
             except Exception as e:
                 yield f"event: file_progress\ndata: {json.dumps({'step': 1, 'error': str(e)})}\n\n"
@@ -44,7 +57,7 @@ class FileUploadAndProcessView(APIView):
             try:
                 original_filename = uploaded_file.name  # e.g., "report.pdf"
                 _, ext = os.path.splitext(original_filename)  # ".pdf"
-                with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as tmp:
+                with metrics.timer('ingestion_stage_seconds', stage='temp_file'), tempfile.NamedTemporaryFile(suffix=ext, delete=False) as tmp:
                     for chunk in file_instance.file.chunks():
                         tmp.write(chunk)
                     tmp.flush()
@@ -56,8 +69,9 @@ class FileUploadAndProcessView(APIView):
 
             # Step 3: Content Extraction
             try:
-                dynamic_loader = DynamicLoader(input_source=local_path, metadata={"user_id" : str(request.user.id), "source_id" : str(file_instance.id), "source" : file_instance.name})
-                docs = dynamic_loader.load()
+                with metrics.timer('ingestion_stage_seconds', stage='extract'):
+                    dynamic_loader = DynamicLoader(input_source=local_path, metadata={"user_id" : str(request.user.id), "source_id" : str(file_instance.id), "source" : file_instance.name})
+                    docs = dynamic_loader.load()
                 yield f"event: file_progress\ndata: {json.dumps({'step': 3, 'total': total_steps, 'status': 'Content extracted'})}\n\n"
             except Exception as e:
                 yield f"event: file_progress\ndata: {json.dumps({'step': 3, 'error': str(e)})}\n\n"
@@ -65,7 +79,8 @@ class FileUploadAndProcessView(APIView):
 
             # Step 4: Chunking
             try:
-                docs = dynamic_loader.splitter.split_documents(docs)
+                with metrics.timer('ingestion_stage_seconds', stage='chunk'):
+                    docs = dynamic_loader.splitter.split_documents(docs)
                 yield f"event: file_progress\ndata: {json.dumps({'step': 4, 'total': total_steps, 'status': 'Content chunked'})}\n\n"
             except Exception as e:
                 yield f"event: file_progress\ndata: {json.dumps({'step': 4, 'error': str(e)})}\n\n"
@@ -73,7 +88,8 @@ class FileUploadAndProcessView(APIView):
 
             # Step 5: Save Chunks
             try:
-                file_instance.add_documents(documents=docs, id_suffix = request.user.email.split("@")[0])
+                with metrics.timer('ingestion_stage_seconds', stage='save'):
+                    file_instance.add_documents(documents=docs, id_suffix = request.user.email.split("@")[0])
                 serializer = FileSerializer(file_instance, context={'request': request})
                 yield f"event: file_progress\ndata: {json.dumps({'step': 5, 'total': total_steps, 'status': 'Chunks saved', 'file': serializer.data})}\n\n"
             except Exception as e:
@@ -85,7 +101,7 @@ class FileUploadAndProcessView(APIView):
 
 
 @method_decorator(csrf_exempt, name='dispatch')
-class LLMResponseSSEView(APIView):
+class LLMResponseSSEView(RequestProfilingMixin, APIView):
     
     def create_human_message(self, conversation_id : str, content_type : str = 'text', content : str | list = '') -> models.Message:
         return models.Message.objects.create_human_message(conversation_id, content_type, content)
@@ -95,6 +111,7 @@ class LLMResponseSSEView(APIView):
         
         
     def post(self, request, *args, **kwargs):
+        started = time.perf_counter()
         user_id = request.user.id
         body = request.data
 
@@ -113,7 +130,7 @@ class LLMResponseSSEView(APIView):
         # Get or Create the conversation
         conversation, with_new_conversation = models.Conversation.objects.get_or_create(id=conversation_id, defaults={'user_id': user_id, **conversation_metadata})
         conversation_id = conversation.id
-        vector_db = PineconeVectorDB(index_name="sample-index")
+        vector_db = get_vector_db(index_name="sample-index")
             
         # Get the all doc chunks for the conversation
         for attachment in attachments:
@@ -149,13 +166,20 @@ class LLMResponseSSEView(APIView):
             'response_mode': response_mode,
             'self_discussion': self_discussion_flag,
             '_verbose': True,
+            '_conversation_metadata': {},
+            '_post_stream_tasks': [],
+            '_stream_writer': None,
+            '_trace': start_trace(str(conversation_id), str(user_id)),
         }
 
         def event_stream():
             self_discussion = False
             tool_calling = False
             tool_index = 0
-            
+            budget_events_sent = 0
+            first_token = True
+            # Set when this generator finishes or is closed, so the graph thread stops calling models for a client that left.
+            stopped = threading.Event()
             
             try:
                 if with_new_conversation:
@@ -164,7 +188,42 @@ class LLMResponseSSEView(APIView):
                     v = ConversationSerializer(conversation).data
                     yield f"event: new_conversation\ndata: {json.dumps({'p' : p, 'o' : o, 'v' : v})}\n\n"
             
-                for message, message_data in graph.stream(s, stream_mode='messages'):
+                # The graph runs in a worker thread so events sent while a node is still running, such as the
+                # scheduler's queue position, reach the client before the node finishes.
+                updates : queue.Queue = queue.Queue()
+                s['_stream_writer'] = lambda event: updates.put(('event', event))
+
+                def run_graph():
+                    chunks = None
+                    try:
+                        chunks = graph.stream(s, stream_mode='messages')
+                        for chunk in chunks:
+                            if stopped.is_set():
+                                break
+                            updates.put(('messages', chunk))
+                        updates.put(('end', None))
+                    except Exception as e:
+                        updates.put(('error', e))
+                    finally:
+                        # Closing the stream cancels the nodes that have not started yet.
+                        if chunks is not None:
+                            chunks.close()
+                        connection.close()
+
+                # A copy of this context lets the request's DB query counter see the graph's queries.
+                threading.Thread(target=contextvars.copy_context().run, args=(run_graph,), daemon=True).start()
+                while True:
+                    kind, chunk = updates.get()
+                    if kind == 'end':
+                        break
+                    if kind == 'error':
+                        raise chunk
+                    if kind == 'event':
+                        if 'queue' in chunk:
+                            yield f"event: queue\ndata: {json.dumps({'p' : 'conversation/message/0/queue', 'o' : 'replace', 'v' : chunk['queue']})}\n\n"
+                        continue
+
+                    message, message_data = chunk
                     message : BaseMessage | AIMessage = message
                     message.pretty_print()
                     node = message_data.get('langgraph_node')
@@ -174,6 +233,12 @@ class LLMResponseSSEView(APIView):
                         response_metadata.update(message.usage_metadata)
                     tool_calls = message.tool_calls if hasattr(message, 'tool_calls') else []
                     tool_call_names = [tool_call['name'] for tool_call in tool_calls]
+
+                    # Turn budget events (tool iteration cap, input token cap, repeated tool calls) recorded by the graph so far
+                    budget_events = s['_conversation_metadata'].get('budget_events', [])
+                    for budget_event in budget_events[budget_events_sent:]:
+                        yield f"event: budget\ndata: {json.dumps({'p' : 'conversation/message/0/budget', 'o' : 'add', 'v' : budget_event})}\n\n"
+                    budget_events_sent = len(budget_events)
                     
                     if node == 'init_node':
                         p = 'conversation/message/0'
@@ -205,6 +270,9 @@ class LLMResponseSSEView(APIView):
                             yield f"event: tool_call_end\ndata: {json.dumps({})}\n\n"
                             
                         if content:
+                            if first_token:
+                                first_token = False
+                                metrics.observe('sse_ttft_seconds', time.perf_counter() - started, model=model_name)
                             p = 'conversation/message/0'
                             o = "append"
                             v = content
@@ -235,6 +303,14 @@ class LLMResponseSSEView(APIView):
                             yield f"event: tool_call_response\ndata: {json.dumps({'p' : p, 'o' : o, 'v' : v})}\n\n"
                             tool_index += 1
                         
+                if s['_trace'] is not None:
+                    s['_conversation_metadata']['trace'] = s['_trace'].finish()
+
+                # Per-turn diagnostics the graph collected in the shared conversation metadata
+                for key in ('timings', 'tool_compression', 'budget_events', 'self_discussion', 'routing', 'trace'):
+                    value = s['_conversation_metadata'].get(key)
+                    if value:
+                        response_metadata[key] = value
                 messages[1].update_status('complete', metadata=response_metadata)
                 messages[1].save()
                 yield f"event: done\ndata: [DONE]\n\n"
@@ -244,4 +320,19 @@ class LLMResponseSSEView(APIView):
                 raise e
                 messages[1].update_status('error', metadata=response_metadata)
                 yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
-        return StreamingHttpResponse(event_stream(), content_type='text/event-stream')
\ No newline at end of file
+
+            finally:
+                stopped.set()
+                # Deferred work (memory writes) runs once the client already has the final event. It also runs when
+                # the stream is closed at that yield, because the client went away or the server stopped reading.
+                for task in s['_post_stream_tasks']:
+                    try:
+                        task()
+                    except Exception as e:
+                        logging.warning(f"Post-stream task failed for conversation {conversation_id}: {e}")
+        return StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+
+
+def internal_metrics(request):
+    """Prometheus scrape target; InternalAPIMiddleware only lets internal services through."""
+    return HttpResponse(metrics_text(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -36,8 +36,13 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'auth_app.middleware.InternalAPIMiddleware',
+    'chats_app.middleware.RequestMetricsMiddleware',
 ]
 
+# Shared secret other services send in X-Service-Auth for /api/internal/ endpoints
+INTERNAL_SECRET_KEY_KEY = os.environ.get('INTERNAL_SECRET_KEY')
+
 # CORS_ALLOWED_ORIGINS = os.environ.get('CORS_ALLOWED_ORIGINS').split(', ')
 
 CORS_ALLOW_ALL_ORIGINS = True
@@ -105,6 +110,12 @@ DATABASES = {
     }
 }
 
+# Optional shared tier for tool results (workflow_graphs/bujji/tool_cache.py), e.g.
+# CACHES = {
+#     'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+#     'tool_results': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://127.0.0.1:6379/1'},
+# }
+
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
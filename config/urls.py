@@ -1,10 +1,12 @@
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from chats_app.views import internal_metrics
 
 urlpatterns = [
     path('api/auth/', include('auth_app.urls')),
     path('api/chat/', include('chats_app.urls')),
+    path('api/internal/metrics', internal_metrics, name='internal_metrics'),
 ]
 
 
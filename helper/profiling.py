@@ -0,0 +1,232 @@
+import os
+import re
+import sys
+import hmac
+import json
+import time
+import uuid
+import logging
+import threading
+import tracemalloc
+from collections import Counter
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+PROFILING_SECRET = os.getenv('PROFILING_SECRET') # value of the X-Profile header that turns profiling on
+PROFILING_INTERVAL = float(os.getenv('PROFILING_INTERVAL', 0.005)) # seconds between stack samples
+PROFILING_DIR = os.getenv('PROFILING_DIR', 'profiles')
+PROFILING_MEMORY_FRAMES = int(os.getenv('PROFILING_MEMORY_FRAMES', 25))
+MAX_STACK_DEPTH = 128
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+# Sampling and tracemalloc are process-wide, so only one request is profiled at a time.
+_profiling_lock = threading.Lock()
+
+
+def profiling_requested(request) -> bool:
+    """The X-Profile header carries PROFILING_SECRET, or the authenticated user has profile_requests set."""
+    header = request.headers.get('X-Profile')
+    if header is not None and PROFILING_SECRET and hmac.compare_digest(header, PROFILING_SECRET):
+        return True
+    return getattr(request.user, 'profile_requests', False)
+
+
+def folded_frame(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ',')
+
+
+def folded_stack(frame, root: str) -> str:
+    """Root-first stack in the collapsed format read by flamegraph.pl, speedscope and inferno."""
+    frames = []
+    while frame is not None and len(frames) < MAX_STACK_DEPTH:
+        frames.append(folded_frame(frame))
+        frame = frame.f_back
+    return ';'.join([root, *reversed(frames)])
+
+
+def thread_cpu_clock(thread_id: int):
+    try:
+        return time.pthread_getcpuclockid(thread_id)
+    except (AttributeError, OSError):
+        return None
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every other thread in the process every `interval` seconds from a background thread.
+    Wall samples count every stack seen; CPU time is the thread's CPU clock advance since its previous sample, in
+    microseconds, charged to the stack it is in now. Stacks start with the thread name, so the graph worker, tool
+    threads and any concurrent request can be told apart.
+    """
+    def __init__(self, interval: float = PROFILING_INTERVAL):
+        self.interval = interval
+        self.wall : Counter = Counter()
+        self.cpu : Counter = Counter()
+        self.samples = 0
+        self._cpu_clocks : dict[int, tuple] = {}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+
+    def _sample(self, names: dict[int, str]):
+        own = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            stack = folded_stack(frame, names.get(thread_id, str(thread_id)))
+            self.wall[stack] += 1
+            clock, previous = self._cpu_clocks.get(thread_id, (None, None))
+            if clock is None and thread_id not in self._cpu_clocks:
+                clock = thread_cpu_clock(thread_id)
+            if clock is None:
+                self._cpu_clocks[thread_id] = (None, None)
+                continue
+            try:
+                now = time.clock_gettime(clock)
+            except OSError: # the thread has exited
+                continue
+            if previous is not None and now > previous:
+                self.cpu[stack] += int((now - previous) * 1e6)
+            self._cpu_clocks[thread_id] = (clock, now)
+        self.samples += 1
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._sample({thread.ident : thread.name for thread in threading.enumerate()})
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+
+class RequestProfiler:
+    """Profiles one request and writes its output to the default storage under PROFILING_DIR/<request id>/."""
+    def __init__(self, request_id: str, path: str, user_id: str, memory: bool = False, interval: float = PROFILING_INTERVAL):
+        self.request_id = request_id
+        self.path = path
+        self.user_id = user_id
+        self.memory = memory
+        self.sampler = SamplingProfiler(interval)
+        self.started = 0.0
+        self.cpu_started = 0.0
+        self._started_tracemalloc = False
+        self._stopped = False
+
+    @classmethod
+    def for_request(cls, request, memory: bool = False) -> 'RequestProfiler | None':
+        if not profiling_requested(request):
+            return None
+        request_id = request.headers.get('X-Request-ID', '')
+        if not REQUEST_ID_PATTERN.match(request_id):
+            request_id = uuid.uuid4().hex
+        return cls(request_id, request.path, str(getattr(request.user, 'id', '')), memory=memory)
+
+    def start(self) -> bool:
+        if not _profiling_lock.acquire(blocking=False):
+            logging.warning(f"Profiling skipped for {self.path}: another request is being profiled")
+            return False
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start(PROFILING_MEMORY_FRAMES)
+            self._started_tracemalloc = True
+        self.started = time.perf_counter()
+        self.cpu_started = time.process_time()
+        self.sampler.start()
+        return True
+
+    def stop(self) -> dict | None:
+        if self._stopped or not self.started:
+            return None
+        self._stopped = True
+        try:
+            self.sampler.stop()
+            summary = {
+                'request_id' : self.request_id,
+                'path' : self.path,
+                'user_id' : self.user_id,
+                'seconds' : round(time.perf_counter() - self.started, 4),
+                'process_cpu_seconds' : round(time.process_time() - self.cpu_started, 4),
+                'samples' : self.sampler.samples,
+                'interval' : self.sampler.interval,
+                'files' : {'wall.folded' : 'samples', 'cpu.folded' : 'CPU microseconds'},
+            }
+            files = {'wall.folded' : self.sampler.wall, 'cpu.folded' : self.sampler.cpu}
+            if self.memory and tracemalloc.is_tracing():
+                files['memory.folded'] = self.memory_stacks(tracemalloc.take_snapshot())
+                summary['memory_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                summary['files']['memory.folded'] = 'bytes still allocated when the request finished'
+            for name, counts in files.items():
+                self.save(name, ''.join(f"{stack} {count}\n" for stack, count in counts.most_common()))
+            self.save('summary.json', json.dumps(summary, indent=2))
+            return summary
+        except Exception as e:
+            logging.warning(f"Writing the profile of request {self.request_id} failed: {e}")
+            return None
+        finally:
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+            _profiling_lock.release()
+
+    @staticmethod
+    def memory_stacks(snapshot: 'tracemalloc.Snapshot') -> Counter:
+        stacks = Counter()
+        for statistic in snapshot.statistics('traceback'):
+            frames = [f"{os.path.basename(frame.filename)}:{frame.lineno}".replace(';', ',') for frame in statistic.traceback]
+            stacks[';'.join(['allocations', *frames])] += statistic.size
+        return stacks
+
+    def save(self, name: str, content: str):
+        default_storage.save(f"{PROFILING_DIR}/{self.request_id}/{name}", ContentFile(content.encode()))
+
+    def wrap(self, streaming_content) -> 'ProfiledStream':
+        return ProfiledStream(streaming_content, self)
+
+
+class ProfiledStream:
+    """
+    Streamed body that stops its profiler once fully sent, or when Django closes the response because the client
+    went away. A generator would not do: closing one that never started skips its finally block.
+    """
+    def __init__(self, streaming_content, profiler: RequestProfiler):
+        self._iterator = iter(streaming_content)
+        self.profiler = profiler
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            self.profiler.stop()
+            raise
+
+    def close(self):
+        self.profiler.stop()
+
+
+class RequestProfilingMixin:
+    """
+    Opt-in profiling for APIViews. A profiled response carries its profile id in the X-Profile-Id header.
+    Unprofiled requests pay one header lookup and one attribute read.
+    """
+    profile_memory = False
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        profiler = RequestProfiler.for_request(request, memory=self.profile_memory)
+        self._profiler = profiler if profiler is not None and profiler.start() else None
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        profiler : RequestProfiler | None = getattr(self, '_profiler', None)
+        if profiler is not None:
+            self._profiler = None
+            response['X-Profile-Id'] = profiler.request_id
+            if response.streaming:
+                response.streaming_content = profiler.wrap(response.streaming_content)
+            else:
+                profiler.stop()
+        return response
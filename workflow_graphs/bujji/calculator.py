@@ -0,0 +1,139 @@
+import ast
+import math
+import time
+import operator
+import statistics
+from functools import lru_cache
+
+
+class CalculatorError(ValueError):
+    pass
+
+
+BINARY_OPERATORS = {
+    ast.Add : operator.add,
+    ast.Sub : operator.sub,
+    ast.Mult : operator.mul,
+    ast.Div : operator.truediv,
+    ast.FloorDiv : operator.floordiv,
+    ast.Mod : operator.mod,
+    ast.Pow : operator.pow,
+}
+UNARY_OPERATORS = {
+    ast.UAdd : operator.pos,
+    ast.USub : operator.neg,
+}
+FUNCTIONS = {
+    'abs' : abs, 'round' : round, 'min' : min, 'max' : max, 'sqrt' : math.sqrt, 'exp' : math.exp,
+    'log' : math.log, 'log10' : math.log10, 'log2' : math.log2, 'sin' : math.sin, 'cos' : math.cos,
+    'tan' : math.tan, 'floor' : math.floor, 'ceil' : math.ceil,
+    # Aggregates over the `values` list
+    'sum' : math.fsum, 'mean' : statistics.fmean, 'median' : statistics.median, 'stdev' : statistics.stdev, 'len' : len,
+}
+CONSTANTS = {'pi' : math.pi, 'e' : math.e}
+
+
+@lru_cache(maxsize=1024)
+def parse(expression: str) -> ast.Expression:
+    if len(expression) > 1000:
+        raise CalculatorError("Expression is too long.")
+    try:
+        return ast.parse(expression, mode='eval')
+    except SyntaxError:
+        raise CalculatorError("Invalid expression.")
+
+
+class SafeEvaluator:
+    """
+    Walks the AST of an arithmetic expression instead of calling eval.
+    Integer results are capped at `max_int_bits`, exponents at `max_exponent`, and every evaluation is bounded by
+    `max_steps` node visits and `time_limit` seconds of CPU time, so inputs like 9**9**9 fail fast. Operators only
+    take numbers, so lists cannot be repeated or concatenated into huge sequences, and complex results are rejected.
+    """
+    def __init__(self, max_steps: int = 10_000, max_int_bits: int = 4096, max_exponent: int = 10_000, time_limit: float = 0.5):
+        self.max_steps = max_steps
+        self.max_int_bits = max_int_bits
+        self.max_exponent = max_exponent
+        self.time_limit = time_limit
+
+    def evaluate(self, expression: str, names: dict | None = None):
+        self._steps = 0
+        self._deadline = time.process_time() + self.time_limit
+        self._names = {**CONSTANTS, **(names or {})}
+        return self._visit(parse(expression).body)
+
+    def evaluate_many(self, expression: str, values: list[float]) -> list:
+        """Evaluate once per element with `x` bound to it, or once if the expression only aggregates `values`."""
+        tree = parse(expression)
+        if not any(isinstance(node, ast.Name) and node.id == 'x' for node in ast.walk(tree)):
+            return self.evaluate(expression, {'values' : values})
+        return [self.evaluate(expression, {'x' : value, 'values' : values}) for value in values]
+
+    def _check_result(self, value):
+        if isinstance(value, int) and value.bit_length() > self.max_int_bits:
+            raise CalculatorError("Result is too large.")
+        if isinstance(value, complex):
+            raise CalculatorError("Result is not a real number.")
+        return value
+
+    @staticmethod
+    def _check_numbers(*operands):
+        if any(isinstance(operand, list) for operand in operands):
+            raise CalculatorError("Operators need numbers; pass lists to functions such as sum(values) or max(values).")
+
+    def _visit(self, node):
+        self._steps += 1
+        if self._steps > self.max_steps:
+            raise CalculatorError("Expression is too complex.")
+        if time.process_time() > self._deadline:
+            raise CalculatorError("Expression took too long to evaluate.")
+
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+            return self._check_result(node.value)
+
+        if isinstance(node, ast.Name):
+            if node.id not in self._names:
+                raise CalculatorError(f"Unknown name '{node.id}'.")
+            return self._names[node.id]
+
+        if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+            operand = self._visit(node.operand)
+            self._check_numbers(operand)
+            return UNARY_OPERATORS[type(node.op)](operand)
+
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+            left, right = self._visit(node.left), self._visit(node.right)
+            self._check_numbers(left, right)
+            if isinstance(node.op, ast.Pow):
+                self._check_power(left, right)
+            elif isinstance(node.op, ast.Mult) and isinstance(left, int) and isinstance(right, int):
+                if left.bit_length() + right.bit_length() > self.max_int_bits:
+                    raise CalculatorError("Result is too large.")
+            try:
+                return self._check_result(BINARY_OPERATORS[type(node.op)](left, right))
+            except (ZeroDivisionError, OverflowError, TypeError) as e:
+                raise CalculatorError(str(e))
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS and not node.keywords:
+            args = [self._visit(arg) for arg in node.args]
+            try:
+                return self._check_result(FUNCTIONS[node.func.id](*args))
+            except (ValueError, TypeError, OverflowError, statistics.StatisticsError) as e:
+                raise CalculatorError(f"{node.func.id}: {e}")
+
+        if isinstance(node, (ast.List, ast.Tuple)):
+            return [self._visit(element) for element in node.elts]
+
+        raise CalculatorError("Unsupported expression. Use numbers, + - * / // % **, parentheses and math functions.")
+
+    def _check_power(self, base, exponent):
+        if not isinstance(base, (int, float)) or not isinstance(exponent, (int, float)):
+            raise CalculatorError("Exponentiation needs numeric operands.")
+        if abs(exponent) > self.max_exponent:
+            raise CalculatorError("Exponent is too large.")
+        if isinstance(base, int) and isinstance(exponent, int) and exponent > 0:
+            if max(base.bit_length(), 1) * exponent > self.max_int_bits:
+                raise CalculatorError("Result is too large.")
+
+
+calculator = SafeEvaluator()
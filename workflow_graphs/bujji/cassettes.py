@@ -0,0 +1,375 @@
+"""
+Record and replay of model and tool traffic as JSONL cassettes, one file per turn.
+
+With CASSETTE_MODE=record, build_context opens a cassette for the turn. Every model call's streamed chunks, with
+their offsets from the start of the call, and every tool call's arguments, result and duration are appended as they
+happen. The first line holds what is needed to rebuild the turn: query, model, response mode, pre-tools, file names
+and the history window. The last line holds the recorded totals.
+
+The replay command re-runs recorded turns through the graph against local stand-ins. Model calls are served from
+the cassette in order and tool calls by their arguments, with the original timing, timing divided by --speedup, or
+none. It reports wall time, prompt tokens, model and tool calls and database queries per turn, and compares them with
+a previous report. Replay runs on throwaway SQLite databases, so the conversations, files and history it rebuilds
+never reach the configured ones:
+
+    python -m workflow_graphs.bujji.cassettes replay cassettes/ --timing compressed --out after.json --baseline before.json
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import hashlib
+import argparse
+import threading
+from typing import Any, Iterator
+from langchain_core.language_models.chat_models import BaseChatModel, generate_from_stream
+from langchain_core.messages import BaseMessage, ToolMessage, message_to_dict, messages_from_dict, messages_to_dict
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from .hedging import as_chunk
+from .tool_executor import call_signature
+
+CASSETTE_MODE = os.getenv('CASSETTE_MODE', 'off') # "off", "record"
+CASSETTE_DIR = os.getenv('CASSETTE_DIR', 'cassettes')
+
+TIMINGS = ('original', 'compressed', 'none')
+
+
+class CassetteMiss(LookupError):
+    pass
+
+
+def prompt_hash(messages: list) -> str:
+    """Fingerprint of a prompt, to tell whether a replayed call was sent the same messages as the recorded one."""
+    text = json.dumps([[getattr(message, 'type', 'human'), str(getattr(message, 'content', message))] for message in messages])
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def estimate_prompt_tokens(messages: list) -> int:
+    return sum(len(str(getattr(message, 'content', message))) for message in messages) // 4
+
+
+class CassetteRecorder:
+    """Appends one turn's traffic to a JSONL file as it happens."""
+    def __init__(self, path: str, header: dict):
+        self.path = path
+        self.started = time.perf_counter()
+        self.model_calls = 0
+        self.tool_calls = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._write({'type' : 'turn', **header})
+
+    def _write(self, entry: dict):
+        with self._lock, open(self.path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(entry, default=str) + '\n')
+
+    def wrap_model(self, model, model_name: str) -> BaseChatModel:
+        return RecordingChatModel(model=model, model_name=model_name, cassette=self)
+
+    def record_model(self, model_name: str, messages: list, chunks: list, seconds: float, error: str | None = None):
+        with self._lock:
+            index = self.model_calls
+            self.model_calls += 1
+        self._write({
+            'type' : 'model', 'index' : index, 'model' : model_name, 'prompt_hash' : prompt_hash(messages),
+            'prompt_tokens' : estimate_prompt_tokens(messages), 'seconds' : round(seconds, 4), 'chunks' : chunks, 'error' : error,
+        })
+
+    def tool_result(self, tool_call: dict) -> ToolMessage | None:
+        return None
+
+    def record_tool(self, tool_call: dict, message: ToolMessage, seconds: float):
+        with self._lock:
+            self.tool_calls += 1
+        self._write({
+            'type' : 'tool', 'name' : tool_call['name'], 'args' : tool_call['args'], 'signature' : call_signature(tool_call),
+            'content' : message.content, 'status' : message.status, 'seconds' : round(seconds, 4),
+        })
+
+    def close(self, summary: dict):
+        self._write({'type' : 'summary', 'seconds' : round(time.perf_counter() - self.started, 4), 'model_calls' : self.model_calls, 'tool_calls' : self.tool_calls, **summary})
+
+
+class CassettePlayer:
+    """
+    Serves a recorded turn. Model calls are answered in recorded order whatever they are sent; tool calls are
+    matched by their arguments first and by name second. Calls the cassette cannot answer are counted as misses.
+    """
+    def __init__(self, path: str, timing: str = 'compressed', speedup: float = 10.0):
+        self.path = path
+        self.timing = timing
+        self.speedup = speedup
+        with open(path, encoding='utf-8') as file:
+            entries = [json.loads(line) for line in file if line.strip()]
+        self.header = next(entry for entry in entries if entry['type'] == 'turn')
+        self.summary = next((entry for entry in entries if entry['type'] == 'summary'), {})
+        self.model_entries = [entry for entry in entries if entry['type'] == 'model']
+        self.tool_entries = [entry for entry in entries if entry['type'] == 'tool']
+        self.model_calls = 0
+        self.prompt_tokens = 0
+        self.drift = 0
+        self.misses = 0
+        self._used_tools : set[int] = set()
+        self._lock = threading.Lock()
+
+    def delay(self, seconds: float) -> float:
+        if self.timing == 'none':
+            return 0.0
+        return seconds / self.speedup if self.timing == 'compressed' else seconds
+
+    def wrap_model(self, model, model_name: str) -> BaseChatModel:
+        return ReplayChatModel(model_name=model_name, cassette=self)
+
+    def next_model_entry(self, messages: list) -> dict:
+        with self._lock:
+            index = self.model_calls
+            self.model_calls += 1
+            self.prompt_tokens += estimate_prompt_tokens(messages)
+            if index >= len(self.model_entries):
+                self.misses += 1
+                raise CassetteMiss(f"{os.path.basename(self.path)} has {len(self.model_entries)} model calls, call {index + 1} was made")
+            entry = self.model_entries[index]
+            self.drift += entry['prompt_hash'] != prompt_hash(messages)
+        return entry
+
+    def tool_result(self, tool_call: dict) -> ToolMessage:
+        signature = call_signature(tool_call)
+        with self._lock:
+            candidates = [index for index, entry in enumerate(self.tool_entries) if index not in self._used_tools and entry['name'] == tool_call['name']]
+            index = next((index for index in candidates if self.tool_entries[index]['signature'] == signature), candidates[0] if candidates else None)
+            if index is None:
+                self.misses += 1
+                return ToolMessage(f"Error: no recorded result for {tool_call['name']}.", name=tool_call['name'], tool_call_id=tool_call['id'], status='error')
+            self._used_tools.add(index)
+        entry = self.tool_entries[index]
+        time.sleep(self.delay(entry['seconds']))
+        return ToolMessage(entry['content'], name=entry['name'], tool_call_id=tool_call['id'], status=entry['status'])
+
+    def record_model(self, *args, **kwargs):
+        pass
+
+    def record_tool(self, *args, **kwargs):
+        pass
+
+    def close(self, summary: dict):
+        pass
+
+
+class RecordingChatModel(BaseChatModel):
+    """Streams from `model` and writes every chunk, with its offset from the start of the call, to the cassette."""
+    model : Any
+    model_name : str
+    cassette : Any
+
+    @property
+    def _llm_type(self) -> str:
+        return 'recording'
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        kwargs = {**kwargs, 'stop' : stop} if stop else kwargs
+        started = time.perf_counter()
+        chunks = []
+        try:
+            # This model reports the chunks to the callbacks; the wrapped one must not report them a second time.
+            for chunk in self.model.stream(messages, config={'callbacks' : []}, **kwargs):
+                chunk = as_chunk(chunk)
+                chunks.append([round(time.perf_counter() - started, 4), message_to_dict(chunk)])
+                yield ChatGenerationChunk(message=chunk)
+        except Exception as e:
+            self.cassette.record_model(self.model_name, messages, chunks, time.perf_counter() - started, error=repr(e))
+            raise
+        self.cassette.record_model(self.model_name, messages, chunks, time.perf_counter() - started)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return generate_from_stream(self._stream(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+
+class ReplayChatModel(BaseChatModel):
+    """Plays the next recorded model call back at the cassette's timing; recorded failures are raised again."""
+    model_name : str
+    cassette : Any
+
+    @property
+    def _llm_type(self) -> str:
+        return 'replay'
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        entry = self.cassette.next_model_entry(messages)
+        started = time.perf_counter()
+        for offset, chunk in entry['chunks']:
+            wait = started + self.cassette.delay(offset) - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            yield ChatGenerationChunk(message=messages_from_dict([chunk])[0])
+        if entry['error']:
+            raise RuntimeError(f"Recorded failure: {entry['error']}")
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return generate_from_stream(self._stream(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+
+def open_cassette(state: dict, history: list[BaseMessage]) -> CassetteRecorder | None:
+    """A recorder for this turn when CASSETTE_MODE=record, otherwise None."""
+    if CASSETTE_MODE != 'record':
+        return None
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{state['conversation_id']}-{uuid.uuid4().hex[:6]}.jsonl"
+    header = {
+        'conversation_id' : state['conversation_id'],
+        'user_query' : state['user_query'],
+        'model_name' : state['model_name'],
+        'response_mode' : state['response_mode'],
+        'self_discussion' : state['self_discussion'],
+        'pre_tools' : list(state['pre_tools']),
+        'uploaded_file_names' : state['_conversation_metadata'].get('uploaded_file_names', []),
+        'history' : messages_to_dict(history),
+        'recorded_at' : time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+    return CassetteRecorder(os.path.join(CASSETTE_DIR, name), header)
+
+
+class QueryCounter:
+    """Statements on every Django connection opened after install() and on every SQLAlchemy engine."""
+    def __init__(self):
+        self.queries = 0
+        self._lock = threading.Lock()
+
+    def _count(self):
+        with self._lock:
+            self.queries += 1
+
+    def django_wrapper(self, execute, sql, params, many, context):
+        self._count()
+        return execute(sql, params, many, context)
+
+    def install(self):
+        from django.db import connections
+        from django.db.backends.signals import connection_created
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        connection_created.connect(lambda sender, connection, **kwargs: connection.execute_wrappers.append(self.django_wrapper), weak=False)
+        for connection in connections.all():
+            connection.execute_wrappers.append(self.django_wrapper)
+        event.listen(Engine, 'before_cursor_execute', lambda *args: self._count())
+
+
+def replay_turn(path: str, user, timing: str, speedup: float, counter: QueryCounter) -> dict:
+    from chats_app.models import Conversation, File
+    from .memory import Memory
+    from .registry import model_registry
+    from .fakes import ScriptedChatModel
+    from .vector_dbs import get_vector_db
+    from .workflow import graph
+
+    player = CassettePlayer(path, timing=timing, speedup=speedup)
+    header = player.header
+    # The replayed calls never reach these models; they stand in for token counting and tool binding.
+    for entry in player.model_entries:
+        model_registry.register(entry['model'], ScriptedChatModel(responses=[""]))
+    model_registry.register(header['model_name'], ScriptedChatModel(responses=[""]))
+
+    conversation = Conversation.objects.create(user=user)
+    for file_name in header['uploaded_file_names']:
+        conversation.add_file(File.objects.create(name=file_name, file=""))
+    history = messages_from_dict(header['history'])
+    if history:
+        memory = Memory.get_memory(str(conversation.id), str(user.id), 7000, model_registry.get_chat_model(header['model_name']), True, False, 'human')
+        memory.add_messages(history)
+
+    state = {
+        'user_id' : str(user.id),
+        'conversation_id' : str(conversation.id),
+        'vector_db' : get_vector_db("cassette-replay"),
+        'user_query' : header['user_query'],
+        'messages' : [],
+        'new_messages' : [],
+        'memory_messages' : [],
+        'pre_tools' : header['pre_tools'],
+        'model_name' : header['model_name'],
+        'response_mode' : header['response_mode'],
+        'self_discussion' : header['self_discussion'],
+        '_verbose' : False,
+        '_conversation_metadata' : {},
+        '_post_stream_tasks' : [],
+        '_stream_writer' : None,
+        '_cassette' : player,
+    }
+    queries = counter.queries
+    started = time.perf_counter()
+    error = None
+    try:
+        for _ in graph.stream(state, stream_mode='messages'):
+            pass
+        for task in state['_post_stream_tasks']:
+            task()
+    except Exception as e:
+        error = repr(e)
+    return {
+        'cassette' : os.path.basename(path),
+        'seconds' : round(time.perf_counter() - started, 4),
+        'recorded_seconds' : player.summary.get('seconds'),
+        'prompt_tokens' : player.prompt_tokens,
+        'recorded_prompt_tokens' : sum(entry['prompt_tokens'] for entry in player.model_entries),
+        'model_calls' : player.model_calls,
+        'recorded_model_calls' : len(player.model_entries),
+        'tool_calls' : len(player._used_tools),
+        'db_queries' : counter.queries - queries,
+        'drift' : player.drift,
+        'misses' : player.misses,
+        'error' : error,
+    }
+
+
+def cassette_paths(paths: list[str]) -> list[str]:
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.jsonl')))
+        else:
+            found.append(path)
+    return found
+
+
+def replay(paths: list[str], timing: str, speedup: float) -> list[dict]:
+    from .fakes import install_offline, setup_throwaway_django
+    setup_throwaway_django('cassette-replay-')
+    from auth_app.models import User
+
+    install_offline({}, index_name="cassette-replay")
+    counter = QueryCounter()
+    counter.install()
+    user, _ = User.objects.get_or_create(email='cassette-replay@example.com', defaults={'first_name' : 'Cassette', 'last_name' : 'Replay'})
+    return [replay_turn(path, user, timing, speedup, counter) for path in cassette_paths(paths)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay recorded turns through the graph without outside services.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    replay_parser = subparsers.add_parser('replay')
+    replay_parser.add_argument('paths', nargs='+', help="cassette files or directories")
+    replay_parser.add_argument('--timing', choices=TIMINGS, default='compressed')
+    replay_parser.add_argument('--speedup', type=float, default=10.0, help="divisor for recorded delays with --timing compressed")
+    replay_parser.add_argument('--out', help="write the report as JSON")
+    replay_parser.add_argument('--baseline', help="earlier report to compare with")
+    args = parser.parse_args()
+
+    results = replay(args.paths, args.timing, args.speedup)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = {result['cassette'] : result for result in json.load(file)}
+
+    sys.stdout.write(f"{'cassette':<52}{'seconds':>9}{'Δ':>8}{'prompt tok':>11}{'Δ':>7}{'db q':>6}{'Δ':>5}{'calls':>7}{'drift':>6}{'miss':>5}\n")
+    for result in results:
+        before = baseline.get(result['cassette'], {})
+        delta = lambda key, spec: format(result[key] - before[key], spec) if key in before else ''
+        sys.stdout.write(
+            f"{result['cassette'][:51]:<52}{result['seconds']:>9.3f}{delta('seconds', '+.3f'):>8}"
+            f"{result['prompt_tokens']:>11}{delta('prompt_tokens', '+d'):>7}{result['db_queries']:>6}{delta('db_queries', '+d'):>5}"
+            f"{result['model_calls']:>4}/{result['recorded_model_calls']:<2}{result['drift']:>6}{result['misses']:>5}"
+            f"{'  ' + result['error'] if result['error'] else ''}\n"
+        )
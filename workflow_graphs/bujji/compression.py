@@ -0,0 +1,157 @@
+import os
+import re
+import math
+from dataclasses import dataclass
+from collections import Counter
+from langchain_core.messages import ToolMessage
+
+# Tokens of each tool's output that are passed on to call_model. Estimated at 4 chars per token, like Memory's recall.
+TOOL_TOKEN_BUDGETS = {
+    'Web URL' : 1200,
+    'Vector DB Search' : 1500,
+    'Wikipedia' : 600,
+    'DuckDuckGo' : 600,
+    'Calculator' : 200,
+}
+DEFAULT_TOOL_TOKEN_BUDGET = 800
+TOOL_TURN_TOKEN_BUDGET = int(os.getenv('TOOL_TURN_TOKEN_BUDGET', 3000))
+# Every output keeps at least this much, even once the turn budget is spent, so the model still sees what the tool said.
+MIN_TOOL_TOKENS = 100
+
+SENTENCE_PATTERN = re.compile(r'(?<=[.!?])\s+(?=[A-Z0-9"\'(\[])|\n+')
+WORD_PATTERN = re.compile(r'\w+')
+STOPWORDS = {
+    'a', 'an', 'the', 'and', 'or', 'of', 'to', 'in', 'on', 'for', 'is', 'are', 'was', 'were', 'be', 'by', 'with',
+    'as', 'at', 'it', 'this', 'that', 'what', 'which', 'who', 'how', 'why', 'when', 'where', 'do', 'does', 'did',
+    'i', 'you', 'me', 'my', 'your', 'about', 'from', 'can', 'tell',
+}
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / 4)
+
+
+def split_sentences(text: str) -> list[str]:
+    return [sentence.strip() for sentence in SENTENCE_PATTERN.split(text) if sentence and sentence.strip()]
+
+
+def normalize_sentence(sentence: str) -> str:
+    return ' '.join(WORD_PATTERN.findall(sentence.lower()))
+
+
+def query_terms(query: str) -> set[str]:
+    return {term for term in WORD_PATTERN.findall(query.lower()) if term not in STOPWORDS}
+
+
+@dataclass
+class CompressionStats:
+    tokens_before : int = 0
+    tokens_after : int = 0
+    compressed : int = 0
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+    def as_dict(self) -> dict:
+        return {'tokens_before' : self.tokens_before, 'tokens_after' : self.tokens_after, 'tokens_saved' : self.tokens_saved, 'compressed' : self.compressed}
+
+
+class ToolOutputCompressor:
+    """
+    Query-aware extractive compression of tool outputs.
+    Sentences already seen earlier in the turn (repeated search snippets, overlapping vector chunks) are dropped,
+    the rest are scored by idf-weighted overlap with the query, and the best ones are kept in document order
+    until the tool's budget, capped by what is left of the turn budget, is filled.
+    """
+    def __init__(self, budgets: dict = TOOL_TOKEN_BUDGETS, turn_budget: int = TOOL_TURN_TOKEN_BUDGET):
+        self.budgets = budgets
+        self.turn_budget = turn_budget
+
+    @staticmethod
+    def _score(sentences: list[str], terms: set[str]) -> list[float]:
+        words = [set(WORD_PATTERN.findall(sentence.lower())) for sentence in sentences]
+        frequency = Counter(word for sentence_words in words for word in sentence_words)
+        scores = []
+        for index, sentence_words in enumerate(words):
+            overlap = sum(math.log(1 + len(sentences) / frequency[term]) for term in terms & sentence_words)
+            # Leading sentences usually carry the summary, so they win ties and matter when the query says nothing.
+            position = 1 / (index + 2)
+            scores.append(overlap / math.sqrt(len(sentence_words) or 1) + 0.1 * position)
+        return scores
+
+    def compress_text(self, text: str, budget: int, query: str = "", seen: set[str] | None = None) -> str:
+        seen = set() if seen is None else seen
+        sentences, keys = [], []
+        for sentence in split_sentences(text):
+            key = normalize_sentence(sentence)
+            if not key or key in seen:
+                continue
+            seen.add(key)
+            sentences.append(sentence)
+            keys.append(key)
+
+        # Chunk overlap leaves sentence fragments that are contained in a neighbouring sentence.
+        unique = [index for index, key in enumerate(keys) if len(key) < 20 or not any(len(other) > len(key) and key in other for other in keys)]
+
+        if sum(len(sentences[index]) + 1 for index in unique) <= budget * 4:
+            return '\n'.join(sentences[index] for index in unique)
+
+        scores = self._score([sentences[index] for index in unique], query_terms(query))
+        chars, selected = budget * 4, set()
+        for position in sorted(range(len(unique)), key=lambda position: scores[position], reverse=True):
+            size = len(sentences[unique[position]]) + 1
+            if size <= chars:
+                selected.add(unique[position])
+                chars -= size
+
+        parts, previous = [], -1
+        for index in sorted(selected):
+            if previous != -1 and index != previous + 1:
+                parts.append("…")
+            parts.append(sentences[index])
+            previous = index
+        return '\n'.join(parts)
+
+    def compress(self, messages: list[ToolMessage], queries: dict[str, str], spent: int = 0) -> tuple[list[ToolMessage], CompressionStats]:
+        """
+        Compress this step's tool messages. `queries` maps tool_call_id to the text the output should be relevant to,
+        `spent` is the number of tool tokens already passed to the model earlier in the turn.
+        Error markers and outputs already within budget are returned unchanged.
+        """
+        stats = CompressionStats()
+        remaining = max(self.turn_budget - spent, 0)
+        seen : set[str] = set()
+        # Smaller outputs are allotted first, so what they leave unused goes to the larger ones.
+        order = sorted(range(len(messages)), key=lambda index: len(str(messages[index].content)))
+        results : dict[int, ToolMessage] = {}
+
+        for position, index in enumerate(order):
+            message = messages[index]
+            content = message.content if isinstance(message.content, str) else str(message.content)
+            tokens = estimate_tokens(content)
+            stats.tokens_before += tokens
+            share = remaining // (len(order) - position)
+            budget = max(min(self.budgets.get(message.name, DEFAULT_TOOL_TOKEN_BUDGET), share), MIN_TOOL_TOKENS)
+
+            keys = {normalize_sentence(sentence) for sentence in split_sentences(content)}
+            if message.status == 'error' or (tokens <= budget and not keys & seen):
+                text = content
+            else:
+                text = self.compress_text(content, budget, queries.get(message.tool_call_id, ""), set(seen)) or content[:budget * 4]
+            seen |= keys
+
+            used = estimate_tokens(text)
+            stats.tokens_after += used
+            remaining = max(remaining - used, 0)
+            if text == content:
+                results[index] = message
+            else:
+                stats.compressed += 1
+                results[index] = message.model_copy(update={'content' : text})
+
+        compressed_messages = [results[index] for index in range(len(messages))]
+        return compressed_messages, stats
+
+
+tool_output_compressor = ToolOutputCompressor()
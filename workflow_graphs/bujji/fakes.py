@@ -0,0 +1,146 @@
+"""
+Offline stand-ins for the provider-backed pieces of the graph: a scripted chat model, deterministic embeddings,
+install_offline() to wire them in through the model registry, long-term memory and an in-memory vector store, and
+setup_throwaway_django() for the offline commands that need Django models.
+"""
+import os
+import re
+import time
+import math
+import atexit
+import shutil
+import hashlib
+import tempfile
+import threading
+from typing import Any, Callable, Iterator, Sequence
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel, generate_from_stream
+from langchain_core.messages import BaseMessage, AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+from .hedging import as_chunk
+
+TOKEN_PATTERN = re.compile(r'\S+\s*|\s+')
+WORD_PATTERN = re.compile(r'\w+')
+
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    Chat model that answers from a script instead of a provider.
+
+    `respond` maps the prompt to the reply; without it the model cycles through `responses`. Text replies stream one
+    word per chunk after `first_token_latency` seconds and `token_latency` seconds between words. Replies with
+    tool calls arrive as one chunk. Usage metadata is estimated the same way the rest of the graph does, at four
+    characters per token. bind_tools returns the model itself, since the script decides which tools are called.
+    """
+    respond : Callable[[list[BaseMessage]], AIMessage | str] | None = None
+    responses : list[Any] = [] # AIMessage or str
+    first_token_latency : float = 0.0
+    token_latency : float = 0.0
+    _calls : int = PrivateAttr(default=0)
+    _lock : Any = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def _llm_type(self) -> str:
+        return 'scripted'
+
+    @property
+    def calls(self) -> int:
+        return self._calls
+
+    def bind_tools(self, tools: Sequence, **kwargs) -> 'ScriptedChatModel':
+        return self
+
+    def get_num_tokens(self, text: str) -> int:
+        # The default counter downloads a GPT-2 tokenizer.
+        return math.ceil(len(text) / 4)
+
+    def _reply(self, messages: list[BaseMessage]) -> AIMessage:
+        with self._lock:
+            index = self._calls
+            self._calls += 1
+        reply = self.respond(messages) if self.respond is not None else self.responses[index % len(self.responses)]
+        return AIMessage(content=reply) if isinstance(reply, str) else reply
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        reply = self._reply(messages)
+        input_tokens = sum(len(str(message.content)) for message in messages) // 4
+        tokens = TOKEN_PATTERN.findall(reply.content) if isinstance(reply.content, str) and not reply.tool_calls else []
+        usage = {'input_tokens' : input_tokens, 'output_tokens' : max(len(tokens), 1), 'total_tokens' : input_tokens + max(len(tokens), 1)}
+        time.sleep(self.first_token_latency)
+        if not tokens:
+            yield ChatGenerationChunk(message=as_chunk(reply.model_copy(update={'usage_metadata' : usage})))
+            return
+        for index, token in enumerate(tokens):
+            if index:
+                time.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+        yield ChatGenerationChunk(message=AIMessageChunk(content='', usage_metadata=usage, response_metadata={'finish_reason' : 'stop'}))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return generate_from_stream(self._stream(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Deterministic bag-of-words embeddings: every word is hashed into one of `size` dimensions and the vector is
+    L2-normalised, so texts that share words are close. Stable across processes, unlike Python's salted hash().
+    """
+    def __init__(self, size: int = 256, latency: float = 0.0):
+        self.size = size
+        self.latency = latency
+
+    def _embed(self, text: str) -> list[float]:
+        vector = [0.0] * self.size
+        for word in WORD_PATTERN.findall(text.lower()):
+            digest = hashlib.md5(word.encode()).digest()
+            vector[int.from_bytes(digest[:4], 'little') % self.size] += 1.0 if digest[4] % 2 else -1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        time.sleep(self.latency)
+        return self._embed(text)
+
+
+def install_offline(models: dict[str, BaseChatModel], embeddings: Embeddings | None = None, index_name: str = "sample-index"):
+    """
+    Serve `models` from the model registry, use `embeddings` (HashingEmbeddings by default) for long-term memory,
+    and create the in-memory vector store `index_name` with them. Set VECTOR_DB_BACKEND=memory so views pick it up.
+    Returns the vector store.
+    """
+    from .registry import model_registry
+    from .memory import set_embeddings
+    from .vector_dbs import InMemoryVectorDB
+
+    embeddings = embeddings or HashingEmbeddings()
+    for model_name, model in models.items():
+        model_registry.register(model_name, model)
+    set_embeddings(embeddings)
+    InMemoryVectorDB(index_name, embeddings=embeddings).delete_index()
+    return InMemoryVectorDB(index_name, embeddings=embeddings)
+
+
+def setup_throwaway_django(prefix: str) -> str:
+    """
+    Set up Django on a migrated SQLite database in a new temporary directory, with the memory database, local vector
+    indexes and the in-memory vector store there too, so nothing an offline run creates reaches the configured
+    databases. Call before anything else sets up Django. The directory is removed at exit; returns its path.
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    directory = tempfile.mkdtemp(prefix=prefix)
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    os.environ['MEMORY_DATABASE_URL'] = f"sqlite:///{directory}/memory.db"
+    os.environ['LOCAL_VECTOR_DB_DIR'] = os.path.join(directory, 'vector_indexes')
+    os.environ['VECTOR_DB_BACKEND'] = 'memory'
+    import django
+    from django.conf import settings
+    from django.core.management import call_command
+    settings.DATABASES = {'default' : {'ENGINE' : 'django.db.backends.sqlite3', 'NAME' : os.path.join(directory, 'django.db')}}
+    django.setup()
+    call_command('migrate', verbosity=0)
+    return directory
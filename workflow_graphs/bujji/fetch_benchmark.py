@@ -0,0 +1,73 @@
+"""
+Latency of the Web URL tool's fetch and extraction against a local HTTP server, so it measures HTMLFetcher and the
+boilerplate stripper rather than the network. Pages are a short article with navigation and footer, and a long page
+of repeated sections that hits the download cap. Runs offline; no Django setup is needed.
+
+    python -m workflow_graphs.bujji.fetch_benchmark --requests 50 --max-tokens 1500
+"""
+import sys
+import time
+import argparse
+import threading
+from statistics import median
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from .fetchers import HTMLFetcher
+
+ARTICLE_HTML = (
+    "<html><head><title>Black Holes</title><script>var tracking = 1;</script></head><body>"
+    "<header><a href='/'>Home</a></header><nav><ul><li><a href='/a'>Menu A</a></li></ul></nav><main><h1>Black Holes</h1>"
+    + "".join(f"<h2>Part {i}</h2><p>A black hole is a region of spacetime where gravity is so strong that nothing can escape.</p>" for i in range(10))
+    + "</main><footer>Copyright</footer></body></html>"
+)
+LARGE_HTML = "<html><head><title>Large</title></head><body>" + "".join(
+    f"<h2>Section {i}</h2><p>{'Galaxies contain stars, gas and dark matter. ' * 20}</p>" for i in range(400)
+) + "</body></html>"
+PAGES = {'/article' : ARTICLE_HTML.encode(), '/large' : LARGE_HTML.encode()}
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        body = PAGES.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[int(q * (len(ordered) - 1))]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure fetch and extraction latency of the Web URL tool.")
+    parser.add_argument('--requests', type=int, default=50, help="fetches per page")
+    parser.add_argument('--max-tokens', type=int, default=1500)
+    parser.add_argument('--max-bytes', type=int, default=200_000)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), PageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    fetcher = HTMLFetcher(max_bytes=args.max_bytes, timeout=5.0, connect_timeout=1.0)
+    try:
+        fetcher.fetch_text(f"{base_url}/article", max_tokens=args.max_tokens)  # warm-up: connection pool
+        sys.stdout.write(f"{'page':<10}{'KB':>8}{'p50 ms':>9}{'p95 ms':>9}\n")
+        for path, body in PAGES.items():
+            seconds = []
+            for _ in range(args.requests):
+                started = time.perf_counter()
+                fetcher.fetch_text(f"{base_url}{path}", max_tokens=args.max_tokens)
+                seconds.append(time.perf_counter() - started)
+            sys.stdout.write(f"{path:<10}{len(body) / 1024:>8.1f}{median(seconds) * 1000:>9.1f}{percentile(seconds, 0.95) * 1000:>9.1f}\n")
+    finally:
+        server.shutdown()
+        server.server_close()
+        fetcher.client.close()
@@ -0,0 +1,199 @@
+import os
+import re
+import time
+import httpx
+from dataclasses import dataclass, field
+from html.parser import HTMLParser
+
+SKIP_TAGS = {'script', 'style', 'noscript', 'svg', 'nav', 'header', 'footer', 'aside', 'form', 'iframe', 'template', 'button', 'select'}
+BLOCK_TAGS = {
+    'p', 'div', 'section', 'article', 'main', 'li', 'ul', 'ol', 'pre', 'blockquote', 'table', 'tr', 'td', 'th',
+    'dd', 'dt', 'figcaption', 'br', 'hr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+}
+HEADING_TAGS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+TEXT_CONTENT_TYPES = ('text/html', 'application/xhtml+xml', 'text/plain')
+
+
+@dataclass
+class Section:
+    heading : str = ""
+    blocks : list[str] = field(default_factory=list)
+
+    @property
+    def text(self) -> str:
+        return '\n'.join(self.blocks)
+
+
+@dataclass
+class FetchResult:
+    url : str
+    status_code : int
+    content_type : str
+    text : str
+    truncated : bool = False
+    elapsed : float = 0.0
+
+
+class TextExtractor(HTMLParser):
+    """
+    Single-pass boilerplate stripper: drops scripts, navigation, headers, footers and forms,
+    splits the rest into blocks, and discards link-dominated blocks such as menus and tag clouds.
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = ""
+        self.sections : list[Section] = [Section()]
+        self._skip_depth = 0
+        self._in_title = False
+        self._in_link = False
+        self._heading : str | None = None
+        self._text : list[str] = []
+        self._link_chars = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag == 'title':
+            self._in_title = True
+        elif tag == 'a':
+            self._in_link = True
+        if tag in BLOCK_TAGS:
+            self._flush()
+        if tag in HEADING_TAGS and not self._skip_depth:
+            self._heading = tag
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS and self._skip_depth:
+            self._skip_depth -= 1
+        elif tag == 'title':
+            self._in_title = False
+        elif tag == 'a':
+            self._in_link = False
+        if tag in BLOCK_TAGS:
+            self._flush()
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+            return
+        if self._skip_depth:
+            return
+        self._text.append(data)
+        if self._in_link:
+            self._link_chars += len(data.strip())
+
+    def _flush(self):
+        text = re.sub(r'\s+', ' ', ''.join(self._text)).strip()
+        link_chars = self._link_chars
+        self._text, self._link_chars = [], 0
+        if not text:
+            self._heading = None
+            return
+        if self._heading:
+            self.sections.append(Section(heading=text))
+            self._heading = None
+            return
+        if link_chars / len(text) > 0.5:
+            return
+        self.sections[-1].blocks.append(text)
+
+    def close(self):
+        super().close()
+        self._flush()
+        self.title = re.sub(r'\s+', ' ', self.title).strip()
+        self.sections = [section for section in self.sections if section.blocks]
+
+
+def extract_sections(html: str) -> tuple[str, list[Section]]:
+    extractor = TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return extractor.title, extractor.sections
+
+
+def budget_sections(sections: list[Section], max_tokens: int, query: str = "") -> list[Section]:
+    """
+    Keep sections within `max_tokens` (estimated at 4 chars per token). With a query, sections sharing the most
+    terms with it are kept first; the result is always returned in document order.
+    """
+    sections = list(sections)
+    terms = set(re.findall(r'\w+', query.lower()))
+    order = list(range(len(sections)))
+    if terms:
+        def score(index: int) -> float:
+            words = re.findall(r'\w+', f"{sections[index].heading} {sections[index].text}".lower())
+            return sum(word in terms for word in words) / (len(words) ** 0.5 or 1)
+        order.sort(key=score, reverse=True)
+
+    budget = max_tokens * 4
+    kept = set()
+    for index in order:
+        section = sections[index]
+        size = len(section.heading) + len(section.text)
+        if size > budget:
+            if budget > 200:
+                kept.add(index)
+                sections[index] = Section(heading=section.heading, blocks=[section.text[:budget] + " …"])
+            break
+        kept.add(index)
+        budget -= size
+    return [section for index, section in enumerate(sections) if index in kept]
+
+
+class HTMLFetcher:
+    """
+    Pooled HTTP fetcher with strict timeouts, a total deadline and a streaming byte cap.
+    """
+    def __init__(self, max_bytes: int = 2_000_000, timeout: float = 10.0, connect_timeout: float = 3.0):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.client = httpx.Client(
+            follow_redirects=True,
+            max_redirects=5,
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=10),
+            headers={'User-Agent' : 'Mozilla/5.0 (compatible; BujjiBot/1.0)', 'Accept' : 'text/html,application/xhtml+xml,text/plain;q=0.9'},
+        )
+
+    def fetch(self, url: str) -> FetchResult:
+        started = time.perf_counter()
+        with self.client.stream('GET', url) as response:
+            response.raise_for_status()
+            content_type = response.headers.get('content-type', '').split(';')[0].strip().lower()
+            if content_type and content_type not in TEXT_CONTENT_TYPES:
+                return FetchResult(str(response.url), response.status_code, content_type, "", elapsed=time.perf_counter() - started)
+
+            chunks, size, truncated = [], 0, False
+            for chunk in response.iter_bytes():
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= self.max_bytes or time.perf_counter() - started > self.timeout:
+                    truncated = True
+                    break
+            body = b''.join(chunks)[:self.max_bytes]
+            text = body.decode(response.encoding or 'utf-8', errors='replace')
+            return FetchResult(str(response.url), response.status_code, content_type, text, truncated, time.perf_counter() - started)
+
+    def fetch_text(self, url: str, max_tokens: int, query: str = "") -> str:
+        result = self.fetch(url)
+        if result.content_type and result.content_type not in TEXT_CONTENT_TYPES:
+            return f"Unsupported content type '{result.content_type}' at {result.url}."
+
+        if result.content_type == 'text/plain':
+            title, sections = "", [Section(blocks=[result.text])]
+        else:
+            title, sections = extract_sections(result.text)
+        sections = budget_sections(sections, max_tokens, query)
+
+        parts = [f"Title: {title}" if title else "", f"URL: {result.url}"]
+        for section in sections:
+            parts.append(f"## {section.heading}\n{section.text}" if section.heading else section.text)
+        if result.truncated:
+            parts.append("[Page truncated at the download size limit]")
+        return '\n\n'.join(part for part in parts if part)
+
+
+html_fetcher = HTMLFetcher(
+    max_bytes=int(os.getenv('WEB_FETCH_MAX_BYTES', 2_000_000)),
+    timeout=float(os.getenv('WEB_FETCH_TIMEOUT', 10)),
+)
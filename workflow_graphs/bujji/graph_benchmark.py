@@ -0,0 +1,233 @@
+"""
+End-to-end benchmark of the chat graph and its SSE view with scripted models, hashing embeddings and an
+in-memory vector store, so it measures our own overhead and runs without network access.
+
+For each scenario (plain answer, calculator tool call, self-discussion, question about an attached file) it reports
+the graph's wall time per turn, the same turn through LLMResponseSSEView and the difference (SSE framing, message
+rows, logging), SSE bytes and events, database writes per turn on the Django and memory databases, and throughput
+with concurrent turns. A second table breaks the graph time down per node.
+
+The Django and memory databases are throwaway SQLite files in a temporary directory, migrated on start and removed
+at exit, so the users, conversations, files and history rows a run creates never reach the configured databases.
+
+    python -m workflow_graphs.bujji.graph_benchmark --turns 20 --concurrency 4 --first-token-latency 0.2
+"""
+import sys
+import time
+import uuid
+import argparse
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+BENCHMARK_MODEL = 'scripted-benchmark'
+ANSWER = "Here is a short answer written by the scripted model so that streaming has a few dozen tokens to send. " * 3
+PLAN = "The user wants a clear answer. No file is needed and the reply should be short and structured."
+REPORT = [
+    "The quarterly report shows revenue of 12 million, up 8 percent on the previous quarter.",
+    "Operating costs rose to 9 million because of new hires in the support team.",
+    "The outlook for next quarter expects revenue between 12.5 and 13 million.",
+]
+
+SCENARIOS = {
+    'no_tool' : {'query' : "Tell me something nice about mornings", 'self_discussion' : False, 'attachment' : False},
+    'tool' : {'query' : "Please calculate 12 * (3 + 4) for me", 'self_discussion' : False, 'attachment' : False},
+    'self_discussion' : {'query' : "Tell me something nice about mornings", 'self_discussion' : True, 'attachment' : False},
+    'attachment' : {'query' : "What does the uploaded report say about revenue?", 'self_discussion' : False, 'attachment' : True},
+}
+
+
+def respond(messages: list) -> AIMessage:
+    """Script for the benchmark model: plan when asked to, call the tool the query calls for once, then answer."""
+    last = messages[-1]
+    if isinstance(last, HumanMessage) and 'self-discussion mode' in str(last.content):
+        return AIMessage(content=PLAN)
+    if isinstance(last, ToolMessage) and last.name != 'self_discussion':
+        return AIMessage(content=ANSWER)
+    query = next((str(message.content) for message in reversed(messages) if isinstance(message, HumanMessage)), "")
+    if 'calculate' in query:
+        return AIMessage(content='', tool_calls=[{'name' : 'Calculator', 'args' : {'expression' : '12 * (3 + 4)'}, 'id' : f"call_{uuid.uuid4().hex[:8]}"}])
+    if 'uploaded report' in query:
+        return AIMessage(content='', tool_calls=[{'name' : 'Vector DB Search', 'args' : {'query' : 'revenue', 'k' : 3}, 'id' : f"call_{uuid.uuid4().hex[:8]}"}])
+    return AIMessage(content=ANSWER)
+
+
+class NodeTimer(BaseCallbackHandler):
+    """Wall time of every graph node run, from the chain callbacks langgraph emits per node."""
+    def __init__(self):
+        self.started : dict = {}
+        self.seconds : dict[str, list[float]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def on_chain_start(self, serialized, inputs, *, run_id, metadata=None, **kwargs):
+        node = (metadata or {}).get('langgraph_node')
+        if node is not None and kwargs.get('name') == node:
+            self.started[run_id] = (node, time.perf_counter())
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        entry = self.started.pop(run_id, None)
+        if entry is not None:
+            with self._lock:
+                self.seconds[entry[0]].append(time.perf_counter() - entry[1])
+
+    on_chain_error = on_chain_end
+
+
+class WriteCounter:
+    """INSERT, UPDATE and DELETE statements on the Django connection of the calling thread and on every SQLAlchemy engine."""
+    WRITES = ('insert', 'update', 'delete')
+
+    def __init__(self):
+        self.django = 0
+        self.memory = 0
+
+    def django_wrapper(self, execute, sql, params, many, context):
+        self.django += sql.lstrip().lower().startswith(self.WRITES)
+        return execute(sql, params, many, context)
+
+    def sqlalchemy_listener(self, connection, cursor, statement, parameters, context, executemany):
+        self.memory += statement.lstrip().lower().startswith(self.WRITES)
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(int(round(q * len(ordered))) - 1, 0))] if ordered else 0.0
+
+
+class Benchmark:
+    def __init__(self, vector_db, user):
+        from chats_app.models import File
+        self.vector_db = vector_db
+        self.user = user
+        self.report = File.objects.create(name="report.pdf", file="", documents=[(f"report-{index}", {'page_content' : text, 'metadata' : {}}) for index, text in enumerate(REPORT)])
+
+    def new_conversation(self, attachment: bool):
+        from chats_app.models import Conversation
+        conversation = Conversation.objects.create(user=self.user)
+        if attachment:
+            conversation.add_file(self.report)
+            self.vector_db.add_documents(self.report.get_documents(metadata={'conversation_id' : str(conversation.id)}))
+        return conversation
+
+    def initial_state(self, scenario: dict) -> dict:
+        """Graph input for one turn of `scenario` in a new conversation, as LLMResponseSSEView builds it."""
+        conversation = self.new_conversation(scenario['attachment'])
+        return {
+            'user_id' : str(self.user.id),
+            'conversation_id' : str(conversation.id),
+            'vector_db' : self.vector_db,
+            'user_query' : scenario['query'],
+            'messages' : [],
+            'new_messages' : [],
+            'memory_messages' : [],
+            'pre_tools' : [],
+            'model_name' : BENCHMARK_MODEL,
+            'response_mode' : 'Auto',
+            'self_discussion' : scenario['self_discussion'],
+            '_verbose' : False,
+            '_conversation_metadata' : {},
+            '_post_stream_tasks' : [],
+            '_stream_writer' : None,
+        }
+
+    def graph_turn(self, scenario: dict, timer: NodeTimer | None = None) -> float:
+        from .workflow import graph
+        state = self.initial_state(scenario)
+        started = time.perf_counter()
+        for _ in graph.stream(state, stream_mode='messages', config={'callbacks' : [timer]} if timer else None):
+            pass
+        for task in state['_post_stream_tasks']:
+            task()
+        return time.perf_counter() - started
+
+    def view_turn(self, scenario: dict) -> tuple[float, int, int]:
+        from rest_framework.test import APIRequestFactory, force_authenticate
+        from chats_app.views import LLMResponseSSEView
+        # The view attaches the file itself.
+        conversation = self.new_conversation(attachment=False)
+        body = {'conversation_id' : str(conversation.id), 'query' : scenario['query'], 'model_name' : BENCHMARK_MODEL, 'response_mode' : 'Auto', 'self_discussion' : scenario['self_discussion']}
+        if scenario['attachment']:
+            body['attachments'] = [{'id' : str(self.report.id)}]
+        request = APIRequestFactory().post('/api/conversation/stream/', body, format='json')
+        force_authenticate(request, user=self.user)
+        started = time.perf_counter()
+        response = LLMResponseSSEView.as_view()(request)
+        size = events = 0
+        for part in response.streaming_content:
+            size += len(part)
+            events += 1
+        return time.perf_counter() - started, size, events
+
+    def run(self, name: str, scenario: dict, turns: int, concurrency: int, timer: NodeTimer) -> dict:
+        from django.db import connection
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        self.graph_turn(scenario)  # warm-up: imports, model bindings, first FAISS index
+        graph_seconds = [self.graph_turn(scenario, timer) for _ in range(turns)]
+
+        counter = WriteCounter()
+        event.listen(Engine, 'before_cursor_execute', counter.sqlalchemy_listener)
+        try:
+            with connection.execute_wrapper(counter.django_wrapper):
+                views = [self.view_turn(scenario) for _ in range(turns)]
+        finally:
+            event.remove(Engine, 'before_cursor_execute', counter.sqlalchemy_listener)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(lambda _: self.graph_turn(scenario), range(turns)))
+        throughput = turns / (time.perf_counter() - started)
+
+        view_seconds = [seconds for seconds, _, _ in views]
+        return {
+            'scenario' : name,
+            'graph_p50' : percentile(graph_seconds, 0.5) * 1000,
+            'graph_p95' : percentile(graph_seconds, 0.95) * 1000,
+            'view_p50' : percentile(view_seconds, 0.5) * 1000,
+            'sse_overhead' : (percentile(view_seconds, 0.5) - percentile(graph_seconds, 0.5)) * 1000,
+            'sse_bytes' : sum(size for _, size, _ in views) / turns,
+            'sse_events' : sum(events for _, _, events in views) / turns,
+            'django_writes' : counter.django / turns,
+            'memory_writes' : counter.memory / turns,
+            'throughput' : throughput,
+        }
+
+
+def setup(first_token_latency: float, token_latency: float, embedding_latency: float):
+    from .fakes import ScriptedChatModel, HashingEmbeddings, install_offline, setup_throwaway_django
+    setup_throwaway_django('graph-benchmark-')
+    from auth_app.models import User
+
+    model = ScriptedChatModel(respond=respond, first_token_latency=first_token_latency, token_latency=token_latency)
+    vector_db = install_offline({BENCHMARK_MODEL : model}, embeddings=HashingEmbeddings(latency=embedding_latency))
+    user, _ = User.objects.get_or_create(email='graph-benchmark@example.com', defaults={'first_name' : 'Graph', 'last_name' : 'Benchmark'})
+    return Benchmark(vector_db, user)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the chat graph and SSE view offline.")
+    parser.add_argument('--turns', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS), help="default: all")
+    parser.add_argument('--first-token-latency', type=float, default=0.0, help="seconds before the scripted model's first chunk")
+    parser.add_argument('--token-latency', type=float, default=0.0, help="seconds between streamed words")
+    parser.add_argument('--embedding-latency', type=float, default=0.0)
+    args = parser.parse_args()
+
+    benchmark = setup(args.first_token_latency, args.token_latency, args.embedding_latency)
+    timer = NodeTimer()
+    results = [benchmark.run(name, SCENARIOS[name], args.turns, args.concurrency, timer) for name in args.scenario or SCENARIOS]
+
+    sys.stdout.write(f"{'scenario':<17}{'graph p50':>10}{'p95 ms':>8}{'view p50':>10}{'sse ms':>8}{'sse KB':>8}{'events':>8}{'db w':>6}{'mem w':>7}{'turns/s':>9}\n")
+    for result in results:
+        sys.stdout.write(
+            f"{result['scenario']:<17}{result['graph_p50']:>10.1f}{result['graph_p95']:>8.1f}{result['view_p50']:>10.1f}"
+            f"{result['sse_overhead']:>8.1f}{result['sse_bytes'] / 1024:>8.1f}{result['sse_events']:>8.0f}"
+            f"{result['django_writes']:>6.0f}{result['memory_writes']:>7.0f}{result['throughput']:>9.1f}\n"
+        )
+    sys.stdout.write(f"\n{'node':<25}{'runs':>6}{'mean ms':>10}{'p95 ms':>9}\n")
+    for node, seconds in sorted(timer.seconds.items(), key=lambda item: -sum(item[1])):
+        sys.stdout.write(f"{node:<25}{len(seconds):>6}{sum(seconds) / len(seconds) * 1000:>10.2f}{percentile(seconds, 0.95) * 1000:>9.2f}\n")
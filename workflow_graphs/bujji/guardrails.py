@@ -0,0 +1,34 @@
+import os
+from langchain_core.messages import AIMessage
+from .metrics import metrics
+
+# Per-turn limits on the call_model -> tool_node cycle. Once either is reached the model is asked for a final answer without tools.
+TOOL_MAX_ITERATIONS = int(os.getenv('TOOL_MAX_ITERATIONS', 5))
+TURN_MAX_INPUT_TOKENS = int(os.getenv('TURN_MAX_INPUT_TOKENS', 24000))
+
+FINAL_ANSWER_PROMPT = "The tool budget for this turn is used up. Do not call any more tools. Answer the user's question now with the information you already have, and say briefly if something could not be looked up."
+BUDGET_EXHAUSTED_TOOL_MESSAGE = "Error: Tool '{name}' was not run because the {budget} budget for this turn is used up."
+
+
+def exceeded_budget(state: dict) -> dict | None:
+    """The first per-turn limit the state has reached, as a budget event, or None."""
+    iterations = state.get('_tool_iterations', 0)
+    if iterations >= TOOL_MAX_ITERATIONS:
+        return {'type' : 'tool_iterations', 'value' : iterations, 'limit' : TOOL_MAX_ITERATIONS}
+    input_tokens = state.get('_input_tokens', 0)
+    if input_tokens >= TURN_MAX_INPUT_TOKENS:
+        return {'type' : 'input_tokens', 'value' : input_tokens, 'limit' : TURN_MAX_INPUT_TOKENS}
+    return None
+
+
+def record_budget_event(state: dict, event: dict):
+    """Budget events are collected in the shared conversation metadata so the view can stream them as they happen."""
+    metrics.inc('turn_budget_events_total', type=event['type'])
+    state['_conversation_metadata'].setdefault('budget_events', []).append(event)
+
+
+def estimate_input_tokens(messages: list, response: AIMessage) -> int:
+    usage = getattr(response, 'usage_metadata', None) or {}
+    if usage.get('input_tokens'):
+        return usage['input_tokens']
+    return sum(len(str(message.content)) for message in messages) // 4
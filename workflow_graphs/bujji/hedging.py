@@ -0,0 +1,157 @@
+import os
+import json
+import math
+import time
+import queue
+import threading
+from typing import Any, Iterator
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.language_models.chat_models import BaseChatModel, generate_from_stream
+from langchain_core.messages import BaseMessage, BaseMessageChunk, AIMessageChunk
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from .metrics import metrics
+
+HEDGE_REQUESTS = os.getenv('HEDGE_REQUESTS', 'false').lower() == 'true'
+# The hedge fires when the first token is later than this percentile of the model's recent time to first token.
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', 0.9))
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', 0.5))
+HEDGE_DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_DELAY', 2.0))
+# "same" duplicates the request to the same model, "fallback" sends it to the next model in the routed pool.
+HEDGE_TARGET = os.getenv('HEDGE_TARGET', 'same')
+
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv('HEDGE_MAX_WORKERS', 32)), thread_name_prefix='llm-stream')
+
+
+class FirstTokenLatency:
+    """Recent time-to-first-token samples per model, used to set the hedge deadline."""
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples : dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def record(self, model_name: str, seconds: float):
+        metrics.observe('llm_ttft_seconds', seconds, model=model_name)
+        with self._lock:
+            self._samples.setdefault(model_name, deque(maxlen=self.window)).append(seconds)
+
+    def deadline(self, model_name: str, percentile: float = HEDGE_PERCENTILE) -> float:
+        with self._lock:
+            samples = sorted(self._samples.get(model_name, ()))
+        if len(samples) < self.min_samples:
+            return HEDGE_DEFAULT_DELAY
+        return max(samples[min(len(samples) - 1, math.ceil(percentile * len(samples)) - 1)], HEDGE_MIN_DELAY)
+
+
+first_token_latency = FirstTokenLatency()
+
+
+def as_chunk(message: BaseMessage) -> BaseMessageChunk:
+    """Models without native streaming yield one whole AIMessage; turn it into the equivalent chunk."""
+    if isinstance(message, BaseMessageChunk):
+        return message
+    tool_call_chunks = [
+        {'name' : tool_call['name'], 'args' : json.dumps(tool_call['args']), 'id' : tool_call['id'], 'index' : index}
+        for index, tool_call in enumerate(getattr(message, 'tool_calls', []))
+    ]
+    return AIMessageChunk(
+        content=message.content,
+        additional_kwargs=message.additional_kwargs,
+        response_metadata=message.response_metadata,
+        usage_metadata=getattr(message, 'usage_metadata', None),
+        tool_call_chunks=tool_call_chunks,
+        id=message.id,
+    )
+
+
+class HedgedChatModel(BaseChatModel):
+    """
+    Streams from `primary` and, if no chunk has arrived after the model's percentile deadline, starts the same
+    request on `backup`. Whichever streams first is used and the other is told to stop. A request still waiting
+    for its first byte stops when that byte arrives, so the loser costs its prompt and at most one chunk.
+    Both requests run in worker threads without the caller's callbacks; only the winner's chunks are re-emitted here.
+    """
+    primary : Any
+    backup : Any
+    primary_name : str
+    backup_name : str
+    delay : float
+
+    @property
+    def _llm_type(self) -> str:
+        return 'hedged'
+
+    @staticmethod
+    def _pump(role: str, runnable, messages, kwargs: dict, outbox: queue.Queue, cancelled: threading.Event):
+        stream = None
+        try:
+            stream = runnable.stream(messages, **kwargs)
+            for chunk in stream:
+                if cancelled.is_set():
+                    break
+                outbox.put((role, 'chunk', chunk))
+            outbox.put((role, 'end', None))
+        except Exception as e:
+            outbox.put((role, 'error', e))
+        finally:
+            if stream is not None:
+                stream.close()
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        kwargs = {**kwargs, 'stop' : stop} if stop else kwargs
+        outbox : queue.Queue = queue.Queue()
+        cancelled = {'primary' : threading.Event(), 'backup' : threading.Event()}
+        started = {'primary' : time.perf_counter()}
+        names = {'primary' : self.primary_name, 'backup' : self.backup_name}
+        _executor.submit(self._pump, 'primary', self.primary, messages, kwargs, outbox, cancelled['primary'])
+
+        def start_backup():
+            started['backup'] = time.perf_counter()
+            metrics.inc('llm_hedges_total', model=self.primary_name, target=self.backup_name)
+            _executor.submit(self._pump, 'backup', self.backup, messages, kwargs, outbox, cancelled['backup'])
+
+        winner, failed = None, set()
+        while True:
+            timeout = None
+            if winner is None and 'backup' not in started:
+                timeout = max(started['primary'] + self.delay - time.perf_counter(), 0)
+            try:
+                role, kind, payload = outbox.get(timeout=timeout)
+            except queue.Empty:
+                start_backup()
+                continue
+
+            if winner is not None and role != winner:
+                continue
+            if kind == 'error':
+                failed.add(role)
+                # A request that fails before its first chunk hands over to the other one.
+                if winner is None and 'backup' not in started:
+                    start_backup()
+                    continue
+                if winner is None and len(failed) < len(started):
+                    continue
+                raise payload
+            if kind == 'end':
+                return
+
+            if winner is None:
+                winner = role
+                loser = 'backup' if role == 'primary' else 'primary'
+                cancelled[loser].set()
+                now = time.perf_counter()
+                first_token_latency.record(names[role], now - started[role])
+                if loser in started and loser not in failed:
+                    # The loser's first token is at least this late; recording it keeps the deadline honest.
+                    first_token_latency.record(names[loser], now - started[loser])
+                if 'backup' in started:
+                    metrics.inc('llm_hedge_wins_total', model=names[role], role=role)
+            yield ChatGenerationChunk(message=as_chunk(payload))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return generate_from_stream(self._stream(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+
+def hedge(model, model_name: str, backup, backup_name: str) -> HedgedChatModel:
+    return HedgedChatModel(primary=model, backup=backup, primary_name=model_name, backup_name=backup_name, delay=first_token_latency.deadline(model_name))
@@ -0,0 +1,61 @@
+"""
+Time to first token with and without hedging, on a scripted model whose queue time is usually short but stalls on
+a small share of requests, the way a provider's does under load. Runs offline; no Django setup is needed.
+
+    python -m workflow_graphs.bujji.hedging_benchmark --requests 300 --stall-rate 0.05 --stall-seconds 1.5
+"""
+import sys
+import time
+import random
+import argparse
+from langchain_core.messages import AIMessage
+from .fakes import ScriptedChatModel
+from .hedging import hedge, first_token_latency
+from .metrics import metrics
+
+MODEL = 'stalling-benchmark'
+
+
+def stalling_model(rng: random.Random, stall_rate: float, stall_seconds: float, queue_seconds: tuple[float, float]) -> ScriptedChatModel:
+    def respond(messages) -> AIMessage:
+        time.sleep(stall_seconds if rng.random() < stall_rate else rng.uniform(*queue_seconds))
+        return AIMessage(content="hello world")
+    return ScriptedChatModel(respond=respond, token_latency=0.01)
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[int(q * (len(ordered) - 1))]
+
+
+def first_tokens(model, requests: int, hedged: bool) -> list[float]:
+    seconds = []
+    for _ in range(requests):
+        runnable = hedge(model, MODEL, model, MODEL) if hedged else model
+        started = time.perf_counter()
+        stream = runnable.stream("hi")
+        next(stream)
+        seconds.append(time.perf_counter() - started)
+        stream.close()
+    return seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure TTFT percentiles with and without request hedging.")
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--warmup', type=int, default=20, help="hedged requests run first so the deadline is set from real samples")
+    parser.add_argument('--stall-rate', type=float, default=0.05)
+    parser.add_argument('--stall-seconds', type=float, default=1.5)
+    parser.add_argument('--seed', type=int, default=3)
+    args = parser.parse_args()
+
+    model = stalling_model(random.Random(args.seed), args.stall_rate, args.stall_seconds, (0.05, 0.15))
+    first_tokens(model, args.warmup, hedged=True)
+    hedges_before = sum(value for (name, _), value in metrics.snapshot()['counters'].items() if name == 'llm_hedges_total')
+
+    sys.stdout.write(f"{'mode':<8}{'p50 s':>8}{'p99 s':>8}{'mean s':>8}\n")
+    for mode, hedged in (('plain', False), ('hedged', True)):
+        seconds = first_tokens(model, args.requests, hedged)
+        sys.stdout.write(f"{mode:<8}{percentile(seconds, 0.5):>8.3f}{percentile(seconds, 0.99):>8.3f}{sum(seconds) / len(seconds):>8.3f}\n")
+    hedges = sum(value for (name, _), value in metrics.snapshot()['counters'].items() if name == 'llm_hedges_total') - hedges_before
+    sys.stdout.write(f"\nhedged {hedges / args.requests:.1%} of requests, deadline {first_token_latency.deadline(MODEL):.3f}s\n")
@@ -1,13 +1,156 @@
 import os
+import time
+import logging
+import threading
+from uuid import uuid4
+from collections import OrderedDict
 from datetime import datetime
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, insert, update, select, MetaData, Table, Column, String, Integer
+from sqlalchemy.dialects import postgresql, sqlite, mysql
+from sqlalchemy.exc import IntegrityError
 from langchain_core.messages import trim_messages
 from langchain_core.messages import HumanMessage, AIMessage, ToolMessage, BaseMessage
 from langchain_community.chat_message_histories import SQLChatMessageHistory
 from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.documents import Document
+from langchain_cohere import CohereEmbeddings
+from .vector_dbs import FAISSVectorDB
+
+_engine = None
+_embeddings = None
+_metadata = MetaData()
+
+# One row per conversation, bumped on every write so other workers can tell their cached window is stale.
+memory_versions = Table(
+    'memory_versions',
+    _metadata,
+    Column('user_id', String(255), primary_key=True),
+    Column('session_id', String(255), primary_key=True),
+    Column('version', Integer, nullable=False, default=0),
+)
+
+
+class HistoryCache:
+    """
+    Process-local LRU of trimmed history windows keyed by (user_id, conversation_id, max_tokens, token counter).
+    Entries expire after `ttl` seconds or as soon as the stored version no longer matches the database.
+    """
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries : OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple, version: int) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry['version'] != version or entry['expires_at'] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key: tuple, history: SQLChatMessageHistory, messages: list[BaseMessage], version: int):
+        with self._lock:
+            self._entries[key] = {
+                'history' : history,
+                'messages' : list(messages),
+                'version' : version,
+                'expires_at' : time.monotonic() + self.ttl,
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: tuple):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+history_cache = HistoryCache(
+    max_size=int(os.getenv('MEMORY_CACHE_SIZE', 256)),
+    ttl=float(os.getenv('MEMORY_CACHE_TTL', 300)),
+)
+
+
+def get_embeddings():
+    global _embeddings
+    if _embeddings is None:
+        _embeddings = CohereEmbeddings(model="embed-english-v3.0")
+    return _embeddings
+
+
+def set_embeddings(embeddings):
+    """Replace the long-term memory embeddings, e.g. with fakes.HashingEmbeddings when running offline."""
+    global _embeddings
+    _embeddings = embeddings
+
+
+class LongTermMemory:
+    """
+    Per-user semantic index of exchanges that have aged out of the recency window.
+    Recall returns the most relevant past exchanges that fit in `max_tokens` (estimated at 4 chars per token).
+    """
+    def __init__(self, user_id: str, k: int = 3, max_tokens: int = 400, score_threshold: float = 0.3):
+        self.user_id = user_id
+        self.k = k
+        self.max_tokens = max_tokens
+        self.score_threshold = score_threshold
+        self._vector_db : FAISSVectorDB | None = None
+
+    @property
+    def vector_db(self) -> FAISSVectorDB:
+        if self._vector_db is None:
+            self._vector_db = FAISSVectorDB(index_name=f"long-term-memory-{self.user_id}", embeddings=get_embeddings())
+        return self._vector_db
+
+    @staticmethod
+    def to_exchanges(messages: list[BaseMessage]) -> list[str]:
+        exchanges, lines = [], []
+        for message in messages:
+            if isinstance(message, HumanMessage) and lines:
+                exchanges.append('\n'.join(lines))
+                lines = []
+            if isinstance(message, HumanMessage):
+                lines.append(f"User: {message.text()}")
+            elif isinstance(message, AIMessage) and message.text():
+                lines.append(f"Assistant: {message.text()}")
+        if lines:
+            exchanges.append('\n'.join(lines))
+        return exchanges
+
+    def remember(self, session_id: str, messages: list[BaseMessage]):
+        exchanges = [exchange for exchange in self.to_exchanges(messages) if exchange.strip()]
+        if not exchanges:
+            return
+        documents = [(str(uuid4()), Document(page_content=exchange, metadata={'session_id' : session_id})) for exchange in exchanges]
+        self.vector_db.add_documents(documents)
+
+    def recall(self, query: str) -> str:
+        try:
+            results = self.vector_db.similarity_search(query, k=self.k, score_threshold=self.score_threshold)
+        except Exception as e:
+            logging.warning(f"Long-term memory recall failed: {e}")
+            return ""
+
+        budget = self.max_tokens * 4
+        recalled = []
+        for document, _ in results:
+            if len(document.page_content) > budget:
+                break
+            recalled.append(document.page_content)
+            budget -= len(document.page_content)
+        return '\n\n'.join(recalled)
+
 
 class Memory:
-    def __init__(self, sql_history_obj : SQLChatMessageHistory,  max_tokens: int, token_counter, include_system: bool, allow_partial: bool, start_on: str):
+    def __init__(self, sql_history_obj : SQLChatMessageHistory,  max_tokens: int, token_counter, include_system: bool, allow_partial: bool, start_on: str, messages: list[BaseMessage] | None = None):
         self.trim_messages = trim_messages(
             max_tokens=max_tokens,
             strategy='last',
@@ -17,29 +160,133 @@ class Memory:
             start_on=start_on
         )
         self.sql_history_obj = sql_history_obj
-        self.messages = self.get_trimmed_messages()
-    
+        self.messages = self.get_trimmed_messages() if messages is None else list(messages)
+        self.cache_key = None
+        self.version = 0
+        self.long_term : LongTermMemory | None = None
+
     def get_trimmed_messages(self):
         return self.trim_messages.invoke(self.sql_history_obj.messages)
-        
+
     def get_timestamp(self):
         return datetime.now().strftime("%A, %B %d, %Y - %I:%M %p")
 
-    def add_user_message(self, message: HumanMessage):
-        self.sql_history_obj.add_user_message(message)
+    def add_user_message(self, message: HumanMessage | str):
+        self.add_messages([message if isinstance(message, BaseMessage) else HumanMessage(content=message)])
+
+    def add_ai_message(self, message: AIMessage | str):
+        self.add_messages([message if isinstance(message, BaseMessage) else AIMessage(content=message)])
 
-    def add_ai_message(self, message: AIMessage):
-        self.sql_history_obj.add_ai_message(message)
-        
     def add_tool_message(self, message: ToolMessage):
-        self.sql_history_obj.add_message(message)
-        
+        self.add_messages([message])
+
     def add_message(self, message: BaseMessage):
-        self.sql_history_obj.add_message(message)
-                
+        self.add_messages([message])
+
+    def add_messages(self, messages: list[BaseMessage]):
+        """Write a whole turn in one transaction with a single multi-row INSERT."""
+        if not messages:
+            return
+        history = self.sql_history_obj
+        table = history.sql_model_class.__table__
+        rows = []
+        for message in messages:
+            sql_message = history.converter.to_sql_model(message, history.session_id)
+            rows.append({column.name : getattr(sql_message, column.name) for column in table.columns if not column.primary_key})
+
+        with history.session_maker() as session:
+            session.execute(insert(table).values(rows))
+            version = self.bump_version(session, *self.cache_key[:2]) if self.cache_key else None
+            session.commit()
+
+        if self.cache_key:
+            self.write_through(messages, version)
+
+    def write_through(self, messages: list[BaseMessage], version: int):
+        window = [*self.messages, *messages]
+        self.messages = self.trim_messages.invoke(window)
+        aged_out = window[:len(window) - len(self.messages)]
+        # Any other writer in between means our window is missing messages, so drop it instead of caching.
+        if version == self.version + 1:
+            history_cache.set(self.cache_key, self.sql_history_obj, self.messages, version)
+        else:
+            history_cache.invalidate(self.cache_key)
+        self.version = version
+
+        if aged_out and self.long_term:
+            try:
+                self.long_term.remember(self.cache_key[1], aged_out)
+            except Exception as e:
+                logging.warning(f"Long-term memory update failed: {e}")
+
+    def recall(self, query: str) -> str:
+        """Relevant exchanges from outside the current window, or an empty string."""
+        return self.long_term.recall(query) if self.long_term else ""
+
+    @staticmethod
+    def bump_version(session, user_id: str, session_id: str) -> int:
+        """Increment the conversation's version in one upsert, so two first writes cannot both insert."""
+        condition = (memory_versions.c.user_id == user_id) & (memory_versions.c.session_id == session_id)
+        row = {'user_id' : user_id, 'session_id' : session_id, 'version' : 1}
+        bumped = {'version' : memory_versions.c.version + 1}
+        dialect = session.get_bind().dialect.name
+        if dialect in ('postgresql', 'sqlite'):
+            upsert = (postgresql if dialect == 'postgresql' else sqlite).insert(memory_versions).values(**row)
+            session.execute(upsert.on_conflict_do_update(index_elements=['user_id', 'session_id'], set_=bumped))
+        elif dialect in ('mysql', 'mariadb'):
+            session.execute(mysql.insert(memory_versions).values(**row).on_duplicate_key_update(**bumped))
+        elif session.execute(update(memory_versions).where(condition).values(**bumped)).rowcount == 0:
+            try:
+                with session.begin_nested():
+                    session.execute(insert(memory_versions).values(**row))
+            except IntegrityError: # another writer inserted the row first
+                session.execute(update(memory_versions).where(condition).values(**bumped))
+        return session.execute(select(memory_versions.c.version).where(condition)).scalar_one()
+
+    @classmethod
+    def get_version(cls, user_id: str, session_id: str) -> int:
+        condition = (memory_versions.c.user_id == user_id) & (memory_versions.c.session_id == session_id)
+        with cls.get_engine().connect() as connection:
+            return connection.execute(select(memory_versions.c.version).where(condition)).scalar() or 0
+
     @classmethod
-    def get_memory(cls, session_id:str, user_id:str, max_tokens: int, token_counter, include_system: bool, allow_partial: bool, start_on: str) -> BaseChatMessageHistory:
-        engine = create_engine(os.getenv('MEMORY_DATABASE_URL'))
-        message_history = SQLChatMessageHistory(session_id=session_id, connection=engine, table_name = user_id)
-        message_history_trimmed = cls(message_history, max_tokens, token_counter, include_system, allow_partial, start_on) if len(message_history.messages) > 0 else message_history
-        return message_history_trimmed
\ No newline at end of file
+    def get_engine(cls):
+        global _engine
+        if _engine is None:
+            _engine = create_engine(os.getenv('MEMORY_DATABASE_URL'), pool_pre_ping=True)
+            _metadata.create_all(_engine)
+        return _engine
+
+    @staticmethod
+    def counter_key(token_counter) -> str:
+        """Stable name for the token counter: a chat model's class and model name, or a function's qualified name."""
+        model_name = getattr(token_counter, 'model_name', None) or getattr(token_counter, 'model', None)
+        if isinstance(model_name, str):
+            return f"{type(token_counter).__name__}:{model_name}"
+        qualname = getattr(token_counter, '__qualname__', None) or type(token_counter).__qualname__
+        return f"{getattr(token_counter, '__module__', '')}.{qualname}"
+
+    @classmethod
+    def get_memory(cls, session_id:str, user_id:str, max_tokens: int, token_counter, include_system: bool, allow_partial: bool, start_on: str) -> 'Memory':
+        # Callers with another limit or token counter trim to a different window, so they are cached apart.
+        cache_key = (user_id, session_id, max_tokens, cls.counter_key(token_counter))
+        version = cls.get_version(user_id, session_id)
+        entry = history_cache.get(cache_key, version)
+
+        if entry is not None:
+            memory = cls(entry['history'], max_tokens, token_counter, include_system, allow_partial, start_on, messages=entry['messages'])
+        else:
+            message_history = SQLChatMessageHistory(session_id=session_id, connection=cls.get_engine(), table_name = user_id)
+            memory = cls(message_history, max_tokens, token_counter, include_system, allow_partial, start_on)
+            history_cache.set(cache_key, message_history, memory.messages, version)
+
+        memory.cache_key = cache_key
+        memory.version = version
+        # Opt-in: it embeds every aged-out exchange with the configured provider and loads the user's index each turn.
+        if os.getenv('LONG_TERM_MEMORY', 'false').lower() == 'true':
+            memory.long_term = LongTermMemory(
+                user_id,
+                k=int(os.getenv('LONG_TERM_MEMORY_K', 3)),
+                max_tokens=int(os.getenv('LONG_TERM_MEMORY_MAX_TOKENS', 400)),
+            )
+        return memory
@@ -0,0 +1,267 @@
+import os
+import json
+import glob
+import time
+import fcntl
+import atexit
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from collections import defaultdict
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Shared directory for multi-worker servers: each process writes its metrics there and any of them can serve the sum.
+METRICS_MULTIPROC_DIR = os.getenv('METRICS_MULTIPROC_DIR')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))
+
+
+class MetricsRegistry:
+    """
+    In-process counters, gauges and histograms keyed by metric name and a sorted tuple of labels.
+    """
+    def __init__(self):
+        self._counters : dict[tuple, float] = defaultdict(float)
+        self._gauges : dict[tuple, float] = defaultdict(float)
+        self._histograms : dict[tuple, dict] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return (name, tuple(sorted((key, str(value)) for key, value in labels.items())))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self._counters[self._key(name, labels)] += value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def add_gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] += value
+
+    def observe(self, name: str, value: float, buckets: tuple = DEFAULT_BUCKETS, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets' : buckets, 'counts' : [0] * (len(buckets) + 1), 'sum' : 0.0, 'count' : 0}
+            histogram['counts'][bisect_left(histogram['buckets'], value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'counters' : dict(self._counters),
+                'gauges' : dict(self._gauges),
+                'histograms' : {key : {**value, 'counts' : list(value['counts'])} for key, value in self._histograms.items()},
+            }
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+
+
+def merge_snapshots(snapshots: list[dict]) -> dict:
+    merged = {'counters' : defaultdict(float), 'gauges' : defaultdict(float), 'histograms' : {}}
+    for snapshot in snapshots:
+        for kind in ('counters', 'gauges'):
+            for key, value in snapshot.get(kind, {}).items():
+                merged[kind][key] += value
+        for key, histogram in snapshot['histograms'].items():
+            total = merged['histograms'].get(key)
+            if total is None:
+                merged['histograms'][key] = {**histogram, 'counts' : list(histogram['counts'])}
+            elif list(total['buckets']) == list(histogram['buckets']):
+                total['counts'] = [left + right for left, right in zip(total['counts'], histogram['counts'])]
+                total['sum'] += histogram['sum']
+                total['count'] += histogram['count']
+    return merged
+
+
+class MultiProcessCollector:
+    """
+    Every METRICS_FLUSH_INTERVAL seconds and at exit, the process writes its snapshot to <directory>/<pid>.json.
+    collect() adds the files of the other processes to the live snapshot of this one. Counters and histograms of
+    exited workers keep counting, as Prometheus expects of counters: collect() folds them into archive.json and
+    deletes the worker's file, so the directory does not grow with every restart. Their gauges are dropped.
+    """
+    ARCHIVE = 'archive.json'
+
+    def __init__(self, registry: MetricsRegistry, directory: str, interval: float = METRICS_FLUSH_INTERVAL):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self._stopped = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def encode(snapshot: dict) -> dict:
+        return {
+            kind : [[name, labels, value] for (name, labels), value in snapshot[kind].items()]
+            for kind in ('counters', 'gauges', 'histograms')
+        }
+
+    @staticmethod
+    def decode(data: dict) -> dict:
+        return {
+            kind : {(name, tuple(tuple(label) for label in labels)) : value for name, labels, value in data[kind]}
+            for kind in ('counters', 'gauges', 'histograms')
+        }
+
+    def path(self, pid: int) -> str:
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def flush(self):
+        path = self.path(os.getpid())
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as file:
+            json.dump(self.encode(self.registry.snapshot()), file)
+        os.replace(f"{path}.tmp", path)
+
+    @staticmethod
+    def alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    @contextmanager
+    def _locked(self, exclusive: bool):
+        """Archiving takes the directory's lock exclusively, so no collector reads a file it is about to delete."""
+        with open(os.path.join(self.directory, 'archive.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def read(self, path: str) -> dict | None:
+        try:
+            with open(path, encoding='utf-8') as file:
+                return self.decode(json.load(file))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning(f"Skipping metrics file {path}: {e}")
+            return None
+
+    def worker_files(self) -> dict[int, str]:
+        """The other processes' files by PID. Names that are not a PID, like the archive, are left out."""
+        files = {}
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            name = os.path.basename(path)[:-len('.json')]
+            if name.isdigit() and int(name) != os.getpid():
+                files[int(name)] = path
+        return files
+
+    def archive(self, paths: list[str]):
+        """Add the counters and histograms in `paths` to the archive and delete the files."""
+        archive_path = os.path.join(self.directory, self.ARCHIVE)
+        with self._locked(exclusive=True):
+            # Another collector may have archived some of them while this one waited for the lock.
+            snapshots = [(path, self.read(path)) for path in paths if os.path.exists(path)]
+            if not snapshots:
+                return
+            merged = merge_snapshots([self.read(archive_path) or {'histograms' : {}}, *(snapshot for _, snapshot in snapshots if snapshot)])
+            merged['gauges'] = {}
+            with open(f"{archive_path}.tmp", 'w', encoding='utf-8') as file:
+                json.dump(self.encode(merged), file)
+            os.replace(f"{archive_path}.tmp", archive_path)
+            for path, _ in snapshots:
+                os.remove(path)
+
+    def collect(self) -> dict:
+        exited = [path for pid, path in self.worker_files().items() if not self.alive(pid)]
+        if exited:
+            self.archive(exited)
+
+        snapshots = [self.registry.snapshot()]
+        with self._locked(exclusive=False):
+            archived = self.read(os.path.join(self.directory, self.ARCHIVE))
+            if archived is not None:
+                snapshots.append(archived)
+            for pid, path in self.worker_files().items():
+                snapshot = self.read(path)
+                if snapshot is None:
+                    continue
+                # Exited since the check above; it is archived on the next collect.
+                if not self.alive(pid):
+                    snapshot['gauges'] = {}
+                snapshots.append(snapshot)
+        return merge_snapshots(snapshots)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except OSError as e:
+                logging.warning(f"Metrics flush failed: {e}")
+
+    def start(self):
+        self._stopped = threading.Event()
+        threading.Thread(target=self._run, name='metrics-flush', daemon=True).start()
+
+    def restart_in_child(self):
+        # A worker forked from a server that loaded the app first inherits the parent's numbers but not its thread.
+        self.registry.clear()
+        self.start()
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def label_text(labels: tuple) -> str:
+    return ','.join(f'{key}="{escape_label(value)}"' for key, value in labels)
+
+
+def render(snapshot: dict) -> str:
+    """The snapshot in the Prometheus text exposition format."""
+    lines = []
+    families : dict[str, list] = defaultdict(list)
+    for kind, metric_type in (('counters', 'counter'), ('gauges', 'gauge'), ('histograms', 'histogram')):
+        for (name, labels), value in snapshot[kind].items():
+            families[(name, metric_type)].append((labels, value))
+    for (name, metric_type), series in sorted(families.items()):
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in sorted(series):
+            if metric_type != 'histogram':
+                lines.append(f"{name}{{{label_text(labels)}}} {value}" if labels else f"{name} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip([*value['buckets'], '+Inf'], value['counts']):
+                cumulative += count
+                lines.append(f"{name}_bucket{{{label_text((*labels, ('le', str(bound))))}}} {cumulative}")
+            suffix = f"{{{label_text(labels)}}}" if labels else ''
+            lines.append(f"{name}_sum{suffix} {value['sum']}")
+            lines.append(f"{name}_count{suffix} {value['count']}")
+    return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+collector = MultiProcessCollector(metrics, METRICS_MULTIPROC_DIR) if METRICS_MULTIPROC_DIR else None
+if collector is not None:
+    collector.start()
+    os.register_at_fork(after_in_child=collector.restart_in_child)
+    atexit.register(collector.flush)
+
+
+def metrics_text() -> str:
+    return render(collector.collect() if collector is not None else metrics.snapshot())
@@ -1,13 +1,28 @@
+import time
 import uuid
 import logging
-from langchain_groq import ChatGroq
-from langchain_core.messages import SystemMessage, HumanMessage, AIMessage, ToolMessage
-from langgraph.prebuilt import ToolNode
+from functools import partial, wraps
+from django.db import connection
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage, ToolMessage, message_chunk_to_message
+from langgraph.prebuilt import tools_condition
 from chats_app.models import Conversation
 from .memory import Memory
+from .registry import model_registry
+from .tool_executor import ToolExecutor, answered_calls, call_signature
+from .guardrails import FINAL_ANSWER_PROMPT, BUDGET_EXHAUSTED_TOOL_MESSAGE, exceeded_budget, record_budget_event, estimate_input_tokens
+from .compression import tool_output_compressor
+from .metrics import metrics
 from .schemas import WorkFlowState
-from .prompts import SYSTEM_PROMPT, SELF_DISCUSSION_PROMPT
-from .tools import calculator_tool, web_url_tool, duckduckgo_search_tool, wikipedia_search_tool, vector_db_search_tool
+from .prompts import SELF_DISCUSSION_PROMPT, system_messages
+from .tools import ALL_TOOLS
+from .tool_selection import select_tools
+from .speculation import RetrievalPrefetch, start_prefetch
+from .self_discussion import SELF_DISCUSSION_MODEL, decide, score_query, planning_latency
+from .router import AUTO_MODEL, model_router
+from .hedging import HEDGE_REQUESTS, HEDGE_TARGET, hedge
+from .scheduler import LLM_SCHEDULER, INTERACTIVE, SchedulerTimeout, Grant, llm_scheduler, estimate_request_tokens
+from .cassettes import open_cassette
+from .tracing import traced, span, instrument_model
 
 logging.basicConfig(
     level=logging.INFO,
@@ -21,6 +36,56 @@ def green_log(message: str):
     logging.info(f"{green}{message}{reset}")
 
 
+def timed(node_name: str):
+    """Record the node's wall-clock duration under `_timings` in the state update."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(state: WorkFlowState):
+            started = time.perf_counter()
+            update = func(state)
+            update['_timings'] = {node_name : round(time.perf_counter() - started, 4)}
+            return update
+        return wrapper
+    return decorator
+
+
+def schedule_model_call(state: WorkFlowState, model_name: str, messages: list) -> Grant | None:
+    """Wait for room in the shared provider budget; queue position updates go to the caller's stream writer."""
+    if not LLM_SCHEDULER:
+        return None
+    stream_writer = state.get('_stream_writer')
+    return llm_scheduler.acquire(
+        model_router.resolve(model_name),
+        state['user_id'],
+        estimate_request_tokens(messages),
+        priority=state.get('_priority', INTERACTIVE),
+        on_wait=(lambda queue: stream_writer({'queue' : queue})) if stream_writer else None,
+    )
+
+
+def settle_model_call(grant: Grant | None, model_name: str, response: AIMessage):
+    usage = getattr(response, 'usage_metadata', None) or {}
+    if grant is not None:
+        grant.settle(usage.get('total_tokens'))
+    if usage:
+        metrics.inc('llm_tokens_total', usage.get('input_tokens', 0), model=model_name, direction='input')
+        metrics.inc('llm_tokens_total', usage.get('output_tokens', 0), model=model_name, direction='output')
+
+
+def closes_db_connection(func):
+    """Nodes run on LangGraph's worker threads, whose Django connections nothing else would ever close."""
+    @wraps(func)
+    def wrapper(state: WorkFlowState):
+        try:
+            return func(state)
+        finally:
+            connection.close()
+    return wrapper
+
+
+@traced('init')
+@timed('init')
+@closes_db_connection
 def init_node(state: WorkFlowState):
     _verbose = state['_verbose']
     if _verbose:
@@ -42,18 +107,30 @@ def init_node(state: WorkFlowState):
     }
     
 
+@traced('load_tools')
+@timed('load_tools')
 def load_tools(state : WorkFlowState):
     _verbose = state['_verbose']
     if _verbose:
         green_log("🔧 Loading tools")
 
-    tools = [calculator_tool, web_url_tool, duckduckgo_search_tool, wikipedia_search_tool, vector_db_search_tool]
+    # Only the tools this request can use are bound, so unused schemas are not sent with every model call.
+    has_files = bool(state['_conversation_metadata'].get('uploaded_file_names'))
+    tools = select_tools(ALL_TOOLS, state['user_query'], state['pre_tools'], has_files)
+    metrics.observe('bound_tools', len(tools), buckets=(0, 1, 2, 3, 4, 5))
+
+    if _verbose:
+        green_log(f"🔧 Tools: {', '.join(tool.name for tool in tools) or 'none'}")
+
+    # With files attached the first tool call is almost always a Vector DB search, so it starts now and overlaps the model call.
     return {
-        'tools' : tools
+        'tools' : tools,
+        '_prefetch' : start_prefetch(state.get('vector_db'), state['user_query'], has_files)
     }
     
-    
-    
+
+@traced('load_model')
+@timed('load_model')
 def load_model(state : WorkFlowState):
     _verbose = state['_verbose']
     model_name = state['model_name']
@@ -62,38 +139,91 @@ def load_model(state : WorkFlowState):
         green_log(f"🧠 Loading model: {model_name}")
 
     tools = state['tools']
-    model = ChatGroq(model = model_name)
-    model = model.bind_tools(tools)
+    # "Auto" binds the router's default here; build_context picks the real model once the context size is known.
+    model = model_registry.get_model(model_router.resolve(model_name), tools)
     return {
         'model' : model
     }
     
 
+@traced('load_memory')
+@timed('load_memory')
 def load_memory(state: WorkFlowState):
     _verbose = state['_verbose']
     if _verbose:
         green_log(f"🧠 Loading memory")
 
     conversation_id = state['conversation_id']
-    _conversation_metadata = state['_conversation_metadata']
-    uploaded_file_names = _conversation_metadata.get('uploaded_file_names', [])
     user_id = state['user_id']
-    model = state['model']
-    response_mode = state['response_mode']
-    pre_tools = state['pre_tools']
-    memory : Memory = Memory.get_memory(conversation_id, user_id, 7000, model, True, False, 'human')
-    system_prompt = SystemMessage(content=SYSTEM_PROMPT.format(response_mode = response_mode, pre_tools = pre_tools, uploaded_file_names = ', '.join(uploaded_file_names)))
-    
+    # The unbound chat model is only used for token counting, so this branch does not wait on load_model.
+    token_counter = model_registry.get_chat_model(model_router.resolve(state['model_name']))
+    memory : Memory = Memory.get_memory(conversation_id, user_id, 7000, token_counter, True, False, 'human')
+    recalled_context = memory.recall(state['user_query'])
+    metrics.observe('memory_history_messages', len(memory.messages), buckets=(0, 2, 5, 10, 20, 50, 100))
+    metrics.observe('memory_history_tokens', sum(len(str(message.content)) for message in memory.messages) // 4, buckets=(0, 250, 500, 1000, 2000, 4000, 7000))
+
     if _verbose:
         green_log("🧠 Memory loaded")
-    
-    memory_messages = [system_prompt, *memory.messages]
+
     return {
         'memory' : memory,
-        'memory_messages' : memory_messages
+        'recalled_context' : recalled_context
+    }
+
+
+@traced('build_context')
+def build_context(state: WorkFlowState):
+    _verbose = state['_verbose']
+    if _verbose:
+        green_log(f"🧩 Prelude finished in {state['_timings']}")
+
+    _conversation_metadata = state['_conversation_metadata']
+    _conversation_metadata['timings'] = dict(state['_timings'])
+    uploaded_file_names = _conversation_metadata.get('uploaded_file_names', [])
+    response_mode = state['response_mode']
+    pre_tools = state['pre_tools']
+    memory : Memory = state['memory']
+    system_prompt, system_config = system_messages(response_mode, pre_tools, uploaded_file_names)
+
+    # Everything that changes from turn to turn goes after the history, so the prompt prefix stays cacheable.
+    memory_messages = [system_prompt, *memory.messages, system_config]
+    recalled_context = state.get('recalled_context')
+    if recalled_context:
+        memory_messages.append(SystemMessage(content=f"Relevant earlier exchanges with this user:\n\n{recalled_context}"))
+    prefetch : RetrievalPrefetch | None = state.get('_prefetch')
+    prefetched_context = prefetch.inject() if prefetch is not None else None
+    if prefetched_context:
+        memory_messages.append(SystemMessage(content=f"Relevant excerpts from the uploaded files for the user's question:\n\n{prefetched_context}"))
+
+    # "auto" self-discussion only spends the extra planning call on queries that look like they need it.
+    decision = decide(state['self_discussion'], state['user_query'], bool(uploaded_file_names), state['tools'], pre_tools)
+    if decision['mode'] == 'auto' and not decision['plan']:
+        decision['estimated_seconds_saved'] = round(planning_latency.value, 3)
+    _conversation_metadata['self_discussion'] = decision
+    if _verbose and decision['mode'] == 'auto':
+        green_log(f"💬 Self-discussion {'on' if decision['plan'] else 'skipped'} (score {decision['score']}: {', '.join(decision['reasons']) or 'simple'})")
+
+    update = {
+        'memory_messages' : memory_messages,
+        'self_discussion' : decision['plan']
     }
+    if state.get('_cassette') is None:
+        cassette = open_cassette(state, memory.messages)
+        if cassette is not None:
+            update['_cassette'] = cassette
+    if state['model_name'] == AUTO_MODEL:
+        score, _ = score_query(state['user_query'], bool(uploaded_file_names), state['tools'], pre_tools)
+        context_tokens = (sum(len(str(message.content)) for message in memory_messages) + len(state['user_query'])) // 4
+        candidates, routing = model_router.route(score, context_tokens)
+        _conversation_metadata['routing'] = routing
+        if _verbose:
+            green_log(f"🧭 Routed to {candidates[0]} ({routing['reason']}, score {score}, {context_tokens} context tokens)")
+        update['model'] = model_registry.get_model(candidates[0], state['tools'])
+        update['_model_candidates'] = candidates
+    return update
     
 
+@traced('call_self_discussion')
 def call_self_discussion(state: WorkFlowState):
     _verbose = state['_verbose']
     if _verbose:
@@ -103,11 +233,28 @@ def call_self_discussion(state: WorkFlowState):
     _conversation_metadata = state['_conversation_metadata']
     uploaded_file_names = _conversation_metadata.get('uploaded_file_names', [])
     model = state['model']
+    if SELF_DISCUSSION_MODEL:
+        # Planning never calls tools, so a smaller unbound model can do it.
+        model = model_registry.get_chat_model(SELF_DISCUSSION_MODEL)
     response_mode = state['response_mode']
     pre_tools = state['pre_tools']
     self_discussion_prompt = SELF_DISCUSSION_PROMPT.format(user_query = user_message, response_mode = response_mode, pre_tools = pre_tools, uploaded_file_names = ', '.join(uploaded_file_names))
     messages = [user_message, HumanMessage(content=self_discussion_prompt)]    
-    response : AIMessage = model.invoke(messages)
+    cassette = state.get('_cassette')
+    if cassette is not None:
+        model = cassette.wrap_model(model, SELF_DISCUSSION_MODEL or state['model_name'])
+    planning_model = SELF_DISCUSSION_MODEL or (state.get('_model_candidates') or [state['model_name']])[0]
+    grant = schedule_model_call(state, planning_model, messages)
+    started = time.perf_counter()
+    with span('model', model=SELF_DISCUSSION_MODEL or state['model_name'], purpose='self_discussion', scheduler_wait=grant.waited if grant else None):
+        response : AIMessage = instrument_model(model).invoke(messages)
+    settle_model_call(grant, planning_model, response)
+    planning_seconds = time.perf_counter() - started
+    planning_latency.observe(planning_seconds)
+    _conversation_metadata.setdefault('self_discussion', {}).update({
+        'planning_seconds' : round(planning_seconds, 3),
+        'planning_model' : SELF_DISCUSSION_MODEL or state['model_name']
+    })
     response : ToolMessage = ToolMessage(content=response.content, tool_name='self_discussion', tool_call_id= str(uuid.uuid4()))
     
     return {
@@ -116,6 +263,7 @@ def call_self_discussion(state: WorkFlowState):
     }
     
 
+@traced('call_model')
 def call_model(state: WorkFlowState):
     _verbose = state['_verbose']
     if _verbose:
@@ -125,21 +273,150 @@ def call_model(state: WorkFlowState):
     messages = state['messages']
     memory_messages = state['memory_messages']
     messages = [*memory_messages, *messages]
-    response : AIMessage = model.invoke(messages)
+    force_final_answer = state.get('_force_final_answer', False)
+    if force_final_answer:
+        messages.append(SystemMessage(content=FINAL_ANSWER_PROMPT))
+
+    # Routed turns fall back to the next model in the pool when a call fails; the outcome feeds the router's health stats.
+    candidates = state.get('_model_candidates') or [state['model_name']]
+    for index, model_name in enumerate(candidates):
+        if index:
+            model = model_registry.get_model(model_name, state['tools'])
+            metrics.inc('router_fallbacks_total', model=model_name)
+            state['_conversation_metadata'].setdefault('routing', {})['fallback'] = model_name
+        if force_final_answer:
+            # The final answer after a budget stop is generated without tools, so the loop cannot continue.
+            model = getattr(model, 'bound', model)
+        if HEDGE_REQUESTS:
+            backup_name = candidates[index + 1] if HEDGE_TARGET == 'fallback' and index + 1 < len(candidates) else model_name
+            backup = model if backup_name == model_name else model_registry.get_model(backup_name, [] if force_final_answer else state['tools'])
+            model = hedge(model, model_name, backup, backup_name)
+        cassette = state.get('_cassette')
+        if cassette is not None:
+            model = cassette.wrap_model(model, model_name)
+        try:
+            grant = schedule_model_call(state, model_name, messages)
+        except SchedulerTimeout as e:
+            # Out of provider capacity is not a model failure, so it does not count against the model's health.
+            if index == len(candidates) - 1:
+                raise
+            logging.warning(f"{e}, falling back")
+            continue
+        started = time.perf_counter()
+        # Every chunk reaches the client as soon as the model yields it, so once one has, another model's answer
+        # would be appended to the partial one; only a call that failed before its first chunk falls back.
+        response = None
+        try:
+            with span('model', model=model_name, attempt=index, scheduler_wait=grant.waited if grant else None):
+                for chunk in instrument_model(model).stream(messages):
+                    response = chunk if response is None else response + chunk
+            if response is None:
+                raise ValueError(f"Model {model_name} returned no output")
+        except Exception as e:
+            model_router.record(model_name, time.perf_counter() - started, ok=False)
+            # Refund the estimate unless the partial response reported what the call used.
+            if grant is not None:
+                grant.settle((getattr(response, 'usage_metadata', None) or {}).get('total_tokens', 0))
+            if response is not None or index == len(candidates) - 1:
+                raise
+            logging.warning(f"Model {model_name} failed, falling back: {e}")
+            continue
+        response : AIMessage = message_chunk_to_message(response)
+        model_router.record(model_name, time.perf_counter() - started, ok=True)
+        settle_model_call(grant, model_name, response)
+        break
     return {
         'messages' : [response],
-        'new_messages' : [response]
+        'new_messages' : [response],
+        '_input_tokens' : state.get('_input_tokens', 0) + estimate_input_tokens(messages, response)
+    }
+
+
+def route_model_output(state: WorkFlowState) -> str:
+    if tools_condition(state) != 'tools' or state.get('_force_final_answer'):
+        return '__end__'
+    if exceeded_budget(state) is not None:
+        return 'budget_exhausted'
+    return 'tools'
+
+
+@traced('stop_tool_loop')
+def stop_tool_loop(state: WorkFlowState) -> dict:
+    event = exceeded_budget(state)
+    record_budget_event(state, event)
+    if state['_verbose']:
+        green_log(f"⛔ Turn {event['type']} budget reached ({event['value']}/{event['limit']}), asking for a final answer")
+
+    # Every pending tool call still needs a result before the model can be called again.
+    budget = 'tool iteration' if event['type'] == 'tool_iterations' else 'input token'
+    tool_messages = [
+        ToolMessage(BUDGET_EXHAUSTED_TOOL_MESSAGE.format(name=tool_call['name'], budget=budget), name=tool_call['name'], tool_call_id=tool_call['id'], status='error')
+        for tool_call in state['messages'][-1].tool_calls
+    ]
+    return {
+        'messages' : tool_messages,
+        '_force_final_answer' : True
     }
     
 
+@traced('tool_node')
 def tool_node(state: WorkFlowState) -> dict:
     _verbose = state['_verbose']
     if _verbose:
         green_log("🔧 Calling tool node")
 
-    return ToolNode(tools=state['tools'], handle_tool_errors = True)
+    started = time.perf_counter()
+    # Calls the model already made this turn with a result; repeating one is answered without running the tool again.
+    previous_calls = answered_calls(state['messages'][:-1])
+    executor = ToolExecutor(tools=state['tools'])
+    tool_messages = executor.run(state['messages'][-1], state, spent=state.get('_tool_seconds', 0.0), previous_calls=previous_calls)
+    repeated = sum(call_signature(tool_call) in previous_calls for tool_call in state['messages'][-1].tool_calls)
+    if repeated:
+        record_budget_event(state, {'type' : 'repeated_tool_calls', 'value' : repeated, 'limit' : 0})
+    return {
+        'messages' : tool_messages,
+        '_tool_seconds' : state.get('_tool_seconds', 0.0) + time.perf_counter() - started,
+        '_tool_iterations' : state.get('_tool_iterations', 0) + 1
+    }
 
 
+@traced('compress_tool_outputs')
+def compress_tool_outputs(state: WorkFlowState) -> dict:
+    _verbose = state['_verbose']
+    messages = state['messages']
+    tool_messages = []
+    for message in reversed(messages):
+        if not isinstance(message, ToolMessage):
+            break
+        tool_messages.insert(0, message)
+    if not tool_messages:
+        return {}
+
+    # Each output is ranked against the user's question and the arguments the model called the tool with.
+    queries = {}
+    calling_message = messages[-len(tool_messages) - 1]
+    for tool_call in getattr(calling_message, 'tool_calls', []):
+        arguments = ' '.join(str(value) for value in tool_call['args'].values() if isinstance(value, str))
+        queries[tool_call['id']] = f"{state['user_query']} {arguments}"
+
+    compressed, stats = tool_output_compressor.compress(tool_messages, queries, spent=state.get('_tool_tokens', 0))
+    metrics.inc('tool_output_tokens_saved_total', stats.tokens_saved)
+
+    _conversation_metadata = state['_conversation_metadata']
+    totals = _conversation_metadata.setdefault('tool_compression', {'tokens_before' : 0, 'tokens_after' : 0, 'tokens_saved' : 0, 'compressed' : 0})
+    for key, value in stats.as_dict().items():
+        totals[key] += value
+    if _verbose:
+        green_log(f"🗜️ Tool outputs compressed from {stats.tokens_before} to {stats.tokens_after} tokens")
+
+    # Messages keep their ids, so add_messages replaces the raw outputs in place.
+    return {
+        'messages' : [message for message, original in zip(compressed, tool_messages) if message is not original],
+        '_tool_tokens' : state.get('_tool_tokens', 0) + stats.tokens_after
+    }
+
+
+@traced('pick_tool_messages')
 def pick_tool_messages(state: WorkFlowState):
     _verbose = state['_verbose']
     if _verbose:
@@ -160,16 +437,25 @@ def pick_tool_messages(state: WorkFlowState):
     }
 
 
+@traced('save_messages_to_memory')
 def save_messages_to_memory(state: WorkFlowState):
     _verbose = state['_verbose']
     if _verbose:
         green_log("💾 Saving messages to memory.")
     
-    memory = state['memory']
-    new_messages = state['new_messages']
-    
-    for message in new_messages:
-        memory.add_message(message)    
+    memory : Memory = state['memory']
+    new_messages = list(state['new_messages'])
+    _post_stream_tasks = state.get('_post_stream_tasks')
+
+    # Defer the write until the client has received its final event when the caller collects post-stream tasks.
+    if _post_stream_tasks is not None:
+        _post_stream_tasks.append(partial(memory.add_messages, new_messages))
+    else:
+        memory.add_messages(new_messages)
+
+    cassette = state.get('_cassette')
+    if cassette is not None:
+        cassette.close({'input_tokens' : state.get('_input_tokens', 0), 'tool_iterations' : state.get('_tool_iterations', 0), 'new_messages' : len(new_messages)})
     
     return {
         'new_messages' : []
@@ -0,0 +1,143 @@
+"""
+Offline benchmark of prompt assembly for provider-side prefix caching.
+
+Replays a synthetic conversation and compares the inline layout, where the turn's configuration and recalled memory
+sit at the top of the prompt, with the split layout used by build_context: static system prompt, history, then the
+configuration block and the per-turn context. For every turn it measures the prompt size and how many leading bytes
+are identical to the previous turn's prompt, which is the part a provider prefix cache can reuse. History is trimmed
+to the last `--history-tokens` tokens the way Memory trims it in load_memory, and once the oldest messages start
+falling out the stable prefix is reported again for those turns alone. No provider calls are made.
+
+    python -m workflow_graphs.bujji.prompt_benchmark --turns 60 --upload-every 8 --mode-change-every 15
+"""
+import sys
+import time
+import random
+import argparse
+from langchain_core.messages import BaseMessage, SystemMessage, HumanMessage, AIMessage, trim_messages
+from .fakes import ScriptedChatModel
+from .prompts import SYSTEM_PROMPT, SYSTEM_CONFIG_PROMPT, system_messages, _render_system_config
+
+RESPONSE_MODES = ["Auto", "Casual", "Scientific", "Story", "Kids"]
+# load_memory keeps this many tokens of history.
+HISTORY_TOKENS = 7000
+
+
+def inline_messages(response_mode: str, pre_tools: list[str], uploaded_file_names: list[str], history: list[BaseMessage], recalled_context: str) -> list[BaseMessage]:
+    """The layout before the split: one system prompt formatted with the config, recalled memory right after it."""
+    config = SYSTEM_CONFIG_PROMPT.format(response_mode = response_mode, pre_tools = ', '.join(pre_tools) or 'No Tool', uploaded_file_names = ', '.join(uploaded_file_names) or 'None')
+    messages = [SystemMessage(content=SYSTEM_PROMPT + config), *history]
+    if recalled_context:
+        messages.insert(1, SystemMessage(content=f"Relevant earlier exchanges with this user:\n\n{recalled_context}"))
+    return messages
+
+
+def split_messages(response_mode: str, pre_tools: list[str], uploaded_file_names: list[str], history: list[BaseMessage], recalled_context: str) -> list[BaseMessage]:
+    system_prompt, system_config = system_messages(response_mode, pre_tools, uploaded_file_names)
+    messages = [system_prompt, *history, system_config]
+    if recalled_context:
+        messages.append(SystemMessage(content=f"Relevant earlier exchanges with this user:\n\n{recalled_context}"))
+    return messages
+
+
+LAYOUTS = {'inline' : inline_messages, 'split' : split_messages}
+
+
+def serialize(messages: list[BaseMessage]) -> bytes:
+    """Roughly what a chat completion request carries, in order."""
+    return ''.join(f"<{message.type}>\n{message.content}\n" for message in messages).encode()
+
+
+def common_prefix(left: bytes, right: bytes) -> int:
+    size = min(len(left), len(right))
+    low, high = 0, size
+    # Binary search on slice equality is much faster in Python than comparing byte by byte.
+    while low < high:
+        middle = (low + high + 1) // 2
+        if left[:middle] == right[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def build_conversation(rng: random.Random, turns: int, upload_every: int, mode_change_every: int, recall_rate: float) -> list[dict]:
+    """Per-turn config, query, answer and recalled memory for a conversation of `turns` turns."""
+    response_mode, uploaded_file_names, conversation = "Auto", [], []
+    for turn in range(turns):
+        if upload_every and turn and turn % upload_every == 0:
+            uploaded_file_names = [*uploaded_file_names, f"report_{turn}.pdf"]
+        if mode_change_every and turn and turn % mode_change_every == 0:
+            response_mode = rng.choice([mode for mode in RESPONSE_MODES if mode != response_mode])
+        recalled_context = ""
+        if rng.random() < recall_rate:
+            recalled_context = f"User: earlier question {rng.randrange(1000)}\nAI: " + "earlier answer " * rng.randint(10, 40)
+        conversation.append({
+            'response_mode' : response_mode,
+            'pre_tools' : [],
+            'uploaded_file_names' : uploaded_file_names,
+            'query' : f"Question {turn}: " + "word " * rng.randint(5, 40),
+            'answer' : "Answer " + "token " * rng.randint(40, 300),
+            'recalled_context' : recalled_context,
+        })
+    return conversation
+
+
+def history_trimmer(max_tokens: int):
+    """The trimmer Memory.get_memory builds, counting tokens at four characters each like the offline models."""
+    return trim_messages(max_tokens=max_tokens, strategy='last', token_counter=ScriptedChatModel(), include_system=True, allow_partial=False, start_on='human')
+
+
+def run(layout: str, conversation: list[dict], history_tokens: int = HISTORY_TOKENS) -> dict:
+    assemble = LAYOUTS[layout]
+    trimmer = history_trimmer(history_tokens)
+    history : list[BaseMessage] = []
+    previous, sizes, reused, assembly_seconds = b"", [], [], 0.0
+    # Index into sizes/reused of the first comparison made after the history window started dropping messages.
+    trimmed_from = None
+    for turn in conversation:
+        started = time.perf_counter()
+        messages = assemble(turn['response_mode'], turn['pre_tools'], turn['uploaded_file_names'], history, turn['recalled_context'])
+        assembly_seconds += time.perf_counter() - started
+        prompt = serialize([*messages, HumanMessage(content=turn['query'])])
+        if previous:
+            sizes.append(len(prompt))
+            reused.append(common_prefix(previous, prompt))
+        previous = prompt
+        window = [*history, HumanMessage(content=turn['query']), AIMessage(content=turn['answer'])]
+        history = trimmer.invoke(window)
+        if trimmed_from is None and len(history) < len(window):
+            trimmed_from = len(sizes)
+
+    return {
+        'layout' : layout,
+        'bytes' : sum(sizes) / len(sizes) if sizes else 0,
+        'stable_prefix' : sum(reused) / sum(sizes) if sizes else 0,
+        'reused' : sum(reused) / len(reused) if reused else 0,
+        'trimmed_turns' : len(sizes) - trimmed_from if trimmed_from is not None else 0,
+        'stable_prefix_trimmed' : sum(reused[trimmed_from:]) / sum(sizes[trimmed_from:]) if trimmed_from is not None and sizes[trimmed_from:] else None,
+        'assembly_us' : assembly_seconds / len(conversation) * 1e6,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare prompt layouts on prefix stability across consecutive turns.")
+    parser.add_argument('--turns', type=int, default=60)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--upload-every', type=int, default=8, help="a file is uploaded every N turns, 0 for never")
+    parser.add_argument('--mode-change-every', type=int, default=15, help="the response mode changes every N turns, 0 for never")
+    parser.add_argument('--recall-rate', type=float, default=0.5, help="share of turns with recalled long-term memory")
+    parser.add_argument('--history-tokens', type=int, default=HISTORY_TOKENS, help="history window, as trimmed by Memory")
+    args = parser.parse_args()
+
+    conversation = build_conversation(random.Random(args.seed), args.turns, args.upload_every, args.mode_change_every, args.recall_rate)
+    _render_system_config.cache_clear()
+    sys.stdout.write(f"{'layout':<10}{'bytes/turn':>12}{'stable prefix':>15}{'reused/turn':>13}{'assembly µs':>13}{'trimmed turns':>15}{'stable after trim':>19}\n")
+    for layout in LAYOUTS:
+        result = run(layout, conversation, args.history_tokens)
+        after_trim = f"{result['stable_prefix_trimmed']:.1%}" if result['stable_prefix_trimmed'] is not None else "-"
+        sys.stdout.write(
+            f"{result['layout']:<10}{result['bytes']:>12.0f}{result['stable_prefix']:>15.1%}"
+            f"{result['reused']:>13.0f}{result['assembly_us']:>13.1f}{result['trimmed_turns']:>15}{after_trim:>19}\n"
+        )
+    sys.stdout.write(f"config cache: {_render_system_config.cache_info()}\n")
@@ -1,5 +1,7 @@
+import os
+from functools import lru_cache
 from langchain_core.messages import SystemMessage
-from typing import Final
+from typing import Final, Sequence
 
 
 SYSTEM_PROMPT = """
@@ -66,10 +68,16 @@ Never mention the mode name. Apply tone implicitly.
 
 You are ChargeGPT – always charged, helpful, and context-aware.
 
-Response Mode: {response_mode}  
-Pre-Tools: {pre_tools}  
-Uploaded Files: {uploaded_file_names}
+The configuration for the current turn is given in a later system message.
+"""
+
+# Kept out of SYSTEM_PROMPT so the system prompt and the conversation history form a prefix that stays byte-identical
+# across turns, which is what provider-side prompt caching matches on.
+SYSTEM_CONFIG_PROMPT = """⚙️ Current Configuration
 
+Response Mode: {response_mode}
+Pre-Tools: {pre_tools}
+Uploaded Files: {uploaded_file_names}
 """
 
 SELF_DISCUSSION_PROMPT = """
@@ -103,4 +111,21 @@ User Query : {user_query}
 Response Mode : {response_mode}  
 Pre-Tools : {pre_tools}  
 Uploaded Files : {uploaded_file_names}
-"""
\ No newline at end of file
+"""
+
+@lru_cache(maxsize=int(os.getenv('SYSTEM_CONFIG_CACHE_SIZE', 512)))
+def _render_system_config(response_mode: str, pre_tools: tuple[str, ...], uploaded_file_names: tuple[str, ...]) -> str:
+    return SYSTEM_CONFIG_PROMPT.format(
+        response_mode = response_mode,
+        pre_tools = ', '.join(pre_tools) or 'No Tool',
+        uploaded_file_names = ', '.join(uploaded_file_names) or 'None'
+    )
+
+
+def system_messages(response_mode: str, pre_tools: Sequence[str], uploaded_file_names: Sequence[str]) -> tuple[SystemMessage, SystemMessage]:
+    """
+    The static system prompt and the turn's configuration block. The first goes before the history and never changes;
+    the second goes after it. The rendered block is cached per configuration.
+    """
+    config = _render_system_config(response_mode, tuple(pre_tools), tuple(uploaded_file_names))
+    return SystemMessage(content=SYSTEM_PROMPT), SystemMessage(content=config)
@@ -0,0 +1,3 @@
+def merge_dicts(left: dict | None, right: dict | None) -> dict:
+    """Shallow-merge updates so parallel branches can each write their own keys."""
+    return {**(left or {}), **(right or {})}
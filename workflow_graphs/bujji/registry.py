@@ -0,0 +1,78 @@
+import os
+import logging
+import threading
+import httpx
+from typing import Sequence
+from langchain_groq import ChatGroq
+from langchain_core.runnables import Runnable
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.tools import BaseTool
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of chat models and their tool bindings.
+    Every model shares one pooled HTTP client so keep-alive connections to the provider survive across requests.
+    """
+    def __init__(self):
+        self._chat_models : dict[str, ChatGroq] = {}
+        self._bound_models : dict[tuple, Runnable] = {}
+        self._http_client : httpx.Client | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def http_client(self) -> httpx.Client:
+        if self._http_client is None:
+            self._http_client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=int(os.getenv('LLM_HTTP_MAX_CONNECTIONS', 50)),
+                    max_keepalive_connections=int(os.getenv('LLM_HTTP_MAX_KEEPALIVE', 20)),
+                    keepalive_expiry=60,
+                ),
+                timeout=httpx.Timeout(60, connect=5),
+            )
+        return self._http_client
+
+    @staticmethod
+    def tools_signature(tools: Sequence[BaseTool]) -> tuple[str, ...]:
+        return tuple(tool.name for tool in tools)
+
+    def get_chat_model(self, model_name: str) -> ChatGroq:
+        with self._lock:
+            if model_name not in self._chat_models:
+                self._chat_models[model_name] = ChatGroq(model=model_name, http_client=self.http_client)
+            return self._chat_models[model_name]
+
+    def register(self, model_name: str, model: BaseChatModel):
+        """Serve `model` for `model_name`, e.g. a fakes.ScriptedChatModel in tests and benchmarks."""
+        with self._lock:
+            self._chat_models[model_name] = model
+            for key in [key for key in self._bound_models if key[0] == model_name]:
+                del self._bound_models[key]
+
+    def get_model(self, model_name: str, tools: Sequence[BaseTool]) -> Runnable:
+        # Requests that need no tools get the plain chat model instead of a binding with an empty tool list.
+        if not tools:
+            return self.get_chat_model(model_name)
+        key = (model_name, self.tools_signature(tools))
+        model = self._bound_models.get(key)
+        if model is None:
+            model = self.get_chat_model(model_name).bind_tools(tools)
+            with self._lock:
+                model = self._bound_models.setdefault(key, model)
+        return model
+
+    def warm(self, model_names: Sequence[str], tools: Sequence[BaseTool]):
+        for model_name in model_names:
+            try:
+                self.get_model(model_name, tools)
+            except Exception as e:
+                logging.warning(f"Failed to warm model {model_name}: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._chat_models.clear()
+            self._bound_models.clear()
+
+
+model_registry = ModelRegistry()
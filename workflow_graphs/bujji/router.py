@@ -0,0 +1,149 @@
+import os
+import json
+import math
+import time
+import threading
+from collections import deque
+from dataclasses import dataclass
+from .metrics import metrics
+
+AUTO_MODEL = 'Auto'
+
+
+@dataclass(frozen=True)
+class ModelProfile:
+    name : str
+    quality : int # 1 (fast, simple questions) to 3 (strongest)
+    context_window : int # tokens
+    cost : float # relative price per token, only used to order equally capable models
+
+
+# Override with ROUTER_MODEL_POOL='[{"name": ..., "quality": ..., "context_window": ..., "cost": ...}, ...]'
+DEFAULT_MODEL_POOL = [
+    ModelProfile('llama-3.1-8b-instant', quality=1, context_window=128_000, cost=0.05),
+    ModelProfile('gemma2-9b-it', quality=2, context_window=8_192, cost=0.2),
+    ModelProfile('llama-3.3-70b-versatile', quality=3, context_window=128_000, cost=0.6),
+]
+ROUTER_MAX_P95 = float(os.getenv('ROUTER_MAX_P95', 20))
+ROUTER_MAX_ERROR_RATE = float(os.getenv('ROUTER_MAX_ERROR_RATE', 0.25))
+# Tokens kept free in the context window for tool results and the answer.
+ROUTER_CONTEXT_RESERVE = int(os.getenv('ROUTER_CONTEXT_RESERVE', 2048))
+# Seconds a latency or error sample counts towards a model's health.
+ROUTER_HEALTH_MAX_AGE = float(os.getenv('ROUTER_HEALTH_MAX_AGE', 300))
+
+
+def load_model_pool() -> list[ModelProfile]:
+    pool = os.getenv('ROUTER_MODEL_POOL')
+    if not pool:
+        return list(DEFAULT_MODEL_POOL)
+    return [ModelProfile(**profile) for profile in json.loads(pool)]
+
+
+class ModelHealth:
+    """
+    Latency and outcome of the last `window` calls to one model within the last `max_age` seconds.
+    Old samples expire, so a model that stopped getting traffic after degrading is tried again later.
+    """
+    def __init__(self, window: int = 100, min_samples: int = 5, max_age: float = 300, clock=time.monotonic):
+        self.min_samples = min_samples
+        self.max_age = max_age
+        self.clock = clock
+        self.samples : deque[tuple[float, float, bool]] = deque(maxlen=window)
+
+    def record(self, seconds: float, ok: bool):
+        self.samples.append((self.clock(), seconds, ok))
+
+    def _recent(self) -> list[tuple[float, float, bool]]:
+        cutoff = self.clock() - self.max_age
+        while self.samples and self.samples[0][0] < cutoff:
+            self.samples.popleft()
+        return list(self.samples)
+
+    @property
+    def p95(self) -> float | None:
+        latencies = sorted(seconds for _, seconds, ok in self._recent() if ok)
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, math.ceil(0.95 * len(latencies)) - 1)]
+
+    @property
+    def error_rate(self) -> float:
+        samples = self._recent()
+        if len(samples) < self.min_samples:
+            return 0.0
+        return sum(not ok for _, _, ok in samples) / len(samples)
+
+    def degraded(self, max_p95: float, max_error_rate: float) -> bool:
+        p95 = self.p95
+        return self.error_rate > max_error_rate or (p95 is not None and p95 > max_p95)
+
+
+def required_quality(score: int) -> int:
+    """Map the local query score (see self_discussion.score_query) to the model quality it needs."""
+    if score <= 0:
+        return 1
+    if score <= 2:
+        return 2
+    return 3
+
+
+class ModelRouter:
+    """
+    Picks a model for model_name="Auto" from a configured pool.
+    Models that cannot fit the context or whose recent p95 latency or error rate is over the limits are skipped;
+    of the rest, the cheapest one that meets the quality the query needs wins. The remaining models, best first,
+    are returned as fallbacks for call_model.
+    """
+    def __init__(self, pool: list[ModelProfile], max_p95: float = ROUTER_MAX_P95, max_error_rate: float = ROUTER_MAX_ERROR_RATE, context_reserve: int = ROUTER_CONTEXT_RESERVE, health_max_age: float = ROUTER_HEALTH_MAX_AGE, clock=time.monotonic):
+        self.pool = pool
+        self.max_p95 = max_p95
+        self.max_error_rate = max_error_rate
+        self.context_reserve = context_reserve
+        self.health = {profile.name : ModelHealth(max_age=health_max_age, clock=clock) for profile in pool}
+        self._lock = threading.Lock()
+
+    @property
+    def default_model(self) -> str:
+        return min(self.pool, key=lambda profile: (abs(profile.quality - 2), profile.cost)).name
+
+    def resolve(self, model_name: str) -> str:
+        """The concrete model behind `model_name` before routing, e.g. for token counting."""
+        return self.default_model if model_name == AUTO_MODEL else model_name
+
+    def record(self, model_name: str, seconds: float, ok: bool):
+        # Model names come from request bodies, so only the pool's get their own health entry and metric label.
+        health = self.health.get(model_name)
+        metrics.observe('llm_call_seconds', seconds, model=model_name if health is not None else 'other', status='ok' if ok else 'error')
+        if health is None:
+            return
+        with self._lock:
+            health.record(seconds, ok)
+
+    def route(self, score: int, context_tokens: int) -> tuple[list[str], dict]:
+        quality = required_quality(score)
+        needed = context_tokens + self.context_reserve
+        with self._lock:
+            degraded = {profile.name for profile in self.pool if self.health[profile.name].degraded(self.max_p95, self.max_error_rate)}
+            error_rates = {profile.name : self.health[profile.name].error_rate for profile in self.pool}
+
+        fits = [profile for profile in self.pool if profile.context_window >= needed] or sorted(self.pool, key=lambda profile: -profile.context_window)[:1]
+        healthy = [profile for profile in fits if profile.name not in degraded]
+        capable = [profile for profile in healthy if profile.quality >= quality]
+        if capable:
+            chosen, reason = min(capable, key=lambda profile: (profile.quality, profile.cost)), 'cheapest_capable'
+        elif healthy:
+            chosen, reason = max(healthy, key=lambda profile: (profile.quality, -profile.cost)), 'best_healthy'
+        else:
+            # Everything is degraded: take the model that fails least and keep the rest as fallbacks.
+            chosen, reason = min(fits, key=lambda profile: (error_rates[profile.name], -profile.quality)), 'least_degraded'
+
+        fallbacks = sorted(
+            (profile for profile in fits if profile is not chosen),
+            key=lambda profile: (profile.name in degraded, -min(profile.quality, quality), profile.cost),
+        )
+        metrics.inc('router_decisions_total', model=chosen.name, reason=reason)
+        decision = {'model' : chosen.name, 'reason' : reason, 'score' : score, 'required_quality' : quality, 'context_tokens' : context_tokens, 'degraded' : sorted(degraded)}
+        return [chosen.name, *(profile.name for profile in fallbacks)], decision
+
+
+model_router = ModelRouter(load_model_pool())
@@ -0,0 +1,142 @@
+"""
+Offline simulation of routing policies for model_name="Auto".
+
+Replays a synthetic workload against simulated models (log-normal latency, error bursts) and compares the
+router with fixed-model policies on success rate, latency, quality shortfall and relative cost. No provider
+calls are made.
+
+    python -m workflow_graphs.bujji.router_simulation --requests 5000 --degrade llama-3.3-70b-versatile:0.3:0.6
+"""
+import sys
+import math
+import random
+import argparse
+from dataclasses import dataclass, field
+from .router import ModelRouter, ModelProfile, load_model_pool, required_quality
+
+
+@dataclass
+class SimulatedModel:
+    profile : ModelProfile
+    median_latency : float
+    sigma : float = 0.35
+    error_rate : float = 0.01
+    # (start, end, error_rate, latency_factor) as fractions of the run
+    degradations : list[tuple[float, float, float, float]] = field(default_factory=list)
+
+    def call(self, rng: random.Random, progress: float, context_tokens: int) -> tuple[float, bool]:
+        error_rate, factor = self.error_rate, 1.0
+        for start, end, degraded_error_rate, latency_factor in self.degradations:
+            if start <= progress < end:
+                error_rate, factor = degraded_error_rate, latency_factor
+        latency = rng.lognormvariate(math.log(self.median_latency * factor), self.sigma) + context_tokens / 20_000
+        if rng.random() < error_rate:
+            return min(latency, 10.0), False
+        return latency, True
+
+
+DEFAULT_LATENCIES = {1 : 0.6, 2 : 1.2, 3 : 2.5}
+
+
+def build_models(pool: list[ModelProfile], degradations: dict[str, list]) -> dict[str, SimulatedModel]:
+    return {
+        profile.name : SimulatedModel(profile, DEFAULT_LATENCIES.get(profile.quality, 1.5), degradations=degradations.get(profile.name, []))
+        for profile in pool
+    }
+
+
+def build_workload(rng: random.Random, requests: int) -> list[tuple[int, int]]:
+    """(query score, context tokens) pairs: mostly simple questions, a long tail of hard ones and long histories."""
+    workload = []
+    for _ in range(requests):
+        score = rng.choices([0, 1, 2, 3, 4], weights=[45, 25, 15, 10, 5])[0]
+        context_tokens = int(min(rng.expovariate(1 / 2500), 60_000))
+        workload.append((score, context_tokens))
+    return workload
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(math.ceil(q * len(ordered)) - 1, 0))] if ordered else 0.0
+
+
+def simulate(policy: str, pool: list[ModelProfile], models: dict[str, SimulatedModel], workload: list[tuple[int, int]], seed: int, max_p95: float, max_error_rate: float, interval: float = 0.1, health_max_age: float = 60) -> dict:
+    rng = random.Random(seed)
+    clock = {'now' : 0.0}
+    router = ModelRouter(pool, max_p95=max_p95, max_error_rate=max_error_rate, health_max_age=health_max_age, clock=lambda: clock['now'])
+    by_name = {profile.name : profile for profile in pool}
+    latencies, failures, shortfalls, fallbacks, cost = [], 0, 0, 0, 0.0
+
+    for index, (score, context_tokens) in enumerate(workload):
+        progress = index / len(workload)
+        clock['now'] = index * interval
+        if policy == 'router':
+            candidates, _ = router.route(score, context_tokens)
+        else:
+            candidates = [policy.split(':', 1)[1]]
+
+        elapsed, served = 0.0, None
+        for attempt, name in enumerate(candidates):
+            profile = by_name[name]
+            if profile.context_window < context_tokens:
+                continue
+            latency, ok = models[name].call(rng, progress, context_tokens)
+            router.record(name, latency, ok)
+            elapsed += latency
+            cost += profile.cost * (context_tokens + 500) / 1000
+            if ok:
+                served = profile
+                fallbacks += attempt > 0
+                break
+
+        latencies.append(elapsed)
+        if served is None:
+            failures += 1
+        elif served.quality < required_quality(score):
+            shortfalls += 1
+
+    total = len(workload)
+    return {
+        'policy' : policy,
+        'success' : 1 - failures / total,
+        'p50' : percentile(latencies, 0.5),
+        'p95' : percentile(latencies, 0.95),
+        'shortfall' : shortfalls / total,
+        'fallbacks' : fallbacks / total,
+        'cost' : cost / total,
+    }
+
+
+def parse_degradation(value: str) -> tuple[str, tuple[float, float, float, float]]:
+    """model:start:end[:error_rate[:latency_factor]]"""
+    name, start, end, *rest = value.split(':')
+    error_rate = float(rest[0]) if rest else 0.5
+    latency_factor = float(rest[1]) if len(rest) > 1 else 4.0
+    return name, (float(start), float(end), error_rate, latency_factor)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare routing policies on a synthetic workload.")
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--degrade', action='append', default=[], help="model:start:end[:error_rate[:latency_factor]], fractions of the run")
+    parser.add_argument('--max-p95', type=float, default=8.0)
+    parser.add_argument('--max-error-rate', type=float, default=0.25)
+    args = parser.parse_args()
+
+    pool = load_model_pool()
+    degradations : dict[str, list] = {}
+    for value in args.degrade:
+        name, window = parse_degradation(value)
+        degradations.setdefault(name, []).append(window)
+    models = build_models(pool, degradations)
+    workload = build_workload(random.Random(args.seed), args.requests)
+
+    policies = ['router', *(f"fixed:{profile.name}" for profile in pool)]
+    sys.stdout.write(f"{'policy':<34}{'success':>9}{'p50 s':>8}{'p95 s':>8}{'shortfall':>11}{'fallback':>10}{'cost':>8}\n")
+    for policy in policies:
+        result = simulate(policy, pool, models, workload, args.seed, args.max_p95, args.max_error_rate)
+        sys.stdout.write(
+            f"{result['policy']:<34}{result['success']:>9.3f}{result['p50']:>8.2f}{result['p95']:>8.2f}"
+            f"{result['shortfall']:>11.3f}{result['fallbacks']:>10.3f}{result['cost']:>8.2f}\n"
+        )
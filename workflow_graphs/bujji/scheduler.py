@@ -0,0 +1,305 @@
+import os
+import json
+import time
+import itertools
+import threading
+from abc import ABC, abstractmethod
+from bisect import insort
+from dataclasses import dataclass, field
+from typing import Callable
+from sqlalchemy import MetaData, Table, Column, String, Integer, insert, update, select, delete
+from sqlalchemy.exc import IntegrityError
+from .metrics import metrics
+
+LLM_SCHEDULER = os.getenv('LLM_SCHEDULER', 'false').lower() == 'true'
+# "local" keeps the budget in this process (tests, a single worker); "database" shares it through MEMORY_DATABASE_URL.
+LLM_SCHEDULER_BACKEND = os.getenv('LLM_SCHEDULER_BACKEND', 'local')
+LLM_TOKENS_PER_MINUTE = int(os.getenv('LLM_TOKENS_PER_MINUTE', 15000))
+LLM_REQUESTS_PER_MINUTE = int(os.getenv('LLM_REQUESTS_PER_MINUTE', 30))
+# Per-model overrides of the provider limits, e.g. LLM_RATE_LIMITS='{"llama-3.3-70b-versatile": {"tokens": 6000, "requests": 30}}'
+LLM_RATE_LIMITS = json.loads(os.getenv('LLM_RATE_LIMITS', '{}'))
+# Length of a budget window in seconds; the per-minute limits are scaled to it.
+LLM_RATE_WINDOW = int(os.getenv('LLM_RATE_WINDOW', 60))
+# Completion tokens charged up front, before the response tells us the real count.
+LLM_OUTPUT_TOKEN_RESERVE = int(os.getenv('LLM_OUTPUT_TOKEN_RESERVE', 1024))
+LLM_SCHEDULER_TIMEOUT = float(os.getenv('LLM_SCHEDULER_TIMEOUT', 120))
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class SchedulerTimeout(TimeoutError):
+    pass
+
+
+def estimate_request_tokens(messages: list) -> int:
+    """Tokens a call will count against the provider's limit: the prompt plus the expected completion."""
+    return sum(len(str(getattr(message, 'content', message))) for message in messages) // 4 + LLM_OUTPUT_TOKEN_RESERVE
+
+
+class BaseTokenBudget(ABC):
+    """
+    Tokens and requests used per model in fixed windows of `window` seconds.
+    `try_acquire` charges a request if it fits and returns 0, otherwise it returns the seconds until the window turns over.
+    """
+    def __init__(self, window: int = LLM_RATE_WINDOW, clock: Callable[[], float] = time.time):
+        self.window = window
+        self.clock = clock
+
+    def current_window(self) -> tuple[int, float]:
+        """The current window number and the seconds left in it."""
+        now = self.clock()
+        number = int(now // self.window)
+        return number, (number + 1) * self.window - now
+
+    @abstractmethod
+    def try_acquire(self, key: str, tokens: int, max_tokens: int, max_requests: int) -> tuple[float, int]:
+        ...
+
+    @abstractmethod
+    def settle(self, key: str, window: int, tokens: int):
+        """Correct the tokens charged in `window` by `tokens` once the real usage is known."""
+        ...
+
+
+class LocalTokenBudget(BaseTokenBudget):
+    def __init__(self, window: int = LLM_RATE_WINDOW, clock: Callable[[], float] = time.time):
+        super().__init__(window, clock)
+        self._windows : dict[tuple[str, int], list[int]] = {}
+        self._lock = threading.Lock()
+
+    def try_acquire(self, key: str, tokens: int, max_tokens: int, max_requests: int) -> tuple[float, int]:
+        number, remaining = self.current_window()
+        with self._lock:
+            for stale in [entry for entry in self._windows if entry[1] < number - 1]:
+                del self._windows[stale]
+            used = self._windows.setdefault((key, number), [0, 0])
+            if used[0] + tokens > max_tokens or used[1] + 1 > max_requests:
+                return remaining, number
+            used[0] += tokens
+            used[1] += 1
+            return 0.0, number
+
+    def settle(self, key: str, window: int, tokens: int):
+        with self._lock:
+            used = self._windows.get((key, window))
+            if used is not None:
+                used[0] = max(used[0] + tokens, 0)
+
+
+_metadata = MetaData()
+
+llm_rate_windows = Table(
+    'llm_rate_windows',
+    _metadata,
+    Column('model', String(255), primary_key=True),
+    Column('window', Integer, primary_key=True),
+    Column('tokens', Integer, nullable=False, default=0),
+    Column('requests', Integer, nullable=False, default=0),
+)
+
+
+class DatabaseTokenBudget(BaseTokenBudget):
+    """
+    The same windows in a table every worker can reach. A request is charged with one conditional UPDATE,
+    so concurrent workers cannot overshoot the limit between reading and writing the counters.
+    """
+    def __init__(self, engine_factory: Callable, window: int = LLM_RATE_WINDOW, clock: Callable[[], float] = time.time):
+        super().__init__(window, clock)
+        self._engine_factory = engine_factory
+        self._engine = None
+
+    def get_engine(self):
+        if self._engine is None:
+            self._engine = self._engine_factory()
+            _metadata.create_all(self._engine)
+        return self._engine
+
+    def try_acquire(self, key: str, tokens: int, max_tokens: int, max_requests: int) -> tuple[float, int]:
+        number, remaining = self.current_window()
+        row = (llm_rate_windows.c.model == key) & (llm_rate_windows.c.window == number)
+        fits = (llm_rate_windows.c.tokens + tokens <= max_tokens) & (llm_rate_windows.c.requests + 1 <= max_requests)
+        charge = update(llm_rate_windows).where(row & fits).values(tokens=llm_rate_windows.c.tokens + tokens, requests=llm_rate_windows.c.requests + 1)
+        with self.get_engine().begin() as connection:
+            if connection.execute(charge).rowcount:
+                return 0.0, number
+            if connection.execute(select(llm_rate_windows.c.window).where(row)).first() is not None:
+                return remaining, number
+        # First request of the window: create the row, or charge it if another worker just did.
+        try:
+            with self.get_engine().begin() as connection:
+                connection.execute(delete(llm_rate_windows).where((llm_rate_windows.c.model == key) & (llm_rate_windows.c.window < number - 1)))
+                connection.execute(insert(llm_rate_windows).values(model=key, window=number, tokens=min(tokens, max_tokens), requests=1))
+            return 0.0, number
+        except IntegrityError:
+            with self.get_engine().begin() as connection:
+                return (0.0 if connection.execute(charge).rowcount else remaining), number
+
+    def settle(self, key: str, window: int, tokens: int):
+        row = (llm_rate_windows.c.model == key) & (llm_rate_windows.c.window == window)
+        with self.get_engine().begin() as connection:
+            connection.execute(update(llm_rate_windows).where(row).values(tokens=llm_rate_windows.c.tokens + tokens))
+
+
+@dataclass(order=True)
+class Ticket:
+    priority : int
+    tag : float # finish tag in the model queue's virtual time, see LLMScheduler
+    seq : int
+    user_id : str = field(compare=False)
+    tokens : int = field(compare=False)
+
+
+@dataclass
+class Grant:
+    budget : BaseTokenBudget
+    model_name : str
+    window : int
+    tokens : int
+    waited : float
+
+    def settle(self, actual_tokens: int | None):
+        """
+        Replace the estimate with the tokens the provider reported, so the next requests see the real usage.
+        None leaves the estimate charged; 0 refunds it, e.g. for a call that failed.
+        """
+        if actual_tokens is not None:
+            self.budget.settle(self.model_name, self.window, actual_tokens - self.tokens)
+
+
+class _ModelQueue:
+    def __init__(self):
+        self.waiting : list[Ticket] = []
+        self.head_wait = 0.0 # seconds the request at the head was last told to wait for the budget
+        self.asking = False # a request is checking the budget outside the lock
+        self.virtual_time = 0.0
+        self.user_tags : dict[str, float] = {}
+
+
+class LLMScheduler:
+    """
+    Queues model calls per model until the shared token budget has room for them.
+
+    Within a worker, interactive requests go before background ones, and requests of the same priority are served
+    by start-time fair queuing on estimated tokens: every user's request is tagged with the user's previous tag
+    (or the queue's virtual time if the user was idle) plus its tokens, so a user with many or large requests
+    cannot hold back others. Only the head of a queue asks the budget, which keeps big requests from starving.
+    Across workers the budget itself is the coordination point.
+    """
+    def __init__(self, budget: BaseTokenBudget, limits: dict[str, dict] = LLM_RATE_LIMITS, tokens_per_minute: int = LLM_TOKENS_PER_MINUTE, requests_per_minute: int = LLM_REQUESTS_PER_MINUTE, poll_interval: float = 0.25):
+        self.budget = budget
+        self.limits = limits
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.poll_interval = poll_interval
+        self._queues : dict[str, _ModelQueue] = {}
+        self._seq = itertools.count()
+        self._condition = threading.Condition()
+
+    def window_limits(self, model_name: str) -> tuple[int, int]:
+        limits = self.limits.get(model_name, {})
+        scale = self.budget.window / 60
+        return (
+            max(int(limits.get('tokens', self.tokens_per_minute) * scale), 1),
+            max(int(limits.get('requests', self.requests_per_minute) * scale), 1),
+        )
+
+    def _enqueue(self, model_queue: _ModelQueue, user_id: str, tokens: int, priority: int) -> Ticket:
+        tag = max(model_queue.virtual_time, model_queue.user_tags.get(user_id, 0.0)) + tokens
+        model_queue.user_tags[user_id] = tag
+        ticket = Ticket(priority, tag, next(self._seq), user_id, tokens)
+        insort(model_queue.waiting, ticket)
+        return ticket
+
+    def _dequeue(self, model_queue: _ModelQueue, ticket: Ticket, served: bool):
+        model_queue.waiting.remove(ticket)
+        if served:
+            model_queue.virtual_time = max(model_queue.virtual_time, ticket.tag - ticket.tokens)
+        # Users whose last tag is behind the virtual time are idle and would start from it anyway.
+        for user_id in [user_id for user_id, tag in model_queue.user_tags.items() if tag <= model_queue.virtual_time]:
+            del model_queue.user_tags[user_id]
+        self._condition.notify_all()
+
+    def expected_wait(self, model_name: str, position: int) -> float:
+        """The head's wait for the budget plus the time the budget needs to pass the tokens queued ahead."""
+        max_tokens, _ = self.window_limits(model_name)
+        model_queue = self._queues[model_name]
+        return model_queue.head_wait + sum(ticket.tokens for ticket in model_queue.waiting[:position]) / (max_tokens / self.budget.window)
+
+    def acquire(self, model_name: str, user_id: str, tokens: int, priority: int = INTERACTIVE, on_wait: Callable[[dict], None] | None = None, timeout: float = LLM_SCHEDULER_TIMEOUT) -> Grant:
+        """
+        Block until the call fits the budget. `on_wait` gets the queue position (1 is next) and the expected wait
+        whenever they change. Raises SchedulerTimeout after `timeout` seconds.
+        """
+        max_tokens, max_requests = self.window_limits(model_name)
+        # A prompt larger than a whole window still has to go through eventually; it waits for an empty window instead.
+        tokens = min(tokens, max_tokens)
+        started = time.perf_counter()
+        deadline = time.monotonic() + timeout
+        reported = None
+        with self._condition:
+            model_queue = self._queues.setdefault(model_name, _ModelQueue())
+            ticket = self._enqueue(model_queue, user_id, tokens, priority)
+        # The lock only guards the queues: the budget (a database round-trip with the shared backend) and
+        # on_wait run without it, so other requests can join or leave the queue in the meantime.
+        try:
+            while True:
+                with self._condition:
+                    position = model_queue.waiting.index(ticket)
+                    asking = position == 0 and not model_queue.asking
+                    model_queue.asking = model_queue.asking or asking
+                if asking:
+                    try:
+                        head_wait, window = self.budget.try_acquire(model_name, tokens, max_tokens, max_requests)
+                    finally:
+                        with self._condition:
+                            model_queue.asking = False
+                            self._condition.notify_all()
+                    with self._condition:
+                        model_queue.head_wait = head_wait
+                        if head_wait == 0:
+                            self._dequeue(model_queue, ticket, served=True)
+                            break
+
+                with self._condition:
+                    position = model_queue.waiting.index(ticket)
+                    expected = round(self.expected_wait(model_name, position), 1)
+                # Updates go out when the position changes or the estimate moves by a second or more.
+                if on_wait is not None and (reported is None or position != reported[0] or abs(expected - reported[1]) >= 1):
+                    reported = (position, expected)
+                    on_wait({'model' : model_name, 'position' : position + 1, 'expected_wait' : expected})
+
+                remaining = deadline - time.monotonic()
+                with self._condition:
+                    if remaining <= 0:
+                        self._dequeue(model_queue, ticket, served=False)
+                        metrics.inc('llm_scheduler_timeouts_total', model=model_name)
+                        raise SchedulerTimeout(f"No capacity for {model_name} within {timeout}s")
+                    # Notifications sent while the lock was released are lost, so look for what they would have announced:
+                    # a new position, or the budget check another request was making at the head having finished.
+                    moved = model_queue.waiting.index(ticket) != position or (position == 0 and not asking and not model_queue.asking)
+                    if not moved:
+                        self._condition.wait(min(self.poll_interval, remaining))
+        except SchedulerTimeout:
+            raise
+        except BaseException:
+            with self._condition:
+                if ticket in model_queue.waiting:
+                    self._dequeue(model_queue, ticket, served=False)
+            raise
+
+        waited = time.perf_counter() - started
+        metrics.observe('llm_scheduler_wait_seconds', waited, model=model_name, priority='interactive' if priority == INTERACTIVE else 'background')
+        if reported is not None:
+            on_wait({'model' : model_name, 'position' : 0, 'expected_wait' : 0.0})
+        return Grant(self.budget, model_name, window, tokens, waited)
+
+
+def build_budget(backend: str = LLM_SCHEDULER_BACKEND) -> BaseTokenBudget:
+    if backend == 'database':
+        from .memory import Memory
+        return DatabaseTokenBudget(Memory.get_engine)
+    return LocalTokenBudget()
+
+
+llm_scheduler = LLMScheduler(build_budget())
@@ -1,5 +1,5 @@
 import operator
-from typing import Sequence
+from typing import Sequence, Callable
 from typing import TypedDict
 from typing_extensions import TypedDict, Annotated
 from langchain_core.messages import BaseMessage
@@ -8,13 +8,28 @@ from langchain_core.tools import BaseTool
 from langgraph.graph.message import add_messages
 from .memory import Memory
 from .vector_dbs import BaseVectorDB
+from .reducers import merge_dicts
+from .speculation import RetrievalPrefetch
 
 
 class WorkFlowState(TypedDict):
     _verbose : bool = False
     _conversation_metadata : dict = {}
+    _post_stream_tasks : list = [] # callables run by the caller after the stream is closed
+    _stream_writer : Callable[[dict], None] | None = None # caller's channel for events while a node is still running
+    _timings : Annotated[dict, merge_dicts] = {} # node name -> seconds
+    _tool_seconds : float = 0.0 # wall-clock time spent in tool_node this turn
+    _tool_tokens : int = 0 # tool output tokens passed to the model this turn, after compression
+    _tool_iterations : int = 0 # completed tool_node steps this turn
+    _input_tokens : int = 0 # prompt tokens sent to call_model this turn
+    _force_final_answer : bool = False # set once a turn budget is reached
+    _prefetch : RetrievalPrefetch | None = None # speculative Vector DB search for the user query
+    _model_candidates : list = [] # routed model followed by its fallbacks, only for model_name="Auto"
+    _priority : int = 0 # scheduler.INTERACTIVE for chat, scheduler.BACKGROUND for jobs that can wait
+    _trace : object | None = None # tracing.Trace when the turn is traced
+    _cassette : object | None = None # cassettes.CassetteRecorder or CassettePlayer when the turn is recorded or replayed
     response_mode : str = "Auto" # "Casual", "Scientific", "Story", "Kids", "Auto"
-    self_discussion : bool = False # True, False
+    self_discussion : bool | str = False # True, False, "auto" (build_context resolves it to a bool)
     pre_tools : list = [] # "Example Tool", "No Tool"
     model_name : str = "gemma2-9b-it" # "gemma2-9b-it", "Auto"
     model : ChatGroq
@@ -24,6 +39,7 @@ class WorkFlowState(TypedDict):
     conversation_id : str # uuid
     tools : Sequence[BaseTool] = [] # [BaseTool]
     user_query : str = ""
+    recalled_context : str = "" # relevant exchanges from long-term memory
     messages: Annotated[Sequence[BaseMessage], add_messages] = []
     memory_messages : Annotated[Sequence[BaseMessage], add_messages] = []
     new_messages : Annotated[Sequence[BaseMessage], add_messages] = []
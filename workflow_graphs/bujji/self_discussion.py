@@ -0,0 +1,74 @@
+import os
+import re
+import threading
+from typing import Sequence
+from langchain_core.tools import BaseTool
+from .tool_selection import SMALL_TALK, PURE_ARITHMETIC
+
+# Model for the planning call, e.g. a small fast one. Unset means the request's own model plans.
+SELF_DISCUSSION_MODEL = os.getenv('SELF_DISCUSSION_MODEL')
+# Score from which "auto" self-discussion plans before answering.
+SELF_DISCUSSION_THRESHOLD = int(os.getenv('SELF_DISCUSSION_THRESHOLD', 2))
+
+COMPLEX_WORDS = re.compile(
+    r'\b(?:why|compare|comparison|difference|versus|vs|analy[sz]e|evaluate|design|plan|strategy|trade-?offs?|pros and cons'
+    r'|step[- ]by[- ]step|explain how|implications?|recommend|should i|best way|debug|prove|derive)\b',
+    re.IGNORECASE,
+)
+# Tools whose use usually needs a plan: reading the user's files or a page, or several tools in a row.
+PLANNING_TOOLS = {'Vector DB Search', 'Web URL'}
+
+
+def score_query(user_query: str, has_files: bool, tools: Sequence[BaseTool], pre_tools: Sequence[str]) -> tuple[int, list[str]]:
+    """Cheap local estimate of how much a query benefits from planning, with the reasons that added to it."""
+    query = user_query or ""
+    if SMALL_TALK.match(query) or PURE_ARITHMETIC.match(query):
+        return 0, ['trivial']
+
+    reasons = []
+    words = len(query.split())
+    if words >= 25:
+        reasons.append('long')
+    if words >= 60:
+        reasons.append('very_long')
+    complex_words = {word.lower() for word in COMPLEX_WORDS.findall(query)}
+    if complex_words:
+        reasons.append('complex')
+    if len(complex_words) >= 2:
+        reasons.append('very_complex')
+    if query.count('?') >= 2:
+        reasons.append('multiple_questions')
+    tool_names = {tool.name for tool in tools}
+    if has_files:
+        reasons.append('attachments')
+        # Vector DB Search is bound whenever there are files, so it adds nothing the attachment has not counted.
+        tool_names.discard('Vector DB Search')
+    if tool_names & PLANNING_TOOLS or [name for name in pre_tools if name in tool_names]:
+        reasons.append('tools_likely')
+    return len(reasons), reasons
+
+
+class PlanningLatency:
+    """Moving average of planning call durations, used to estimate the time saved when planning is skipped."""
+    def __init__(self, initial: float = 2.0, alpha: float = 0.2):
+        self.value = initial
+        self.alpha = alpha
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self.value += self.alpha * (seconds - self.value)
+
+
+planning_latency = PlanningLatency(initial=float(os.getenv('SELF_DISCUSSION_DEFAULT_SECONDS', 2.0)))
+
+
+def decide(mode, user_query: str, has_files: bool, tools: Sequence[BaseTool], pre_tools: Sequence[str]) -> dict:
+    """
+    Self-discussion decision for a turn. `mode` is the request's flag: True and False are honoured as given,
+    "auto" plans only when the query scores at least SELF_DISCUSSION_THRESHOLD.
+    """
+    if isinstance(mode, str) and mode.lower() == 'auto':
+        score, reasons = score_query(user_query, has_files, tools, pre_tools)
+        return {'mode' : 'auto', 'plan' : score >= SELF_DISCUSSION_THRESHOLD, 'score' : score, 'reasons' : reasons}
+    return {'mode' : 'on' if mode else 'off', 'plan' : bool(mode)}
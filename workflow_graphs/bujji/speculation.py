@@ -0,0 +1,81 @@
+import os
+import re
+import logging
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from .vector_dbs import BaseVectorDB
+from .metrics import metrics
+from .tool_selection import FILE_WORDS
+from .compression import query_terms
+
+SPECULATIVE_RETRIEVAL = os.getenv('SPECULATIVE_RETRIEVAL', 'false').lower() == 'true'
+SPECULATIVE_RETRIEVAL_K = int(os.getenv('SPECULATIVE_RETRIEVAL_K', 5))
+# Seconds build_context waits for the prefetch before it gives up on injecting the result into the first prompt.
+SPECULATIVE_INJECT_WAIT = float(os.getenv('SPECULATIVE_INJECT_WAIT', 1.5))
+# Seconds the Vector DB tool waits for an unfinished prefetch before it runs its own query.
+SPECULATIVE_SERVE_WAIT = float(os.getenv('SPECULATIVE_SERVE_WAIT', 2.0))
+# Share of the shorter query's content words that the model's Vector DB query and the user's query must have in common.
+SPECULATIVE_MATCH_THRESHOLD = float(os.getenv('SPECULATIVE_MATCH_THRESHOLD', 0.6))
+
+CHUNK_SEPARATOR = re.compile(r'\n\n(?=Chunk \d+\n)')
+
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv('SPECULATIVE_MAX_WORKERS', 8)), thread_name_prefix='prefetch')
+
+
+class RetrievalPrefetch:
+    """
+    Vector DB search for the user's query started before the model has asked for it.
+    The Vector DB tool serves it when the model's query is close enough to the user's, and build_context injects it
+    into the first prompt when the question is clearly about the uploaded files.
+    """
+    def __init__(self, vector_db: BaseVectorDB, query: str, k: int = SPECULATIVE_RETRIEVAL_K):
+        self.query = query
+        self.k = k
+        self.confident = bool(FILE_WORDS.search(query))
+        self.injected = False
+        self.future = _executor.submit(vector_db.query, query, k)
+
+    def matches(self, query: str, k: int) -> bool:
+        if k > self.k:
+            return False
+        left, right = query_terms(query), query_terms(self.query)
+        return bool(left and right) and len(left & right) / min(len(left), len(right)) >= SPECULATIVE_MATCH_THRESHOLD
+
+    def result(self, timeout: float | None = None) -> str | None:
+        try:
+            return self.future.result(timeout=timeout)
+        except FutureTimeoutError:
+            metrics.inc('speculative_retrieval_total', result='timeout')
+            return None
+        except Exception as e:
+            logging.warning(f"Speculative retrieval failed: {e}")
+            metrics.inc('speculative_retrieval_total', result='error')
+            return None
+
+    def serve(self, query: str, k: int, timeout: float = SPECULATIVE_SERVE_WAIT) -> str | None:
+        """
+        The prefetched chunks trimmed to `k`, or None when the query differs too much to reuse them or the prefetch
+        is not done within `timeout` seconds.
+        """
+        if not self.matches(query, k):
+            metrics.inc('speculative_retrieval_total', result='miss')
+            return None
+        result = self.result(timeout)
+        if result is None:
+            return None
+        metrics.inc('speculative_retrieval_total', result='hit')
+        return '\n\n'.join(CHUNK_SEPARATOR.split(result)[:k])
+
+    def inject(self, timeout: float = SPECULATIVE_INJECT_WAIT) -> str | None:
+        if not self.confident:
+            return None
+        result = self.result(timeout)
+        if result:
+            self.injected = True
+            metrics.inc('speculative_retrieval_total', result='injected')
+        return result
+
+
+def start_prefetch(vector_db: BaseVectorDB | None, query: str, has_files: bool) -> RetrievalPrefetch | None:
+    if not SPECULATIVE_RETRIEVAL or not has_files or vector_db is None or not query:
+        return None
+    return RetrievalPrefetch(vector_db, query)
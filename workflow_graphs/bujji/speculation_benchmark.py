@@ -0,0 +1,65 @@
+"""
+Time to first token of a question about an attached file, with speculative retrieval off, served to the model's
+Vector DB Search call, and injected into the first prompt. Runs offline on graph_benchmark's setup; the scripted
+model's first-token latency and the embedding latency stand in for the provider and the embedding API.
+
+    python -m workflow_graphs.bujji.speculation_benchmark --turns 5 --first-token-latency 0.6 --embedding-latency 0.4
+"""
+import sys
+import time
+import uuid
+import argparse
+from statistics import median
+from langchain_core.messages import AIMessage, SystemMessage, ToolMessage
+from .graph_benchmark import ANSWER, BENCHMARK_MODEL, setup
+
+FILE_QUESTION = "What does the uploaded report say about revenue?"
+PLAIN_QUESTION = "What was the revenue last quarter?"
+
+# mode: (speculative retrieval on, question). Only a question that names the file gets the prefetch injected.
+MODES = {
+    'off' : (False, FILE_QUESTION),
+    'served' : (True, PLAIN_QUESTION),
+    'injected' : (True, FILE_QUESTION),
+}
+
+
+def respond(messages: list) -> AIMessage:
+    """Answer once file excerpts are in the prompt or the Vector DB tool has answered, otherwise search the file."""
+    if any(isinstance(message, ToolMessage) for message in messages) or any(isinstance(message, SystemMessage) and 'Relevant excerpts' in str(message.content) for message in messages):
+        return AIMessage(content=ANSWER)
+    return AIMessage(content='', tool_calls=[{'name' : 'Vector DB Search', 'args' : {'query' : 'revenue last quarter', 'k' : 3}, 'id' : f"call_{uuid.uuid4().hex[:8]}"}])
+
+
+def ttft(benchmark, query: str) -> float:
+    from .workflow import graph
+    state = benchmark.initial_state({'query' : query, 'self_discussion' : False, 'attachment' : True})
+    started = time.perf_counter()
+    first_token = None
+    for message, metadata in graph.stream(state, stream_mode='messages'):
+        if first_token is None and metadata.get('langgraph_node') == 'call_model' and message.content:
+            first_token = time.perf_counter() - started
+    for task in state['_post_stream_tasks']:
+        task()
+    return first_token
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure TTFT with and without speculative retrieval, offline.")
+    parser.add_argument('--turns', type=int, default=5)
+    parser.add_argument('--first-token-latency', type=float, default=0.6, help="seconds before each model reply starts")
+    parser.add_argument('--embedding-latency', type=float, default=0.4, help="seconds per embedding call, i.e. per vector query")
+    args = parser.parse_args()
+
+    benchmark = setup(args.first_token_latency, 0.0, args.embedding_latency)
+    from . import speculation
+    from .fakes import ScriptedChatModel
+    from .registry import model_registry
+    model_registry.register(BENCHMARK_MODEL, ScriptedChatModel(respond=respond, first_token_latency=args.first_token_latency))
+
+    sys.stdout.write(f"{'mode':<10}{'TTFT p50 s':>12}{'min s':>8}{'max s':>8}\n")
+    for mode, (enabled, query) in MODES.items():
+        speculation.SPECULATIVE_RETRIEVAL = enabled
+        ttft(benchmark, query)  # warm-up
+        seconds = [ttft(benchmark, query) for _ in range(args.turns)]
+        sys.stdout.write(f"{mode:<10}{median(seconds):>12.3f}{min(seconds):>8.3f}{max(seconds):>8.3f}\n")
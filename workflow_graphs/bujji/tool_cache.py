@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import hashlib
+import inspect
+import logging
+import threading
+from functools import wraps
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urlunsplit
+from .metrics import metrics
+
+# Seconds a result is served as fresh. After that it is served stale for the same period again while a refresh runs.
+TOOL_CACHE_TTLS = {
+    'Wikipedia' : 24 * 60 * 60,
+    'DuckDuckGo' : 30 * 60,
+    'Web URL' : 60 * 60,
+}
+DEFAULT_TOOL_CACHE_TTL = 10 * 60
+
+# Django cache alias used as the shared persistent tier when it is configured in settings.CACHES.
+PERSISTENT_CACHE_ALIAS = os.getenv('TOOL_CACHE_ALIAS', 'tool_results')
+
+
+def normalize_args(tool_name: str, args: dict) -> dict:
+    normalized = {}
+    for key, value in args.items():
+        if isinstance(value, str) and tool_name == 'Web URL':
+            parts = urlsplit(value.strip())
+            value = urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip('/') or '/', parts.query, ''))
+        elif isinstance(value, str):
+            value = ' '.join(value.split()).casefold()
+        normalized[key] = value
+    return normalized
+
+
+class ToolResultCache:
+    """
+    Shared cache of tool results keyed by tool name and normalized arguments.
+    Memory tier is a size-bounded LRU; the optional persistent tier is a Django cache shared by all workers.
+    Expired entries are served stale once more while a single background refresh replaces them.
+    """
+    def __init__(self, max_size: int = 1024, ttls: dict = TOOL_CACHE_TTLS):
+        self.max_size = max_size
+        self.ttls = ttls
+        self._entries : OrderedDict = OrderedDict()
+        self._refreshing : set[str] = set()
+        self._lock = threading.Lock()
+        self._refresher = ThreadPoolExecutor(max_workers=4, thread_name_prefix='tool-cache')
+
+    @staticmethod
+    def make_key(tool_name: str, args: dict) -> str:
+        payload = json.dumps(normalize_args(tool_name, args), sort_keys=True, default=str)
+        return f"tool:{tool_name}:{hashlib.sha1(payload.encode()).hexdigest()}"
+
+    @property
+    def persistent(self):
+        from django.conf import settings
+        from django.core.cache import caches
+        if PERSISTENT_CACHE_ALIAS not in getattr(settings, 'CACHES', {}):
+            return None
+        return caches[PERSISTENT_CACHE_ALIAS]
+
+    def _get_memory(self, key: str) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _set_memory(self, key: str, entry: dict):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def set(self, tool_name: str, key: str, value):
+        ttl = self.ttls.get(tool_name, DEFAULT_TOOL_CACHE_TTL)
+        now = time.time()
+        entry = {'value' : value, 'fresh_until' : now + ttl, 'stale_until' : now + 2 * ttl}
+        self._set_memory(key, entry)
+        persistent = self.persistent
+        if persistent is not None:
+            try:
+                persistent.set(key, entry, timeout=2 * ttl)
+            except Exception as e:
+                logging.warning(f"Tool cache persistent write failed: {e}")
+
+    def _refresh(self, tool_name: str, key: str, compute, should_cache):
+        try:
+            value = compute()
+            if should_cache(value):
+                self.set(tool_name, key, value)
+        except Exception as e:
+            logging.warning(f"Tool cache refresh for {tool_name} failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _revalidate(self, tool_name: str, key: str, compute, should_cache):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        self._refresher.submit(self._refresh, tool_name, key, compute, should_cache)
+
+    def get_or_compute(self, tool_name: str, args: dict, compute, should_cache=bool):
+        key = self.make_key(tool_name, args)
+        now = time.time()
+        tier = 'memory'
+        entry = self._get_memory(key)
+
+        if entry is None or entry['stale_until'] < now:
+            persistent = self.persistent
+            entry = None
+            if persistent is not None:
+                try:
+                    entry = persistent.get(key)
+                except Exception as e:
+                    logging.warning(f"Tool cache persistent read failed: {e}")
+                if entry is not None:
+                    tier = 'persistent'
+                    self._set_memory(key, entry)
+
+        if entry is not None and entry['fresh_until'] >= now:
+            metrics.inc('tool_cache_requests_total', tool=tool_name, result='hit', tier=tier)
+            return entry['value']
+
+        if entry is not None and entry['stale_until'] >= now:
+            metrics.inc('tool_cache_requests_total', tool=tool_name, result='stale', tier=tier)
+            self._revalidate(tool_name, key, compute, should_cache)
+            return entry['value']
+
+        metrics.inc('tool_cache_requests_total', tool=tool_name, result='miss', tier='none')
+        value = compute()
+        if should_cache(value):
+            self.set(tool_name, key, value)
+        return value
+
+    def cached(self, tool_name: str, should_cache=bool):
+        """Decorator for tool functions; apply it beneath @tool so the tool keeps the function's signature."""
+        def decorator(func):
+            signature = inspect.signature(func)
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                arguments = signature.bind(*args, **kwargs).arguments
+                return self.get_or_compute(tool_name, dict(arguments), lambda: func(*args, **kwargs), should_cache)
+            return wrapper
+        return decorator
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+tool_cache = ToolResultCache(max_size=int(os.getenv('TOOL_CACHE_SIZE', 1024)))
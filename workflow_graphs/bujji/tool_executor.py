@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+from typing import Sequence
+from langchain_core.messages import AIMessage, ToolMessage
+from langchain_core.tools import BaseTool
+from .metrics import metrics
+from .tool_cache import normalize_args
+from .tracing import span
+
+# Seconds a single call may take before it is answered with a timeout marker.
+TOOL_TIMEOUTS = {
+    'Calculator' : 5,
+    'Vector DB Search' : 10,
+    'Wikipedia' : 10,
+    'DuckDuckGo' : 10,
+    'Web URL' : 15,
+}
+DEFAULT_TOOL_TIMEOUT = 15
+TOOL_TURN_BUDGET = float(os.getenv('TOOL_TURN_BUDGET', 45))
+
+TOOL_CALL_ERROR_TEMPLATE = "Error: {error}\n Please fix your mistakes."
+TOOL_TIMEOUT_TEMPLATE = "Error: Tool '{name}' timed out after {timeout:.1f}s. No result is available, answer with what you have or try a different tool."
+TOOL_BUDGET_EXHAUSTED_TEMPLATE = "Error: Tool '{name}' was not run because the tool time budget for this turn is used up. Answer with what you have."
+TOOL_REPEATED_CALL_TEMPLATE = "Tool '{name}' was already called with the same arguments this turn and its result is above. Do not call it again; use that result or answer with what you have."
+
+
+def call_signature(tool_call: dict) -> str:
+    """Identity of a tool call for loop detection; only whitespace and case in text arguments are ignored."""
+    args = normalize_args(tool_call['name'], tool_call['args'])
+    return f"{tool_call['name']}:{json.dumps(args, sort_keys=True, default=str)}"
+
+
+def answered_calls(messages: list) -> set[str]:
+    """Signatures of the calls in `messages` that have a successful result; failed or timed-out calls may be retried."""
+    succeeded = {message.tool_call_id for message in messages if isinstance(message, ToolMessage) and message.status != 'error'}
+    return {call_signature(tool_call) for message in messages for tool_call in getattr(message, 'tool_calls', []) if tool_call['id'] in succeeded}
+
+
+TOOL_MAX_WORKERS = int(os.getenv('TOOL_MAX_WORKERS', 16)) # concurrent calls per AI message
+
+
+class Settlement:
+    """
+    Decides who reports a submitted call: the worker when it finishes in time, or the waiter when it times out.
+    An abandoned call stays in tool_calls_abandoned until its worker thread returns.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._settled = False
+
+    def claim(self) -> bool:
+        with self._lock:
+            claimed, self._settled = not self._settled, True
+            return claimed
+
+    def abandon(self) -> bool:
+        if not self.claim():
+            return False
+        metrics.add_gauge('tool_calls_abandoned', 1, tool=self.name)
+        return True
+
+    def finish(self) -> bool:
+        """True if the worker settled the call; otherwise it had been abandoned and is now no longer running."""
+        if self.claim():
+            return True
+        metrics.add_gauge('tool_calls_abandoned', -1, tool=self.name)
+        return False
+
+
+class ToolExecutor:
+    """
+    Runs every tool call of one AI message concurrently, on threads of its own so a call that hangs past its
+    timeout cannot hold a worker that later turns need.
+    Each call gets its own timeout, capped by what is left of the per-turn budget; calls that miss it are
+    answered with a timeout marker so the model still receives a result for every tool_call_id.
+    """
+    def __init__(self, tools: Sequence[BaseTool], timeouts: dict = TOOL_TIMEOUTS, turn_budget: float = TOOL_TURN_BUDGET):
+        self.tools_by_name = {tool.name : tool for tool in tools}
+        self.timeouts = timeouts
+        self.turn_budget = turn_budget
+
+    @staticmethod
+    def injected_args(tool: BaseTool) -> set[str]:
+        return set(tool.get_input_schema().model_fields) - set(tool.tool_call_schema.model_fields)
+
+    def run_one(self, tool_call: dict, state: dict, settlement: Settlement | None = None) -> ToolMessage:
+        name = tool_call['name']
+        tool = self.tools_by_name.get(name)
+        if tool is None:
+            content = f"Error: {name} is not a valid tool, try one of [{', '.join(self.tools_by_name)}]."
+            return ToolMessage(content, name=name, tool_call_id=tool_call['id'], status='error')
+
+        # A replayed turn is answered from its cassette, a recorded one gets the result appended to it.
+        cassette = state.get('_cassette')
+        if cassette is not None:
+            replayed = cassette.tool_result(tool_call)
+            if replayed is not None:
+                return replayed
+
+        started = time.perf_counter()
+        args = {**tool_call['args'], **{arg : state for arg in self.injected_args(tool)}}
+        with span('tool', tool=name) as tool_span:
+            try:
+                tool_message : ToolMessage = tool.invoke({**tool_call, 'args' : args, 'type' : 'tool_call'})
+                if not isinstance(tool_message.content, (str, list)):
+                    tool_message.content = str(tool_message.content)
+                status = 'ok'
+            except Exception as e:
+                tool_message = ToolMessage(TOOL_CALL_ERROR_TEMPLATE.format(error=repr(e)), name=name, tool_call_id=tool_call['id'], status='error')
+                status = 'error'
+            if tool_span is not None:
+                tool_span.set(status=status)
+        # A call that already timed out was reported as such by run().
+        if settlement is not None and not settlement.finish():
+            return tool_message
+        metrics.observe('tool_latency_seconds', time.perf_counter() - started, tool=name, status=status)
+        if cassette is not None:
+            cassette.record_tool(tool_call, tool_message, time.perf_counter() - started)
+        return tool_message
+
+    def run(self, message: AIMessage, state: dict, spent: float = 0.0, previous_calls: set[str] | None = None) -> list[ToolMessage]:
+        """`previous_calls` holds the signatures of calls already answered this turn; repeats are not run again."""
+        started = time.perf_counter()
+        remaining = max(self.turn_budget - spent, 0.0)
+        previous_calls = previous_calls or set()
+        futures : list[tuple[dict, float, Settlement, Future | None]] = []
+        outputs : dict[str, ToolMessage] = {}
+        executor = ThreadPoolExecutor(max_workers=max(min(len(message.tool_calls), TOOL_MAX_WORKERS), 1), thread_name_prefix='tool')
+        for tool_call in message.tool_calls:
+            if call_signature(tool_call) in previous_calls:
+                metrics.inc('tool_calls_repeated_total', tool=tool_call['name'])
+                outputs[tool_call['id']] = ToolMessage(TOOL_REPEATED_CALL_TEMPLATE.format(name=tool_call['name']), name=tool_call['name'], tool_call_id=tool_call['id'])
+                continue
+            timeout = min(self.timeouts.get(tool_call['name'], DEFAULT_TOOL_TIMEOUT), remaining)
+            settlement = Settlement(tool_call['name'])
+            # The worker runs in a copy of this context, so its spans are children of the tool_node span.
+            future = executor.submit(contextvars.copy_context().run, self.run_one, tool_call, state, settlement) if timeout > 0 else None
+            futures.append((tool_call, started + timeout, settlement, future))
+
+        try:
+            for tool_call, deadline, settlement, future in futures:
+                if future is None:
+                    metrics.inc('tool_budget_exhausted_total', tool=tool_call['name'])
+                    outputs[tool_call['id']] = ToolMessage(TOOL_BUDGET_EXHAUSTED_TEMPLATE.format(name=tool_call['name']), name=tool_call['name'], tool_call_id=tool_call['id'], status='error')
+                    continue
+                try:
+                    outputs[tool_call['id']] = future.result(timeout=max(deadline - time.perf_counter(), 0))
+                except FutureTimeoutError:
+                    if not settlement.abandon(): # finished just now, so its result is on its way
+                        outputs[tool_call['id']] = future.result()
+                        continue
+                    # The worker thread cannot be interrupted; it finishes in the background and its result is dropped.
+                    if future.cancel(): # it was still queued, so nothing is left running
+                        metrics.add_gauge('tool_calls_abandoned', -1, tool=tool_call['name'])
+                    timeout = deadline - started
+                    metrics.observe('tool_latency_seconds', timeout, tool=tool_call['name'], status='timeout')
+                    outputs[tool_call['id']] = ToolMessage(
+                        TOOL_TIMEOUT_TEMPLATE.format(name=tool_call['name'], timeout=timeout),
+                        name=tool_call['name'],
+                        tool_call_id=tool_call['id'],
+                        status='error',
+                    )
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        return [outputs[tool_call['id']] for tool_call in message.tool_calls]
@@ -0,0 +1,53 @@
+import re
+from typing import Sequence
+from langchain_core.tools import BaseTool
+
+# Tools bound when the query looks like an information request and nothing more specific matched.
+LOOKUP_TOOLS = ('DuckDuckGo', 'Wikipedia')
+# pre_tools values that leave the choice to the model instead of naming tools.
+NO_PRE_TOOLS = {'', 'no tool', 'none'}
+
+URL_PATTERN = re.compile(r'https?://\S+|www\.\S+|\b[\w-]+\.(?:com|org|net|io|dev|ai|edu|gov|co|in)(?:/\S*)?\b', re.IGNORECASE)
+ARITHMETIC_PATTERN = re.compile(r'\d\s*[-+*/^%x×÷]\s*\(?\s*\d|\d\s*%|\b(?:sqrt|log|sin|cos|tan)\s*\(', re.IGNORECASE)
+MATH_WORDS = re.compile(
+    r'\b(?:calculate|compute|solve|sum|average|mean|median|percent(?:age)?|interest|convert|multiply|divide|square root|how much|how many)\b',
+    re.IGNORECASE,
+)
+FILE_WORDS = re.compile(r'\b(?:file|document|pdf|upload(?:ed)?|attachment|doc|sheet|page|chapter|section|report|according to)\b', re.IGNORECASE)
+SMALL_TALK = re.compile(
+    r'^\s*(?:hi|hello|hey|yo|thanks|thank you|thx|ok(?:ay)?|cool|great|nice|bye|good (?:morning|afternoon|evening|night)|how are you)\b[\s!.?]*$',
+    re.IGNORECASE,
+)
+PURE_ARITHMETIC = re.compile(r'^[\d\s.,+\-*/^%()=?x×÷]+$', re.IGNORECASE)
+
+
+def select_tool_names(user_query: str, pre_tools: Sequence[str], has_files: bool) -> set[str]:
+    """
+    Names of the tools worth binding for this request.
+    Tools forced through pre_tools are always bound; the Vector DB tool needs uploaded files; the rest follow
+    cheap intent checks on the query, with Wikipedia and DuckDuckGo as the default for anything that is not
+    small talk or plain arithmetic.
+    """
+    names = {name for name in pre_tools if name.strip().lower() not in NO_PRE_TOOLS}
+    query = user_query or ""
+
+    if has_files:
+        names.add('Vector DB Search')
+    if SMALL_TALK.match(query):
+        return names
+    if ARITHMETIC_PATTERN.search(query) or MATH_WORDS.search(query):
+        names.add('Calculator')
+    if PURE_ARITHMETIC.match(query):
+        return names
+    if URL_PATTERN.search(query):
+        names.add('Web URL')
+    # Questions about the user's own files are answered from them, not from the web.
+    if not (has_files and FILE_WORDS.search(query)):
+        names.update(LOOKUP_TOOLS)
+    return names
+
+
+def select_tools(tools: Sequence[BaseTool], user_query: str, pre_tools: Sequence[str], has_files: bool) -> list[BaseTool]:
+    """Subset of `tools` in their original order, so equal subsets share one cached model binding."""
+    names = select_tool_names(user_query, pre_tools, has_files)
+    return [tool for tool in tools if tool.name in names]
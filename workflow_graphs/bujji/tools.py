@@ -1,81 +1,146 @@
-import re
+import os
+import json
+import logging
+import sqlite3
+import time
+import httpx
 from typing import Annotated, Optional
 from langchain_core.tools import tool
 from langchain_community.tools import DuckDuckGoSearchRun
-from langchain_community.document_loaders import UnstructuredURLLoader
 from duckduckgo_search.exceptions import RatelimitException
 from langchain_community.utilities import WikipediaAPIWrapper
 from langchain_community.tools import WikipediaQueryRun
 from langgraph.prebuilt import InjectedState
 from .vector_dbs import BaseVectorDB
+from .tool_cache import tool_cache
+from .rate_limit import TokenBucket, CircuitBreaker, SingleFlight, backoff_delay
+from .metrics import metrics
+from .fetchers import html_fetcher
+from .calculator import calculator, CalculatorError
+from .wiki_index import WikipediaIndex
 
 api_wrapper = WikipediaAPIWrapper(top_k_results=1, doc_content_chars_max=2000)
 wiki = WikipediaQueryRun(api_wrapper=api_wrapper)
+search = DuckDuckGoSearchRun(name="Search")
+
+# Outbound search is shared by every user of the worker, so it is throttled and guarded process-wide.
+search_bucket = TokenBucket(rate=float(os.getenv('DUCKDUCKGO_RATE', 1)), capacity=int(os.getenv('DUCKDUCKGO_BURST', 3)))
+search_breaker = CircuitBreaker('duckduckgo', failure_threshold=3, reset_timeout=60)
+search_flight = SingleFlight()
+SEARCH_RETRIES = 2
+WEB_URL_MAX_TOKENS = int(os.getenv('WEB_URL_MAX_TOKENS', 1500))
+
+RATE_LIMIT_MESSAGE = "Failed to get context from the web due to rate limiting."
+SEARCH_FALLBACK_PREFIX = "DuckDuckGo is rate limited right now, do not call it again this turn. Wikipedia results instead:"
+
+
+# "local" serves Wikipedia from the FTS index built by wiki_index.py and only calls the live API on a miss.
+WIKIPEDIA_BACKEND = os.getenv('WIKIPEDIA_BACKEND', 'api')
+wiki_index = WikipediaIndex(os.getenv('WIKIPEDIA_INDEX_PATH', 'wikipedia.sqlite3')) if WIKIPEDIA_BACKEND == 'local' else None
+
+
+def _wikipedia_search(query: str) -> str:
+    if wiki_index is not None:
+        try:
+            result = wiki_index.query(query)
+        except sqlite3.Error as e:
+            result = ""
+            logging.warning(f"Local Wikipedia index failed: {e}")
+        metrics.inc('wikipedia_local_requests_total', result='hit' if result else 'miss')
+        if result:
+            return result
+    return wiki.invoke(input=query)
+
+
+def _search_fallback(query: str) -> str:
+    metrics.inc('duckduckgo_fallback_total')
+    try:
+        return f"{SEARCH_FALLBACK_PREFIX}\n\n{_wikipedia_search(query)}"
+    except Exception:
+        return RATE_LIMIT_MESSAGE
+
+
+def _duckduckgo_search(query: str) -> str:
+    for attempt in range(SEARCH_RETRIES + 1):
+        if not search_breaker.allow():
+            break
+        try:
+            if not search_bucket.acquire(timeout=2):
+                break
+            result = search.run(query)
+            search_breaker.record_success()
+            return result
+        except RatelimitException:
+            metrics.inc('duckduckgo_rate_limited_total')
+            search_breaker.record_failure()
+        except Exception:
+            search_breaker.record_failure()
+            raise
+        finally:
+            search_breaker.release()
+        if attempt < SEARCH_RETRIES:
+            time.sleep(backoff_delay(attempt))
+    return _search_fallback(query)
+
 
 @tool("DuckDuckGo")
+@tool_cache.cached("DuckDuckGo", should_cache=lambda result: bool(result) and result != RATE_LIMIT_MESSAGE and not result.startswith(SEARCH_FALLBACK_PREFIX))
 def duckduckgo_search_tool(query: Annotated[str, "The search term to find information from DuckDuckGo."]) -> str:
     """
     Searches the web using DuckDuckGo and returns the results.
 
     Returns:
-        str: The search results obtained from DuckDuckGo or a rate limiting error message.
+        str: The search results obtained from DuckDuckGo, or Wikipedia results when DuckDuckGo is rate limited.
     """
-    try:
-        search = DuckDuckGoSearchRun(name="Search")
-        return search.run(query)
-    except RatelimitException:
-        return "Failed to get context from the web due to rate limiting."
+    # Identical queries already in flight share one outbound request.
+    return search_flight.do(' '.join(query.split()).casefold(), lambda: _duckduckgo_search(query))
 
 
 @tool("Web URL")
-def web_url_tool(url: Annotated[str, "A single URL to retrieve content from."]) -> str:
+@tool_cache.cached("Web URL")
+def web_url_tool(url: Annotated[str, "A single URL to retrieve content from."], query: Annotated[str, "Optional: what you are looking for on the page, used to keep the most relevant sections."] = "") -> str:
     """
     Web Scrap the content from the given URL.
 
     Returns:
-        str: A string summarizing the content retrieved from the URL.
+        str: The readable text of the page, trimmed to the most relevant sections.
     """
     if not url:
         return "No URL provided."
 
-    loader: UnstructuredURLLoader = UnstructuredURLLoader(urls=[url])  
-    docs: list = loader.load()  
-    content: str = ""  
-
-    for doc in docs:
-        content += f"Content: {doc.page_content.strip()}\n\n"  
-    return content  
+    try:
+        return html_fetcher.fetch_text(url, max_tokens=WEB_URL_MAX_TOKENS, query=query)
+    except httpx.HTTPStatusError as e:
+        return f"Failed to fetch {url}: HTTP {e.response.status_code}."
+    except httpx.HTTPError as e:
+        return f"Failed to fetch {url}: {e.__class__.__name__}."
 
 
 @tool("Calculator")
-def calculator_tool(expression: Annotated[str, "A string containing a mathematical expression"]) -> float:
+def calculator_tool(expression: Annotated[str, "A mathematical expression, e.g. '(3 + 4) * 2 ** 3' or 'sqrt(x) * 2' when values are given"], values: Annotated[Optional[list[float]], "Optional list of numbers. The expression is evaluated once per number bound to x, or once over the whole list with aggregates like mean(values)"] = None) -> float | str:
     """
-    Evaluates a basic arithmetic expression and returns the result.
-        
+    Evaluates an arithmetic expression and returns the result.
+    Supports + - * / // % **, parentheses, sqrt, log, exp, trig functions, and sum/mean/median/stdev/min/max over `values`.
+
     Returns:
-        float: The result of the evaluated expression or an error message if invalid.
+        float | str: The result (a JSON list when evaluated per value) or an error message if invalid.
     """
-    
-    valid_pattern = r'^[\d\s+\-*/().]+$'
-    
-    
-    if not re.match(valid_pattern, expression):
-        return "Error: Invalid expression. Only numbers and +, -, *, / operators are allowed."
-    
     try:
-        # Evaluate the expression
-        result = eval(expression)
-        return result
-    except Exception as e:
+        if values:
+            result = calculator.evaluate_many(expression, values)
+            return json.dumps(result) if isinstance(result, list) else result
+        return calculator.evaluate(expression)
+    except CalculatorError as e:
         return f"Error: {str(e)}"
 
 
 @tool("Wikipedia")
+@tool_cache.cached("Wikipedia")
 def wikipedia_search_tool(query: Annotated[str, "Search query for Wikipedia"]) -> str:
     """
     Searches Wikipedia and returns the result.
     """
-    return wiki.invoke(input=query)
+    return _wikipedia_search(query)
     
     
 @tool("Vector DB Search")
@@ -84,6 +149,13 @@ def vector_db_search_tool(query: Annotated[str, "Search query for vector databas
     Searches the vector database and returns the relvent chunks as result.
     """
     k = 10 if k > 10 else k
+    prefetch = state.get('_prefetch')
+    if prefetch is not None:
+        result = prefetch.serve(query, k)
+        if result is not None:
+            return result
     vector_db : BaseVectorDB = state['vector_db']
     return vector_db.query(query, k)
-    
\ No newline at end of file
+
+
+ALL_TOOLS = [calculator_tool, web_url_tool, duckduckgo_search_tool, wikipedia_search_tool, vector_db_search_tool]
@@ -0,0 +1,384 @@
+"""
+Per-turn tracing: a span for every graph node, model call, tool call, vector query, embedding call and database
+statement, carrying the conversation and user ids.
+
+The view starts a Trace before running the graph and finishes it afterwards. Nodes decorated with @traced open
+their span under the turn's root span and make it current for the thread, so span() anywhere below (tools, vector
+DBs, embeddings, database hooks) attaches to it. Without a current span, span() does nothing.
+
+TRACE_EXPORTER selects where finished traces go: "jsonl" (one span per line in TRACE_FILE), "otlp" (OTLP/JSON
+export requests, POSTed to OTLP_ENDPOINT or appended to TRACE_FILE), a dotted path to a SpanExporter subclass, or
+"none" to turn tracing off. TRACE_SAMPLE_RATE is the share of turns that are traced and exported. With
+TRACE_SLOW_SECONDS set, every turn is traced and unsampled turns are exported only when they took at least that long.
+"""
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+import contextvars
+import urllib.request
+from abc import ABC, abstractmethod
+from functools import wraps
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterator
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel, generate_from_stream
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from .hedging import as_chunk
+from .metrics import metrics
+
+TRACE_EXPORTER = os.getenv('TRACE_EXPORTER', 'none') # "none", "jsonl", "otlp" or a dotted path
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 1.0))
+TRACE_SLOW_SECONDS = float(os.getenv('TRACE_SLOW_SECONDS', 0)) # 0 exports sampled turns only
+TRACE_FILE = os.getenv('TRACE_FILE', 'traces.jsonl')
+OTLP_ENDPOINT = os.getenv('OTLP_ENDPOINT') # e.g. http://localhost:4318/v1/traces
+SERVICE_NAME = os.getenv('TRACE_SERVICE_NAME', 'bujji')
+EMBEDDING_BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+# Exports run off the request path, one at a time so file appends never interleave.
+_export_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='trace-export')
+current_span : contextvars.ContextVar['Span | None'] = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    __slots__ = ('trace', 'name', 'span_id', 'parent_id', 'start', 'end', 'attributes', 'status')
+
+    def __init__(self, trace: 'Trace', name: str, parent_id: str | None, attributes: dict):
+        self.trace = trace
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start = time.time_ns()
+        self.end : int | None = None
+        self.attributes = attributes
+        self.status = 'ok'
+
+    @property
+    def seconds(self) -> float:
+        return ((self.end or time.time_ns()) - self.start) / 1e9
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> dict:
+        return {
+            'trace_id' : self.trace.trace_id, 'span_id' : self.span_id, 'parent_id' : self.parent_id, 'name' : self.name,
+            'start' : self.start, 'end' : self.end, 'status' : self.status,
+            'attributes' : {'conversation_id' : self.trace.conversation_id, 'user_id' : self.trace.user_id, **self.attributes},
+        }
+
+
+class Trace:
+    """Spans of one turn. Spans that end after finish(), such as a timed-out tool still running, are dropped."""
+    def __init__(self, conversation_id: str, user_id: str, sampled: bool, exporter: 'SpanExporter'):
+        self.trace_id = uuid.uuid4().hex
+        self.conversation_id = conversation_id
+        self.user_id = user_id
+        self.sampled = sampled
+        self.exporter = exporter
+        self.root = Span(self, 'turn', None, {})
+        self.spans : list[Span] = []
+        self.finished = False
+        self._lock = threading.Lock()
+
+    def add(self, span: Span):
+        with self._lock:
+            if not self.finished:
+                self.spans.append(span)
+
+    @contextmanager
+    def span(self, name: str, parent: Span | None = None, **attributes) -> Iterator[Span]:
+        span = Span(self, name, (parent or self.root).span_id, attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.status = 'error'
+            span.attributes['error'] = repr(e)
+            raise
+        finally:
+            current_span.reset(token)
+            span.end = time.time_ns()
+            self.add(span)
+
+    def summary(self) -> dict:
+        """Where the turn's time went, compact enough for the assistant message's metadata."""
+        def total(spans: list[Span]) -> dict:
+            return {'count' : len(spans), 'seconds' : round(sum(span.seconds for span in spans), 4)}
+
+        by_name : dict[str, list[Span]] = {}
+        for span in self.spans:
+            by_name.setdefault(span.name, []).append(span)
+        nodes, tools = {}, {}
+        for span in by_name.get('node', []):
+            nodes[span.attributes['node']] = round(nodes.get(span.attributes['node'], 0) + span.seconds, 4)
+        for span in by_name.get('tool', []):
+            tools[span.attributes['tool']] = round(tools.get(span.attributes['tool'], 0) + span.seconds, 4)
+        model_keys = ('model', 'ttft', 'tokens_per_second', 'output_tokens', 'queue_time', 'scheduler_wait')
+        return {
+            'trace_id' : self.trace_id,
+            'seconds' : round(self.root.seconds, 4),
+            'exported' : self.sampled or self.root.seconds >= TRACE_SLOW_SECONDS > 0,
+            'nodes' : nodes,
+            'model_calls' : [{'seconds' : round(span.seconds, 4), 'status' : span.status, **{key : span.attributes[key] for key in model_keys if span.attributes.get(key) is not None}} for span in by_name.get('model', [])],
+            'tools' : tools,
+            'vector_queries' : total(by_name.get('vector.query', [])),
+            'embeddings' : total(by_name.get('embedding', [])),
+            'db' : total(by_name.get('db', [])),
+        }
+
+    def finish(self) -> dict:
+        self.root.end = time.time_ns()
+        summary = self.summary()
+        with self._lock:
+            self.finished = True
+            spans = [self.root, *self.spans]
+        if summary['exported']:
+            _export_executor.submit(self._export, [span.to_dict() for span in spans])
+        return summary
+
+    def _export(self, spans: list[dict]):
+        try:
+            self.exporter.export(spans)
+        except Exception as e:
+            logging.warning(f"Trace export failed: {e}")
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Span | None]:
+    """A child of the current span, or nothing when the turn is not traced."""
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    with parent.trace.span(name, parent=parent, **attributes) as child:
+        yield child
+
+
+def traced(node_name: str):
+    """Run the node inside a span under the turn's root span when the state carries a trace."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(state):
+            trace : Trace | None = state.get('_trace')
+            if trace is None:
+                return func(state)
+            with trace.span('node', node=node_name):
+                return func(state)
+        return wrapper
+    return decorator
+
+
+class SpanExporter(ABC):
+    @abstractmethod
+    def export(self, spans: list[dict]) -> None:
+        ...
+
+
+class JSONLSpanExporter(SpanExporter):
+    def __init__(self, path: str = TRACE_FILE):
+        self.path = path
+
+    def export(self, spans: list[dict]) -> None:
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.writelines(json.dumps(span, default=str) + '\n' for span in spans)
+
+
+class OTLPSpanExporter(SpanExporter):
+    """OTLP/JSON trace export requests, POSTed to an OTLP/HTTP collector or written one per line to a file."""
+    def __init__(self, endpoint: str | None = OTLP_ENDPOINT, path: str = TRACE_FILE, timeout: float = 5.0):
+        self.endpoint = endpoint
+        self.path = path
+        self.timeout = timeout
+
+    @staticmethod
+    def attribute(key: str, value: Any) -> dict:
+        if isinstance(value, bool):
+            return {'key' : key, 'value' : {'boolValue' : value}}
+        if isinstance(value, int):
+            return {'key' : key, 'value' : {'intValue' : str(value)}}
+        if isinstance(value, float):
+            return {'key' : key, 'value' : {'doubleValue' : value}}
+        return {'key' : key, 'value' : {'stringValue' : str(value)}}
+
+    def request(self, spans: list[dict]) -> dict:
+        return {'resourceSpans' : [{
+            'resource' : {'attributes' : [self.attribute('service.name', SERVICE_NAME)]},
+            'scopeSpans' : [{
+                'scope' : {'name' : 'workflow_graphs.bujji'},
+                'spans' : [{
+                    'traceId' : span['trace_id'],
+                    'spanId' : span['span_id'],
+                    **({'parentSpanId' : span['parent_id']} if span['parent_id'] else {}),
+                    'name' : span['name'] if span['name'] != 'node' else f"node {span['attributes']['node']}",
+                    'kind' : 3 if span['name'] in ('model', 'embedding', 'vector.query', 'db') else 1, # CLIENT, INTERNAL
+                    'startTimeUnixNano' : str(span['start']),
+                    'endTimeUnixNano' : str(span['end']),
+                    'attributes' : [self.attribute(key, value) for key, value in span['attributes'].items() if value is not None],
+                    'status' : {'code' : 2 if span['status'] == 'error' else 1},
+                } for span in spans],
+            }],
+        }]}
+
+    def export(self, spans: list[dict]) -> None:
+        body = json.dumps(self.request(spans)).encode()
+        if self.endpoint:
+            request = urllib.request.Request(self.endpoint, data=body, headers={'Content-Type' : 'application/json'}, method='POST')
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                pass
+            return
+        with open(self.path, 'ab') as file:
+            file.write(body + b'\n')
+
+
+EXPORTERS = {'jsonl' : JSONLSpanExporter, 'otlp' : OTLPSpanExporter}
+
+
+def build_exporter(name: str = TRACE_EXPORTER) -> SpanExporter | None:
+    if name == 'none':
+        return None
+    if name in EXPORTERS:
+        return EXPORTERS[name]()
+    from django.utils.module_loading import import_string
+    return import_string(name)()
+
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def get_exporter() -> SpanExporter | None:
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None and TRACE_EXPORTER != 'none':
+            _exporter = build_exporter()
+            install_db_hooks()
+    return _exporter
+
+
+def start_trace(conversation_id: str, user_id: str) -> Trace | None:
+    """A trace for the turn, or None when tracing is off or the turn is neither sampled nor a slow-turn candidate."""
+    exporter = get_exporter()
+    if exporter is None:
+        return None
+    sampled = random.random() < TRACE_SAMPLE_RATE
+    if not sampled and TRACE_SLOW_SECONDS <= 0:
+        return None
+    return Trace(conversation_id, user_id, sampled, exporter)
+
+
+def provider_queue_time(response_metadata: dict) -> float | None:
+    """Seconds the provider queued the request before processing it, where the provider reports it (Groq does)."""
+    for usage in (response_metadata.get('token_usage'), response_metadata.get('usage'), (response_metadata.get('x_groq') or {}).get('usage')):
+        if isinstance(usage, dict) and usage.get('queue_time') is not None:
+            return usage['queue_time']
+    return None
+
+
+class TracedChatModel(BaseChatModel):
+    """Streams from `model` and sets time to first token, throughput and provider queue time on the current span."""
+    model : Any
+
+    @property
+    def _llm_type(self) -> str:
+        return 'traced'
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        kwargs = {**kwargs, 'stop' : stop} if stop else kwargs
+        model_span = current_span.get()
+        started = time.perf_counter()
+        first_token = None
+        usage, response_metadata = {}, {}
+        # This model reports the chunks to the callbacks; the wrapped one must not report them a second time.
+        for chunk in self.model.stream(messages, config={'callbacks' : []}, **kwargs):
+            chunk = as_chunk(chunk)
+            if first_token is None and (chunk.content or getattr(chunk, 'tool_call_chunks', None)):
+                first_token = time.perf_counter()
+            usage = getattr(chunk, 'usage_metadata', None) or usage
+            response_metadata.update(chunk.response_metadata or {})
+            yield ChatGenerationChunk(message=chunk)
+        if model_span is not None:
+            finished = time.perf_counter()
+            first_token = first_token or finished
+            output_tokens = usage.get('output_tokens')
+            model_span.set(
+                ttft=round(first_token - started, 4),
+                input_tokens=usage.get('input_tokens'),
+                output_tokens=output_tokens,
+                tokens_per_second=round((output_tokens - 1) / (finished - first_token), 1) if output_tokens and output_tokens > 1 and finished > first_token else None,
+                queue_time=provider_queue_time(response_metadata),
+            )
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return generate_from_stream(self._stream(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+
+def instrument_model(model):
+    """Wrap the model for the current model span; untraced turns get the model back unchanged."""
+    return TracedChatModel(model=model) if current_span.get() is not None else model
+
+
+class TracedEmbeddings(Embeddings):
+    """Embedding calls as spans of the traced turn, plus batch size and latency metrics for every call."""
+    def __init__(self, embeddings: Embeddings):
+        self.embeddings = embeddings
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        metrics.observe('embedding_batch_size', len(texts), buckets=EMBEDDING_BATCH_BUCKETS, kind='documents')
+        with span('embedding', kind='documents', texts=len(texts)), metrics.timer('embedding_seconds', kind='documents'):
+            return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        metrics.observe('embedding_batch_size', 1, buckets=EMBEDDING_BATCH_BUCKETS, kind='query')
+        with span('embedding', kind='query', texts=1), metrics.timer('embedding_seconds', kind='query'):
+            return self.embeddings.embed_query(text)
+
+
+def traced_embeddings(embeddings: Embeddings) -> Embeddings:
+    return embeddings if isinstance(embeddings, TracedEmbeddings) else TracedEmbeddings(embeddings)
+
+
+def _django_execute(execute, sql, params, many, context):
+    if current_span.get() is None:
+        return execute(sql, params, many, context)
+    with span('db', system='django', operation=sql.lstrip().split(None, 1)[0].upper(), statement=sql[:200]):
+        return execute(sql, params, many, context)
+
+
+def _sqlalchemy_before(connection, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._trace_parent = current_span.get()
+        context._trace_start = time.time_ns()
+
+
+def _sqlalchemy_after(connection, cursor, statement, parameters, context, executemany):
+    # Recorded after the fact rather than made current, so a failed statement never leaves a span open.
+    parent : Span | None = getattr(context, '_trace_parent', None)
+    if parent is not None:
+        db_span = Span(parent.trace, 'db', parent.span_id, {'system' : 'memory', 'operation' : statement.lstrip().split(None, 1)[0].upper(), 'statement' : statement[:200]})
+        db_span.start = context._trace_start
+        db_span.end = time.time_ns()
+        parent.trace.add(db_span)
+
+
+def _add_django_wrapper(connection, **kwargs):
+    if _django_execute not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_django_execute)
+
+
+def install_db_hooks():
+    """Database statements on the Django connections and the memory engine become spans of the current turn."""
+    from django.db import connections
+    from django.db.backends.signals import connection_created
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    connection_created.connect(_add_django_wrapper, weak=False)
+    for connection in connections.all(initialized_only=True):
+        _add_django_wrapper(connection)
+    event.listen(Engine, 'before_cursor_execute', _sqlalchemy_before)
+    event.listen(Engine, 'after_cursor_execute', _sqlalchemy_after)
@@ -1,6 +1,9 @@
 import re
 import os
 import time
+import fcntl
+import shutil
+import threading
 import weaviate
 from abc import ABC, abstractmethod
 from uuid import uuid4
@@ -8,14 +11,42 @@ from pinecone import Pinecone, ServerlessSpec
 from langchain_pinecone import PineconeVectorStore
 from langchain_weaviate import WeaviateVectorStore
 from langchain_community.vectorstores.zilliz import Zilliz
+from langchain_community.vectorstores import FAISS
+from langchain_core.vectorstores import InMemoryVectorStore
+from langchain_core.embeddings import Embeddings
 from langchain_core.documents import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from qdrant_client import QdrantClient, models
 from langchain_qdrant import QdrantVectorStore
 from langchain_cohere import CohereEmbeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from functools import wraps
+from contextlib import contextmanager
+from .tracing import span, traced_embeddings
+from .metrics import metrics
+
+
+def build_embeddings(embeddings: Embeddings | None = None) -> Embeddings:
+    """Cohere unless given, wrapped so every call is measured and is an embedding span of the traced turn."""
+    return traced_embeddings(embeddings or CohereEmbeddings(model="embed-english-v3.0"))
+
+
+def traced_query(query):
+    @wraps(query)
+    def wrapper(self, *args, **kwargs):
+        backend = type(self).__name__
+        with span('vector.query', backend=backend), metrics.timer('vector_query_seconds', backend=backend):
+            return query(self, *args, **kwargs)
+    return wrapper
+
 
 class BaseVectorDB(ABC):
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Every backend's query is timed and is a vector.query span of the traced turn.
+        if 'query' in cls.__dict__:
+            cls.query = traced_query(cls.__dict__['query'])
+
     @abstractmethod
     def add_documents(self, documents: list[Document]) -> None:
         pass
@@ -53,7 +84,7 @@ class PineconeVectorDB(BaseVectorDB):
                 time.sleep(1)
                 
         self.index = self.client.Index(index_name)
-        self.embeddings = CohereEmbeddings(model="embed-english-v3.0")
+        self.embeddings = build_embeddings()
         self.store : PineconeVectorStore = PineconeVectorStore(index=self.index, embedding=self.embeddings)
         
             
@@ -88,7 +119,7 @@ class QdrantVectorDB(BaseVectorDB):
                     vectors_config=models.VectorParams(size=1024, distance=models.Distance.COSINE),
                 )
                 
-        self.embeddings = CohereEmbeddings(model="embed-english-v3.0")
+        self.embeddings = build_embeddings()
         self.store = QdrantVectorStore(client=self.client, collection_name=self.collection_name, embedding=self.embeddings)
         
             
@@ -116,7 +147,7 @@ class ZillizVectorDB(BaseVectorDB):
         
         self.text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
                 
-        self.embeddings = CohereEmbeddings(model="embed-english-v3.0")
+        self.embeddings = build_embeddings()
         self.store : Zilliz = Zilliz(embedding_function=self.embeddings, connection_args=self.connection_args, collection_name = self.collection_name)
     
     def add_documents(self, documents : list[list[str | Document]]) -> None:
@@ -136,13 +167,113 @@ class ZillizVectorDB(BaseVectorDB):
         self.store.delete(ids = ids)
 
 
+class FAISSVectorDB(BaseVectorDB):
+    """
+    Local FAISS index persisted under LOCAL_VECTOR_DB_DIR/<index_name>.
+    Suited to small per-user indexes that should not leave the worker host.
+    Writers on the host, in this process or another worker, take an exclusive flock on <index_name>.lock and
+    re-read the index before changing it; readers take a shared one so they never load a half-written index.
+    """
+    def __init__(self, index_name: str, embeddings: Embeddings | None = None):
+        self.index_name = index_name
+        self.folder_path = os.path.join(os.environ.get("LOCAL_VECTOR_DB_DIR", "vector_indexes"), index_name)
+        self.lock_path = f"{self.folder_path}.lock"
+        self.embeddings = build_embeddings(embeddings)
+        with self._locked(exclusive=False):
+            self.store : FAISS | None = self._load()
+
+    @contextmanager
+    def _locked(self, exclusive: bool):
+        os.makedirs(os.path.dirname(self.lock_path) or '.', exist_ok=True)
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load(self) -> FAISS | None:
+        if not os.path.exists(os.path.join(self.folder_path, "index.faiss")):
+            return None
+        return FAISS.load_local(self.folder_path, self.embeddings, allow_dangerous_deserialization=True, normalize_L2=True)
+
+    def add_documents(self, documents : list[list[str | Document]]) -> None:
+        uuids, docs = zip(*documents)
+        texts = [doc.page_content for doc in docs]
+        # Embed before taking the lock, so other writers only wait for the index update itself.
+        text_embeddings = list(zip(texts, self.embeddings.embed_documents(texts)))
+        metadatas = [doc.metadata for doc in docs]
+        with self._locked(exclusive=True):
+            self.store = self._load()
+            if self.store is None:
+                self.store = FAISS.from_embeddings(text_embeddings, self.embeddings, metadatas=metadatas, ids=list(uuids), normalize_L2=True)
+            else:
+                self.store.add_embeddings(text_embeddings, metadatas=metadatas, ids=list(uuids))
+            self.store.save_local(self.folder_path)
+
+    def similarity_search(self, query: str, k: int = 5, score_threshold: float = 0.0) -> list[tuple[Document, float]]:
+        if self.store is None:
+            return []
+        return self.store.similarity_search_with_relevance_scores(query, k=k, score_threshold=score_threshold)
+
+    def query(self, query: str, k: int = 5) -> str:
+        results = self.similarity_search(query, k=k)
+        response = ["Chunk " + str(id+1) + '\n' + result.page_content for id, (result, _) in enumerate(results)]
+        return "\n\n".join(response)
+
+    def delete_index(self):
+        with self._locked(exclusive=True):
+            shutil.rmtree(self.folder_path, ignore_errors=True)
+        self.store = None
+
+    def delete_vectors(self, ids : list = []) -> None:
+        with self._locked(exclusive=True):
+            self.store = self._load()
+            if self.store is None:
+                return
+            self.store.delete(ids=ids)
+            self.store.save_local(self.folder_path)
+
+
+class InMemoryVectorDB(BaseVectorDB):
+    """
+    Process-local index with no service behind it, for tests, benchmarks and offline development.
+    Instances with the same index_name share one store, like a hosted index shared by all requests.
+    """
+    _stores : dict[str, InMemoryVectorStore] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, index_name: str, embeddings: Embeddings | None = None):
+        self.index_name = index_name
+        with self._lock:
+            if index_name not in self._stores:
+                self._stores[index_name] = InMemoryVectorStore(build_embeddings(embeddings))
+            self.store = self._stores[index_name]
+
+    def add_documents(self, documents : list[list[str | Document]]) -> None:
+        uuids, docs = zip(*documents)
+        self.store.add_documents(documents=list(docs), ids=list(uuids))
+
+    def query(self, query: str, k: int = 5) -> str:
+        results = self.store.similarity_search(query, k=k)
+        response = ["Chunk " + str(id+1) + '\n' + result.page_content for id, result in enumerate(results)]
+        return "\n\n".join(response)
+
+    def delete_index(self):
+        with self._lock:
+            self._stores.pop(self.index_name, None)
+
+    def delete_vectors(self, ids : list = []) -> None:
+        self.store.delete(ids=ids)
+
+
 class WeaviateVectorDB:
     def __init__(self, index_name: str):
         self.client =  weaviate.connect_to_weaviate_cloud(cluster_url=os.environ.get("WEAVIATE_CLUSTER_URL"), auth_credentials=weaviate.auth.AuthApiKey(api_key=os.environ.get("WEAVIATE_API_KEY")), skip_init_checks=True)
         self.index_name = index_name
         self.text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
                 
-        self.embeddings = CohereEmbeddings(model="embed-english-v3.0")
+        self.embeddings = build_embeddings()
         self.store = WeaviateVectorStore(index_name=index_name, client=self.client, embedding=self.embeddings, text_key='content')
             
     
@@ -154,4 +285,13 @@ class WeaviateVectorDB:
     def query(self, query: str, k: int = 5) -> str:
         results = self.store.similarity_search(query, k=k)
         response = ["Chunk " + str(id+1) + '\n' + result.page_content for id, result in enumerate(results)]
-        return "\n\n".join(response)
\ No newline at end of file
+        return "\n\n".join(response)
+
+def get_vector_db(index_name: str) -> BaseVectorDB:
+    """The conversation vector store selected by VECTOR_DB_BACKEND: "pinecone" (default), "faiss" or "memory"."""
+    backend = os.environ.get("VECTOR_DB_BACKEND", "pinecone")
+    if backend == "memory":
+        return InMemoryVectorDB(index_name)
+    if backend == "faiss":
+        return FAISSVectorDB(index_name)
+    return PineconeVectorDB(index_name)
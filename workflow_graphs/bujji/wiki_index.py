@@ -0,0 +1,157 @@
+import re
+import os
+import bz2
+import sys
+import sqlite3
+import threading
+import argparse
+import xml.etree.ElementTree as ET
+
+LEAD_CHARS_MAX = 2000
+# bm25 relevance (as a positive number, higher is better) below which a full-text match counts as a miss
+WIKIPEDIA_MIN_SCORE = float(os.getenv('WIKIPEDIA_MIN_SCORE', 5.0))
+# Dropped from full-text queries, since every remaining term has to match
+STOPWORDS = frozenset('a an and are as at be by did do does for from how in is it of on or the to was were what when where which who why with'.split())
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS articles (id INTEGER PRIMARY KEY, title TEXT NOT NULL, lead TEXT NOT NULL);
+CREATE UNIQUE INDEX IF NOT EXISTS articles_title ON articles (title COLLATE NOCASE);
+CREATE VIRTUAL TABLE IF NOT EXISTS articles_fts USING fts5(title, lead, content='articles', content_rowid='id', tokenize='porter unicode61');
+"""
+
+
+def _strip_nested(text: str, open_token: str, close_token: str) -> str:
+    output, depth, index = [], 0, 0
+    while index < len(text):
+        if text.startswith(open_token, index):
+            depth += 1
+            index += len(open_token)
+        elif depth and text.startswith(close_token, index):
+            depth -= 1
+            index += len(close_token)
+        else:
+            if not depth:
+                output.append(text[index])
+            index += 1
+    return ''.join(output)
+
+
+def extract_lead(wikitext: str, max_chars: int = LEAD_CHARS_MAX) -> str:
+    """Plain text of the article's lead section (everything before the first heading)."""
+    lead = re.split(r'^==.*==\s*$', wikitext, maxsplit=1, flags=re.MULTILINE)[0]
+    lead = re.sub(r'<!--.*?-->', '', lead, flags=re.DOTALL)
+    lead = re.sub(r'<ref[^>]*/>', '', lead)
+    lead = re.sub(r'<ref[^>]*>.*?</ref>', '', lead, flags=re.DOTALL)
+    lead = _strip_nested(lead, '{{', '}}')
+    lead = _strip_nested(lead, '{|', '|}')
+    lead = re.sub(r'\[\[(?:File|Image|Category):[^\[\]]*(?:\[\[[^\]]*\]\][^\[\]]*)*\]\]', '', lead, flags=re.IGNORECASE)
+    lead = re.sub(r'\[\[(?:[^|\]]*\|)?([^\]]*)\]\]', r'\1', lead)
+    lead = re.sub(r'\[https?://\S+\s([^\]]*)\]', r'\1', lead)
+    lead = re.sub(r"'{2,}", '', lead)
+    lead = re.sub(r'<[^>]+>', '', lead)
+    lead = re.sub(r'[ \t]+', ' ', lead)
+    lead = re.sub(r'\n\s*\n+', '\n', lead).strip()
+    return lead[:max_chars]
+
+
+def iter_pages(dump_path: str):
+    """Stream (title, wikitext) for main-namespace, non-redirect pages of a MediaWiki XML dump (.xml or .xml.bz2)."""
+    opener = bz2.open if dump_path.endswith('.bz2') else open
+    with opener(dump_path, 'rb') as dump:
+        title = namespace = text = root = None
+        redirect = False
+        for event, element in ET.iterparse(dump, events=('start', 'end')):
+            if root is None:
+                root = element
+            if event == 'start':
+                continue
+            tag = element.tag.rsplit('}', 1)[-1]
+            if tag == 'title':
+                title = element.text
+            elif tag == 'ns':
+                namespace = element.text
+            elif tag == 'redirect':
+                redirect = True
+            elif tag == 'text':
+                text = element.text or ''
+            elif tag == 'page':
+                if namespace == '0' and not redirect and title and text:
+                    yield title, text
+                title = namespace = text = None
+                redirect = False
+                # Drop finished pages from the tree so memory stays flat on multi-GB dumps.
+                root.clear()
+
+
+class WikipediaIndex:
+    """
+    Local SQLite FTS5 index of Wikipedia article leads. Lookups try an exact title match first, then bm25 ranking
+    of articles that contain every query term; a best match scoring under `min_score` is a miss, so the caller
+    falls back to the live API instead of answering with a loosely related article.
+    """
+    def __init__(self, path: str, min_score: float = WIKIPEDIA_MIN_SCORE):
+        self.path = path
+        self.min_score = min_score
+        self._local = threading.local()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path)
+            connection.executescript(SCHEMA)
+        return connection
+
+    def import_dump(self, dump_path: str, batch_size: int = 1000) -> int:
+        connection = self.connection
+        count, batch = 0, []
+
+        def flush():
+            connection.executemany("INSERT OR REPLACE INTO articles (title, lead) VALUES (?, ?)", batch)
+            connection.commit()
+            batch.clear()
+
+        for title, wikitext in iter_pages(dump_path):
+            lead = extract_lead(wikitext)
+            if not lead:
+                continue
+            batch.append((title, lead))
+            count += 1
+            if len(batch) >= batch_size:
+                flush()
+        flush()
+        connection.execute("INSERT INTO articles_fts (articles_fts) VALUES ('rebuild')")
+        connection.commit()
+        return count
+
+    @staticmethod
+    def _match_expression(query: str) -> str:
+        terms = [term for term in re.findall(r'\w+', query) if term.lower() not in STOPWORDS]
+        return ' AND '.join(f'"{term}"' for term in terms)
+
+    def search(self, query: str, k: int = 1) -> list[tuple[str, str]]:
+        connection = self.connection
+        row = connection.execute("SELECT title, lead FROM articles WHERE title = ? COLLATE NOCASE", (query.strip(),)).fetchone()
+        if row:
+            return [row]
+        expression = self._match_expression(query)
+        if not expression:
+            return []
+        rows = connection.execute(
+            "SELECT title, lead, -bm25(articles_fts, 10.0, 1.0) AS score FROM articles_fts WHERE articles_fts MATCH ? ORDER BY score DESC LIMIT ?",
+            (expression, k),
+        ).fetchall()
+        return [(title, lead) for title, lead, score in rows if score >= self.min_score]
+
+    def query(self, query: str, k: int = 1) -> str:
+        """Same output shape as WikipediaQueryRun, or an empty string on a miss."""
+        return '\n\n'.join(f"Page: {title}\nSummary: {lead}" for title, lead in self.search(query, k))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Import a MediaWiki XML dump into a local Wikipedia index.")
+    parser.add_argument('dump', help="Path to pages-articles .xml or .xml.bz2")
+    parser.add_argument('--index', default=os.getenv('WIKIPEDIA_INDEX_PATH', 'wikipedia.sqlite3'))
+    args = parser.parse_args()
+    imported = WikipediaIndex(args.index).import_dump(args.dump)
+    sys.stdout.write(f"Imported {imported} articles into {args.index}\n")
@@ -1,7 +1,6 @@
 from langgraph.graph import StateGraph, START, END
-from langgraph.prebuilt import tools_condition
 from .schemas import WorkFlowState
-from .nodes import init_node, load_tools, load_model, load_memory, call_self_discussion, call_model, tool_node, pick_tool_messages, save_messages_to_memory
+from .nodes import init_node, load_tools, load_model, load_memory, build_context, call_self_discussion, call_model, route_model_output, stop_tool_loop, tool_node, compress_tool_outputs, pick_tool_messages, save_messages_to_memory
 
 
 
@@ -12,26 +11,34 @@ workflow.add_node('init', init_node)
 workflow.add_node('load_tools', load_tools)
 workflow.add_node('load_model', load_model)
 workflow.add_node('load_memory', load_memory)
+workflow.add_node('build_context', build_context)
 workflow.add_node('call_self_discussion', call_self_discussion)
 workflow.add_node('call_model', call_model)
 workflow.add_node('tool_node', tool_node)
+workflow.add_node('stop_tool_loop', stop_tool_loop)
+workflow.add_node('compress_tool_outputs', compress_tool_outputs)
 workflow.add_node('pick_tool_messages', pick_tool_messages)
 
 workflow.add_node('save_messages_to_memory', save_messages_to_memory)
 
-workflow.set_entry_point('init')
 workflow.set_finish_point('save_messages_to_memory')
 
+# Tool and model loading need the conversation's files from init; the history read is independent, so the two
+# branches fan out from START and join in build_context
+workflow.add_edge(START, 'init')
+workflow.add_edge(START, 'load_memory')
 workflow.add_edge('init', 'load_tools')
 workflow.add_edge('load_tools', 'load_model')
-workflow.add_edge('load_model', 'load_memory')
+workflow.add_edge(['load_model', 'load_memory'], 'build_context')
 workflow.add_edge('call_self_discussion', 'call_model')
-workflow.add_edge('tool_node', 'pick_tool_messages')
+workflow.add_edge('tool_node', 'compress_tool_outputs')
+workflow.add_edge('compress_tool_outputs', 'pick_tool_messages')
+workflow.add_edge('stop_tool_loop', 'pick_tool_messages')
 workflow.add_edge('pick_tool_messages', 'call_model')
 
 
-workflow.add_conditional_edges('load_memory', lambda stage : 'make_dicussion' if stage['self_discussion'] else 'no_dicussion', {'make_dicussion' : 'call_self_discussion', 'no_dicussion' : 'call_model'})
-workflow.add_conditional_edges('call_model', tools_condition, {'tools' : 'tool_node', '__end__' : 'save_messages_to_memory'})
+workflow.add_conditional_edges('build_context', lambda stage : 'make_dicussion' if stage['self_discussion'] else 'no_dicussion', {'make_dicussion' : 'call_self_discussion', 'no_dicussion' : 'call_model'})
+workflow.add_conditional_edges('call_model', route_model_output, {'tools' : 'tool_node', 'budget_exhausted' : 'stop_tool_loop', '__end__' : 'save_messages_to_memory'})
 
 graph = workflow.compile()
 